@@ -0,0 +1,4 @@
+"""
+Benchmarks for the bug tracker's hot paths.  Run each module with
+``python -m benchmarks.<name>``; see its docstring for what it needs.
+"""
@@ -0,0 +1,101 @@
+"""
+Compare the bug_details and login paths with and without prepared statements.
+
+Each path is run many times on a pooled connection, which prepares its
+statements once and then only sends EXECUTE, and on a plain connection,
+which sends the full query text every time.  Password hashing is left out
+of the login path so the numbers show the database round trips only::
+
+    python -m benchmarks.prepared_statements --bug 42 --user alice \\
+        [--iterations 2000] [--settings settings.py]
+"""
+import argparse
+import statistics
+import sys
+import time
+import psycopg2
+from bookmarky import bug_bookmarks, bug_users
+from bookmarky.bug_dbutil import PooledConnection
+
+
+def bug_details_path(dbc, bid, user_name):
+    bug_bookmarks.get_bug_details(dbc, bid)
+
+
+def login_path(dbc, bid, user_name):
+    # /login looks the user up, then load_user fetches the profile on the
+    # next request
+    user = bug_users.lookup_user(dbc, user_name)
+    bug_users.get_user(dbc, user['id'])
+
+
+PATHS = [('bug_details', bug_details_path), ('login', login_path)]
+
+
+def timings(dbc, path, bid, user_name, iterations, warmup=50):
+    """
+    Time repeated runs of a path.
+    :param dbc: A database connection.
+    :param path: The path function.
+    :param bid: The bug ID to show.
+    :param user_name: The user to log in as.
+    :param iterations: The number of timed runs.
+    :param warmup: The number of untimed runs first.
+    :return: A list of run times in seconds.
+    """
+    for _ in range(warmup):
+        path(dbc, bid, user_name)
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        path(dbc, bid, user_name)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summary(times):
+    times = sorted(times)
+    return {'mean': statistics.mean(times),
+            'p50': times[len(times) // 2],
+            'p95': times[int(len(times) * 0.95)]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.prepared_statements',
+                                     description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--bug', type=int, required=True,
+                        help='ID of a bug to show')
+    parser.add_argument('--user', required=True, help='user name to log in as')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--settings', default='settings.py',
+                        help='settings file holding PG_ARGS')
+    args = parser.parse_args(argv)
+    config = {}
+    with open(args.settings) as f:
+        exec(compile(f.read(), args.settings, 'exec'), config)
+
+    plain = psycopg2.connect(**config['PG_ARGS'])
+    pooled = psycopg2.connect(connection_factory=PooledConnection,
+                              **config['PG_ARGS'])
+    try:
+        print('{:<12} {:<10} {:>10} {:>10} {:>10}'.format(
+            'path', 'mode', 'mean ms', 'p50 ms', 'p95 ms'))
+        for name, path in PATHS:
+            results = {}
+            for mode, dbc in (('plain', plain), ('prepared', pooled)):
+                results[mode] = summary(timings(dbc, path, args.bug,
+                                                args.user, args.iterations))
+                print('{:<12} {:<10} {mean:>10.3f} {p50:>10.3f} {p95:>10.3f}'
+                      .format(name, mode, **{k: v * 1000 for k, v
+                                             in results[mode].items()}))
+            saved = 1 - results['prepared']['mean'] / results['plain']['mean']
+            print('{:<12} prepared statements save {:.1%} of mean latency'
+                  .format(name, saved))
+    finally:
+        plain.close()
+        pooled.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
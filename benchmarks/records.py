@@ -0,0 +1,94 @@
+"""
+Compare per-row dictionaries with the Bug and Comment records.
+
+Builds a bug list and a comment list of the given size from synthetic rows
+shaped like the cursor's, once as dictionaries (as the fetch functions used
+to) and once with ``Record._make``, and reports build time and memory held.
+No database is needed::
+
+    python -m benchmarks.records [--rows 50000] [--repeat 5]
+"""
+import argparse
+import datetime
+import gc
+import sys
+import time
+import tracemalloc
+from bookmarky.bug_records import Bug, Comment
+
+
+def bug_rows(n):
+    now = datetime.datetime(2024, 1, 1)
+    for i in range(n):
+        yield (i, 'Bug {} crashes on save'.format(i),
+               'Steps to reproduce bug {}'.format(i), i % 500,
+               now, i % 50, now, '', 'Open', None, 'High', i % 20,
+               'Milestone {}'.format(i % 20), now, ['ui', 'crash'], 1, i % 30)
+
+
+def comment_rows(n):
+    now = datetime.datetime(2024, 1, 1)
+    for i in range(n):
+        yield (i, now, 'Comment {} about the crash'.format(i),
+               'User {}'.format(i % 500), i % 1000)
+
+
+def as_dicts(record, rows):
+    fields = record._fields
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def as_records(record, rows):
+    return list(map(record._make, rows))
+
+
+def measure(build, record, rows, repeat):
+    """
+    Time and size one way of building records.
+    :return: (best build time in seconds, bytes allocated and still held)
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        build(record, rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build(record, rows)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del built
+    return best, held
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.records',
+                                     description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print('{:<8} {:<8} {:>10} {:>12}'.format('rows', 'form', 'build ms',
+                                              'memory KiB'))
+    for record, make_rows in ((Bug, bug_rows), (Comment, comment_rows)):
+        # materialize the rows first: their values are shared by both forms,
+        # so only the containers are measured
+        rows = list(make_rows(args.rows))
+        results = {}
+        for form, build in (('dict', as_dicts), ('record', as_records)):
+            results[form] = measure(build, record, rows, args.repeat)
+            print('{:<8} {:<8} {:>10.1f} {:>12.0f}'.format(
+                record.__name__, form, results[form][0] * 1000,
+                results[form][1] / 1024))
+        print('{:<8} records take {:.0%} of the time and {:.0%} of the memory'
+              .format(record.__name__,
+                      results['record'][0] / results['dict'][0],
+                      results['record'][1] / results['dict'][1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,83 @@
+import datetime
+import decimal
+import json
 import flask
 import psycopg2
 import sys
+from psycopg2.extras import execute_values
+from markupsafe import Markup, escape
+from bookmarky import bug_rollups, bug_statements
+from bookmarky.bug_dbutil import bump_versions
+from bookmarky.bug_records import Bug, Comment, Developer, Milestone
+from bookmarky.bug_tags import tag_index
+
+def bug_stamp(bid):
+    """
+    Name the version stamp bumped whenever a bug or its comments change.
+    :param bid: The bug ID.
+    :return: The stamp name.
+    """
+    return 'bug:{}'.format(bid)
+
+
+def feed_stamp(uid):
+    """
+    Name the version stamp bumped whenever a comment reaches a user's news
+    feed.
+    :param uid: The user ID.
+    :return: The stamp name.
+    """
+    return 'feed:{}'.format(uid)
+
+
+# The NOTIFY channel for changes pushed to live news feeds (bug_events).
+EVENT_CHANNEL = 'bug_events'
+
+# Comment IDs per notification, keeping payloads well under the 8000-byte
+# NOTIFY limit.
+_EVENT_IDS_PER_NOTIFY = 500
+
+
+def _notify(cur, payload):
+    # delivered to listeners only if, and when, the transaction commits
+    cur.execute('SELECT pg_notify(%s, %s)', (EVENT_CHANNEL, json.dumps(payload)))
+
+
+def parse_tags(text):
+    """
+    Parse a comma-separated tag field.
+    :param text: The tag text as entered on the form.
+    :return: A sorted list of distinct, non-empty, lower-case tags.
+    """
+    return sorted({tag.strip().lower() for tag in text.split(',')} - {''})
+
+
+def sync_tags(cur, bid, tags):
+    """
+    Make a bug's tags exactly ``tags`` with one batched delete and one batched
+    insert, whatever the number of tags.
+    :param cur: A cursor in the caller's transaction.
+    :param bid: The bug ID.
+    :param tags: The new tag list, as returned by parse_tags.
+    :return: The (added, removed) lists of tags.
+    """
+    cur.execute('''
+        DELETE FROM bug_tag
+        WHERE bug_id = %s AND tag <> ALL(%s::text[])
+        RETURNING tag
+    ''', (bid, tags))
+    removed = [tag for tag, in cur]
+    cur.execute('''
+        INSERT INTO bug_tag (bug_id, tag)
+        SELECT %s, new_tag
+        FROM unnest(%s::text[]) AS new_tag
+        WHERE NOT EXISTS (SELECT 1 FROM bug_tag
+                          WHERE bug_id = %s AND tag = new_tag)
+        RETURNING tag
+    ''', (bid, tags, bid))
+    added = [tag for tag, in cur]
+    return added, removed
+
 
 def create_bug(dbc, uid, form):
     with dbc, dbc.cursor() as cur:
@@ -24,111 +101,149 @@ def create_bug(dbc, uid, form):
               status, bug_priority, milestone_id))
         bid = cur.fetchone()[0]
 
-        tags = form['tags'].split(',')
-        for tag in tags:
+        tags = parse_tags(form['tags'])
+        if tags:
             cur.execute('''
-                INSERT INTO bug_tag (bug_id, tag) VALUES (%s, %s)
-            ''', (bid, tag.strip().lower()))
+                INSERT INTO bug_tag (bug_id, tag)
+                SELECT %s, unnest(%s::text[])
+            ''', (bid, tags))
 
+        bug_rollups.bug_created(cur, bid)
+        stamps = [bug_stamp(bid), 'bugs', 'reports']
+        if tags:
+            stamps.append('tags')
+        versions = bump_versions(cur, *stamps)
 
-def update_bug(dbc, bid, form):
-    ntries = 1
-    while ntries < 5:
-        try:
-            with dbc:
-                with dbc.cursor() as cur:
+    if tags:
+        tag_index.bug_changed([], None, tags, status, versions['tags'])
 
-                    cur.execute('''
-                      SELECT bug_id FROM bug
-                      WHERE bug_id = %s
-                    ''', (bid,))
-                    row = cur.fetchone()
-                    if row is None:
-                        flask.abort(403)
 
-                    bug_title = form['bug_title'].strip()
-                    if not bug_title:
-                        bug_title = None
-                    bug_details = form['bug_details'].strip()
-                    if not bug_details:
-                        bug_details = None
-                    bug_priority = form['bug_priority']
-                    if not bug_priority:
-                        bug_priority = None
-                    milestone_id = form['milestone']
-                    if not milestone_id:
-                        milestone_id = None
-                    assignee = form['assignee'].strip()
-                    if not assignee:
-                        assignee = None
-                    status = form['status'].strip()
-                    if not status:
-                        status = None
+class BugConflict(Exception):
+    """
+    Raised when a bug edit was based on a version of the bug that has since
+    been changed by someone else.
+    """
 
-                    cur.execute('''
-                        UPDATE bug
-                        SET bug_title = %s, bug_details = %s,
-                            bug_priority = %s, milestone_id = %s,
-                            assignee = %s, status = %s
-                        WHERE bug_id = %s
-                    ''', (bug_title, bug_details, bug_priority,
-                          milestone_id, assignee, status, bid))
+    def __init__(self, bid):
+        super(BugConflict, self).__init__('bug {} has changed'.format(bid))
+        self.bid = bid
 
 
-                    ##tag items
-                    cur.execute('''
-                        SELECT tag FROM bug_tag WHERE bug_id = %s
-                    ''', (bid,))
-                    old_tags = []
-                    for tag, in cur:
-                        old_tags.append(tag)
-                    tags = [t.strip().lower() for t in form['tags'].split(',')]
-                    for tag in tags:
-                        if tag not in old_tags:
-                            cur.execute('''
-                              INSERT INTO bug_tag (bug_id, tag) VALUES (%s, %s)
-                            ''', (bid, tag))
-                    for tag in old_tags:
-                        if tag not in tags:
-                            cur.execute('''
-                              DELETE FROM bug_tag
-                              WHERE bug_id = %s AND tag = %s
-                            ''', (bid, tag))
-                return
-        except psycopg2.DatabaseError as dbe:
-            print("commit error: {}".format(dbe), file=sys.stderr)
-            dbc.rollback()
-            ntries += 1
+def _edited_fields(form):
+    # the edit form's values, keyed by bug column; blank means NULL
+    def text(name):
+        return form[name].strip() or None
 
-    flask.abort(500)
+    def record_id(name):
+        value = text(name)
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            flask.abort(400)
 
+    return {'bug_title': text('bug_title'),
+            'bug_details': text('bug_details'),
+            'bug_priority': text('bug_priority'),
+            'milestone_id': record_id('milestone'),
+            'assignee': record_id('assignee'),
+            'status': text('status')}
+
+
+def update_bug(dbc, bid, form):
+    """
+    Apply an edit to a bug, writing only the fields (and tags) that changed.
+    The edit must be based on the bug's current version; it is never merged
+    with, or retried over, a concurrent edit.  A new assignee's news feed
+    gets the bug's earlier comments, as if they had just been added.
+    :param dbc: A database connection.  This function will make and commit a
+                transaction.
+    :param bid: The bug ID.
+    :param form: The edit form, including the 'version' of the bug it was
+                 rendered from.
+    :raises BugConflict: if the bug has changed since that version.
+    """
+    try:
+        version = int(form['version'])
+    except (KeyError, ValueError):
+        flask.abort(400)
+    edited = _edited_fields(form)
+    tags = parse_tags(form['tags'])
 
-def get_for_user(dbc, uid):
     with dbc, dbc.cursor() as cur:
+        _GET_BUG.execute(cur, (bid,))
+        row = cur.fetchone()
+        if row is None:
+            flask.abort(403)
+        bug = Bug._make(row)
+        if bug.version != version:
+            raise BugConflict(bid)
+
+        changed = {name: value for name, value in edited.items()
+                   if getattr(bug, name) != value}
+        old_tags = sorted(bug.tags)
+        if not changed and tags == old_tags:
+            return
+
+        # the version test makes this a no-op if another edit committed
+        # since the bug was read, without holding a lock in between
+        columns = sorted(changed)
         cur.execute('''
-            SELECT bookmark_id, tag
-            FROM bookmark JOIN bm_tag USING (bookmark_id)
-            WHERE owner_id = %s
-        ''', (uid,))
-        tag_map = {}
-        for bid, tag in cur:
-            if bid in tag_map:
-                tag_map[bid].append(tag)
-            else:
-                tag_map[bid] = [tag]
+            UPDATE bug
+            SET {assignments}
+            WHERE bug_id = %s AND version = %s
+        '''.format(assignments=', '.join(
+            ['{} = %s'.format(name) for name in columns] +
+            ['version = version + 1'])),
+                    [changed[name] for name in columns] + [bid, version])
+        if cur.rowcount == 0:
+            raise BugConflict(bid)
+
+        status = edited['status']
+        bug_rollups.bug_changed(cur, bid, bug.milestone_id, bug.status,
+                                edited['milestone_id'], status)
+        if tags != old_tags:
+            sync_tags(cur, bid, tags)
+        stamps = [bug_stamp(bid), 'bugs', 'reports']
+        if changed.get('assignee') is not None:
+            cur.execute('''
+                INSERT INTO news_feed_item (user_id, comment_id)
+                SELECT %s, comment_id FROM comment WHERE bug_id = %s
+                ON CONFLICT DO NOTHING
+            ''', (changed['assignee'], bid))
+            if cur.rowcount:
+                stamps.append(feed_stamp(changed['assignee']))
+        if 'status' in changed or 'assignee' in changed:
+            _notify(cur, {'type': 'bug', 'bug_id': bid,
+                          'bug_title': edited['bug_title'], 'status': status,
+                          'old_status': bug.status,
+                          'assignee': edited['assignee'],
+                          'old_assignee': bug.assignee})
+        tags_changed = tags != old_tags or (old_tags and status != bug.status)
+        if tags_changed:
+            stamps.append('tags')
+        versions = bump_versions(cur, *stamps)
+
+    if tags_changed:
+        tag_index.bug_changed(old_tags, bug.status, tags, status,
+                              versions['tags'])
+
 
+def get_for_user(dbc, uid):
+    with dbc, dbc.cursor() as cur:
         cur.execute('''
             SELECT bookmark_id, url, COALESCE(title, url),
-             notes, create_time
+             notes, create_time,
+             ARRAY(SELECT tag FROM bm_tag
+                   WHERE bm_tag.bookmark_id = bookmark.bookmark_id)
             FROM bookmark
             WHERE owner_id = %s
             ORDER BY create_time DESC
         ''', (uid,))
         marks = []
-        for id, url, title, notes, time in cur:
+        for id, url, title, notes, time, tags in cur:
             marks.append({'id': id, 'url': url, 'title': title,
                           'notes': notes, 'create_time': time,
-                          'tags': tag_map.get(id, [])})
+                          'tags': tags})
         return marks
 
 
@@ -139,12 +254,7 @@ def get_milestones(dbc):
             FROM milestone
             ORDER BY target_date
         ''')
-        milestones = []
-        for milestone_id, milestone_title, target_date in cur:
-            milestones.append({'milestone_id': milestone_id,
-                               'milestone_title': milestone_title,
-                               'target_date': target_date})
-        return milestones
+        return list(map(Milestone._make, cur))
 
 
 def get_developers(dbc):
@@ -155,159 +265,686 @@ def get_developers(dbc):
             WHERE role LIKE('Developer')
             ORDER BY display_name
         ''')
-        developers = []
-        for user_id, display_name in cur:
-            developers.append({'user_id': user_id,
-                               'display_name': display_name})
-        return developers
+        return list(map(Developer._make, cur))
+
+# The users whose news feeds show a bug's comments: its creator, its assignee
+# and its subscribers.  Used LATERAL against a row exposing ``bug``.
+_FEED_RECIPIENTS = '''
+    SELECT bug.creator
+    UNION SELECT bug.assignee
+    UNION SELECT subscription.user_id
+          FROM subscription
+          WHERE subscription.bug_id = bug.bug_id'''
+
+
+def _record_id(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError('must be a positive integer')
+    return value
+
+
+def _hours(value):
+    try:
+        value = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        raise ValueError('must be a number')
+    if not value.is_finite() or not 0 < value <= 24:
+        raise ValueError('must be more than 0 and at most 24')
+    return value
+
+
+def _text(value):
+    # JSON entries may hold null or a number here; str() would store 'None'
+    if not isinstance(value, str):
+        raise TypeError('must be text')
+    value = value.strip()
+    if not value:
+        raise ValueError('must not be empty')
+    return value
+
+
+def _check_batch(dbc, entries, fields):
+    """
+    Validate a batch of entries, each a dictionary.  ``fields`` lists the
+    (name, converter) pairs to read from each entry; the first two must be
+    the bug ID and the user ID, which are checked against the database with
+    one query each.
+    :return: A (rows, errors) pair: the converted tuples and a list of
+             {'row': n, 'error': message} dictionaries, rows numbered from 1.
+    """
+    rows = []
+    errors = []
+    for n, entry in enumerate(entries, 1):
+        row = []
+        for name, convert in fields:
+            try:
+                row.append(convert(entry[name]))
+            except KeyError:
+                errors.append({'row': n, 'error': '{} is missing'.format(name)})
+                break
+            except (TypeError, ValueError) as e:
+                errors.append({'row': n, 'error': '{}: {}'.format(name, e)})
+                break
+        else:
+            rows.append((n, tuple(row)))
 
-def add_comment(dbc, bid, uid, form):
     with dbc, dbc.cursor() as cur:
-        comment_text = form['comment_text'].strip()
-
         cur.execute('''
-            INSERT INTO comment
-              (comment_author, bug_id, comment_text)
-            VALUES (%s, %s, %s)
-            RETURNING comment_id
-        ''', (uid, bid, comment_text))
+            SELECT bug_id FROM bug WHERE bug_id = ANY(%s)
+        ''', (list({row[0] for _, row in rows}),))
+        bugs = {bug_id for bug_id, in cur}
+        cur.execute('''
+            SELECT user_id FROM bug_user WHERE user_id = ANY(%s)
+        ''', (list({row[1] for _, row in rows}),))
+        users = {user_id for user_id, in cur}
+    for n, row in rows:
+        if row[0] not in bugs:
+            errors.append({'row': n, 'error': 'no bug {}'.format(row[0])})
+        elif row[1] not in users:
+            errors.append({'row': n, 'error': 'no user {}'.format(row[1])})
+    errors.sort(key=lambda error: error['row'])
+    return [row for _, row in rows], errors
+
+
+def _batches(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+class PartialLoad(Exception):
+    """
+    Raised when a bulk load fails part way through.  The entries before
+    ``row`` (numbered from 1) were committed and have the new ``ids``; that
+    entry and the ones after it were not added.
+    """
+
+    def __init__(self, ids, row, error):
+        super(PartialLoad, self).__init__(
+            'stopped at row {}: {}'.format(row, error))
+        self.ids = ids
+        self.row = row
+
+
+def _load_batches(dbc, rows, batch_size, insert):
+    # each group is its own transaction; if one fails, say how far the load
+    # got so the rest can be retried without adding the first part twice
+    ids = []
+    for batch in _batches(rows, batch_size):
+        try:
+            with dbc, dbc.cursor() as cur:
+                batch_ids = insert(cur, batch)
+        except psycopg2.Error as e:
+            if not ids:
+                raise
+            raise PartialLoad(ids, len(ids) + 1, str(e).strip()) from e
+        ids.extend(batch_ids)
+    return ids
+
+
+def add_comments_batch(dbc, entries, batch_size=1000):
+    """
+    Add many comments.  The whole batch is validated first; if any entry is
+    invalid nothing is added.  Otherwise the comments are inserted
+    ``batch_size`` at a time, each group with one multi-row insert and
+    committed together with its comment counts, news feed items and version
+    stamps.
+    :param dbc: A database connection.  This function will make and commit
+                transactions.
+    :param entries: Dictionaries with 'bug_id', 'user_id' (the author) and
+                    'comment_text'.
+    :param batch_size: The number of comments per transaction.
+    :return: A dictionary with the new comment 'ids', in entry order, and the
+             per-entry 'errors'.
+    :raise PartialLoad: If a group fails after earlier ones were committed.
+    """
+    rows, errors = _check_batch(dbc, entries, [('bug_id', _record_id),
+                                               ('user_id', _record_id),
+                                               ('comment_text', _text)])
+    if errors:
+        return {'ids': [], 'errors': errors}
+    return {'ids': _load_batches(dbc, rows, batch_size, _insert_comments),
+            'errors': []}
+
+
+def _insert_comments(cur, batch):
+    comment_ids = [comment_id for comment_id, in execute_values(cur, '''
+        INSERT INTO comment (bug_id, comment_author, comment_text)
+        VALUES %s
+        RETURNING comment_id
+    ''', batch, page_size=len(batch), fetch=True)]
+    cur.execute('''
+        UPDATE bug
+        SET comment_count = bug.comment_count + added.comment_count
+        FROM (SELECT bug_id, COUNT(*) AS comment_count
+              FROM comment
+              WHERE comment_id = ANY(%s)
+              GROUP BY bug_id) AS added
+        WHERE bug.bug_id = added.bug_id
+    ''', (comment_ids,))
+
+    # fan out to the news feeds now, so reading a feed is a range scan
+    cur.execute('''
+        INSERT INTO news_feed_item (user_id, comment_id)
+        SELECT recipient.user_id, comment.comment_id
+        FROM comment
+        JOIN bug USING (bug_id)
+        CROSS JOIN LATERAL ({recipients}) AS recipient (user_id)
+        WHERE comment.comment_id = ANY(%s)
+          AND recipient.user_id IS NOT NULL
+        RETURNING user_id
+    '''.format(recipients=_FEED_RECIPIENTS), (comment_ids,))
+    stamps = {feed_stamp(user_id) for user_id, in cur}
+    stamps.update(bug_stamp(row[0]) for row in batch)
+    bump_versions(cur, *stamps)
+    for start in range(0, len(comment_ids), _EVENT_IDS_PER_NOTIFY):
+        _notify(cur, {'type': 'comments', 'ids': comment_ids[
+            start:start + _EVENT_IDS_PER_NOTIFY]})
+    return comment_ids
 
-def get_bug_comments(dbc,bid):
+
+def add_comment(dbc, bid, uid, form):
+    result = add_comments_batch(dbc, [{'bug_id': bid, 'user_id': uid,
+                                       'comment_text': form['comment_text']}])
+    if result['errors']:
+        flask.abort(400)
+    return result['ids'][0]
+
+
+_GET_BUG_COMMENTS = bug_statements.statement('get_bug_comments', '''
+    SELECT comment_id, comment_date,
+           comment_text, display_name, bug_id
+    FROM comment
+    JOIN bug_user ON(comment.comment_author = bug_user.user_id)
+    WHERE comment.bug_id = %s
+    ORDER BY comment_date DESC, comment_id DESC
+    LIMIT %s
+''')
+
+_GET_BUG_COMMENTS_BEFORE = bug_statements.statement('get_bug_comments_before', '''
+    SELECT comment_id, comment_date,
+           comment_text, display_name, bug_id
+    FROM comment
+    JOIN bug_user ON(comment.comment_author = bug_user.user_id)
+    WHERE comment.bug_id = %s
+      AND (comment_date, comment_id) < (%s, %s)
+    ORDER BY comment_date DESC, comment_id DESC
+    LIMIT %s
+''')
+
+
+def _comment_page(comments, limit):
+    # the fetch asks for one extra row to learn whether another page follows
+    more = len(comments) > limit
+    del comments[limit:]
+    return {'comments': comments,
+            'next': _comment_cursor(comments[-1]) if more else None}
+
+
+def get_bug_comments(dbc, bid, limit=50, before=None):
+    """
+    Get one page of a bug's comments, newest first, using a keyset on
+    (comment_date, comment_id).
+    :param dbc: A database connection.  This function will take a transaction.
+    :param bid: The bug ID.
+    :param limit: The page size.
+    :param before: Cursor of the last comment on the previous page, to fetch
+                   the page following it.
+    :return: A dictionary with the page's 'comments', as Comment records, and
+             the 'next' cursor (None on the last page).
+    """
     with dbc, dbc.cursor() as cur:
-        cur.execute('''
-            SELECT comment_id, comment_date,
-                   comment_text, display_name
-            FROM comment
-            JOIN bug_user ON(comment.comment_author = bug_user.user_id)
-            WHERE comment.bug_id = %s
-            ORDER BY comment_date DESC
-        ''', (bid,))
-        bug_comments = []
-        for (comment_id, comment_date,
-             comment_text, display_name) in cur:
-            bug_comments.append({'comment_id': comment_id,
-                                 'comment_date': comment_date,
-                                 'comment_text': comment_text,
-                                 'display_name': display_name})
-        return bug_comments
-
-
-def get_news_comments(dbc,uid):
+        if before is None:
+            _GET_BUG_COMMENTS.execute(cur, (bid, limit + 1))
+        else:
+            comment_date, comment_id = _parse_cursor(before)
+            _GET_BUG_COMMENTS_BEFORE.execute(
+                cur, (bid, comment_date, comment_id, limit + 1))
+        return _comment_page(list(map(Comment._make, cur)), limit)
+
+
+_GET_NEWS_COMMENTS = bug_statements.statement('get_news_comments', '''
+    SELECT comment_id, comment_date,
+           comment_text, display_name, bug_id
+    FROM news_feed_item
+    JOIN comment USING(comment_id)
+    JOIN bug_user ON(comment.comment_author=bug_user.user_id)
+    WHERE news_feed_item.user_id = %s
+    ORDER BY news_feed_item.comment_id DESC
+    LIMIT %s
+''')
+
+# Oldest first, by the transaction that added each item, so a poll that
+# finds more than a page of new comments returns the first page and the
+# client continues from its last comment.  Comment IDs are taken at insert
+# but become visible at commit, so a lower one can turn up after a higher
+# one has been returned; only items from transactions that had all finished
+# before this statement's snapshot are returned, and none of those can
+# appear later.
+_GET_NEWS_COMMENTS_SINCE = bug_statements.statement(
+    'get_news_comments_since', '''
+    SELECT comment_id, comment_date,
+           comment_text, display_name, bug_id, news_feed_item.xact_id
+    FROM news_feed_item
+    JOIN comment USING(comment_id)
+    JOIN bug_user ON(comment.comment_author=bug_user.user_id)
+    WHERE news_feed_item.user_id = %s
+      AND (news_feed_item.xact_id, news_feed_item.comment_id) > (%s, %s)
+      AND news_feed_item.xact_id < txid_snapshot_xmin(txid_current_snapshot())
+    ORDER BY news_feed_item.xact_id, news_feed_item.comment_id
+    LIMIT %s
+''')
+
+
+def _feed_cursor(xact_id, comment_id):
+    return '{},{}'.format(xact_id, comment_id)
+
+
+def _parse_feed_cursor(cursor):
+    # an (xact_id, comment_id) position, as made by _feed_cursor
+    try:
+        xact_id, comment_id = cursor.split(',')
+        return int(xact_id), int(comment_id)
+    except ValueError:
+        flask.abort(400)
+
+
+def get_feed_deliveries(dbc, comment_ids, uids):
+    """
+    Find which of some users' news feeds some comments went to.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param comment_ids: The comment IDs.
+    :param uids: The user IDs to consider.
+    :return: A list of (user ID, Comment record) pairs.
+    """
     with dbc, dbc.cursor() as cur:
         cur.execute('''
-            SELECT comment_id, comment_date,
-                   comment_text, display_name
-            FROM comment
+            SELECT news_feed_item.user_id, comment_id, comment_date,
+                   comment_text, display_name, bug_id
+            FROM news_feed_item
+            JOIN comment USING(comment_id)
             JOIN bug_user ON(comment.comment_author=bug_user.user_id)
-            JOIN bug USING(bug_id)
-            LEFT OUTER JOIN subscription USING(bug_id)
-            WHERE bug.creator = %s
-               OR bug.assignee = %s
-               OR subscription.user_id = %s
-            ORDER BY comment_date DESC
-        ''', (uid, uid, uid))
-        news_comments = []
-        for (comment_id, comment_date,
-             comment_text, display_name) in cur:
-            news_comments.append({'comment_id': comment_id,
-                                  'comment_date': comment_date,
-                                  'comment_text': comment_text,
-                                  'display_name': display_name})
-        return news_comments
-
-
-def add_hours_worked(dbc, bid, uid, form):
-    print('in add_hours_worked - before with dbc')
+            WHERE news_feed_item.comment_id = ANY(%s)
+              AND news_feed_item.user_id = ANY(%s)
+            ORDER BY comment_id
+        ''', (list(comment_ids), list(uids)))
+        return [(row[0], Comment._make(row[1:])) for row in cur]
+
+
+def get_bug_watchers(dbc, bid, uids):
+    """
+    Find which of some users follow a bug in their news feed: its creator,
+    its assignee and its subscribers.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param bid: The bug ID.
+    :param uids: The user IDs to consider.
+    :return: A set of user IDs.
+    """
     with dbc, dbc.cursor() as cur:
-        print('in add_hours_worked - after with dbc')
-
-        hours_worked = form['hours_worked'].strip()
-        print('hours worked = ')
         cur.execute('''
-            INSERT INTO hours
-              (user_id, bug_id, hours_worked)
-            VALUES (%s, %s, %s)
-            RETURNING hours_id
-        ''', (uid, bid, hours_worked))
+            SELECT recipient.user_id
+            FROM bug
+            CROSS JOIN LATERAL ({recipients}) AS recipient (user_id)
+            WHERE bug.bug_id = %s AND recipient.user_id = ANY(%s)
+        '''.format(recipients=_FEED_RECIPIENTS), (bid, list(uids)))
+        return {user_id for user_id, in cur}
+
+
+def get_news_comments(dbc, uid, limit=50, since=None):
+    """
+    Get a user's news feed, newest first, or the comments added to it since
+    an earlier poll, oldest first.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param uid: The user ID.
+    :param limit: The maximum number of comments to return.
+    :param since: If given, the cursor returned by the previous call: only
+                  comments added after it are returned, in the order they
+                  were committed.  A transaction still open holds later
+                  comments back until it ends, so none is ever skipped.
+    :return: A dictionary with the 'comments', as Comment records, and the
+             'since' cursor for the next poll.  The first poll after a full
+             feed may repeat comments it showed; clients drop those by
+             comment_id.
+    """
+    with dbc, dbc.cursor() as cur:
+        if since is None:
+            # taken first: everything finished before it is in the feed
+            # read below, anything later is left to the next poll
+            cur.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            since = _feed_cursor(cur.fetchone()[0], 0)
+            _GET_NEWS_COMMENTS.execute(cur, (uid, limit))
+            return {'comments': list(map(Comment._make, cur)),
+                    'since': since}
+        _GET_NEWS_COMMENTS_SINCE.execute(
+            cur, (uid,) + _parse_feed_cursor(since) + (limit,))
+        comments = []
+        for row in cur:
+            comments.append(Comment._make(row[:-1]))
+            since = _feed_cursor(row[-1], row[0])
+        return {'comments': comments, 'since': since}
+
+
+def add_hours_batch(dbc, entries, batch_size=1000):
+    """
+    Add many time entries.  The whole batch is validated first; if any entry
+    is invalid nothing is added.  Otherwise the entries are inserted
+    ``batch_size`` at a time, each group with one multi-row insert and
+    committed together with its rollup changes.
+    :param dbc: A database connection.  This function will make and commit
+                transactions.
+    :param entries: Dictionaries with 'bug_id', 'user_id' and 'hours_worked'.
+    :param batch_size: The number of entries per transaction.
+    :return: A dictionary with the new hours 'ids', in entry order, and the
+             per-entry 'errors'.
+    :raise PartialLoad: If a group fails after earlier ones were committed.
+    """
+    rows, errors = _check_batch(dbc, entries, [('bug_id', _record_id),
+                                               ('user_id', _record_id),
+                                               ('hours_worked', _hours)])
+    if errors:
+        return {'ids': [], 'errors': errors}
+    return {'ids': _load_batches(dbc, rows, batch_size, _insert_hours),
+            'errors': []}
+
+
+def _insert_hours(cur, batch):
+    hours_ids = [hours_id for hours_id, in execute_values(cur, '''
+        INSERT INTO hours (bug_id, user_id, hours_worked)
+        VALUES %s
+        RETURNING hours_id
+    ''', batch, page_size=len(batch), fetch=True)]
+    bug_rollups.hours_added(cur, hours_ids)
+    bump_versions(cur, 'reports')
+    return hours_ids
 
 
-def get_bugs(dbc):
-    with dbc, dbc.cursor() as cur:
+def add_hours_worked(dbc, bid, uid, form):
+    result = add_hours_batch(dbc, [{'bug_id': bid, 'user_id': uid,
+                                    'hours_worked': form['hours_worked']}])
+    if result['errors']:
+        flask.abort(400)
+
+
+# Server-side filters accepted by get_bugs, mapped to their WHERE clauses.
+# The ID filters come from free-text inputs and are checked in
+# _bug_filter_clauses.
+BUG_FILTERS = {
+    'status': 'bug.status = %s',
+    'priority': 'bug.bug_priority = %s',
+    'milestone': 'bug.milestone_id = %s',
+    'assignee': 'bug.assignee = %s',
+    'tag': 'EXISTS (SELECT 1 FROM bug_tag'
+           ' WHERE bug_tag.bug_id = bug.bug_id AND bug_tag.tag = %s)',
+}
+
+
+# The columns of a Bug record, in order; the queries join bug to milestone.
+_BUG_COLUMNS = '''bug_id, bug_title, bug_details, creator, creation_date,
+                   assignee, assigned_date, tag_text, status, close_date,
+                   bug_priority, milestone_id, milestone_title, target_date,
+                   ARRAY(SELECT tag FROM bug_tag
+                         WHERE bug_tag.bug_id = bug.bug_id),
+                   bug.version, bug.comment_count'''
+
+
+def _bug_cursor(bug):
+    return '{},{}'.format(bug.creation_date.isoformat(), bug.bug_id)
+
+
+def _comment_cursor(comment):
+    return '{},{}'.format(comment.comment_date.isoformat(), comment.comment_id)
+
+
+def _parse_cursor(cursor):
+    # a (timestamp, id) keyset position, as made by _bug_cursor or
+    # _comment_cursor
+    try:
+        timestamp, row_id = cursor.rsplit(',', 1)
+        return datetime.datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        flask.abort(400)
+
+
+_ID_FILTERS = {'milestone', 'assignee'}
+
+
+def _bug_filter_clauses(filters):
+    clauses = []
+    params = []
+    for name, value in sorted((filters or {}).items()):
+        if name not in BUG_FILTERS:
+            raise ValueError('unknown bug filter: {}'.format(name))
+        if name == 'tag':
+            value = value.strip().lower()
+        elif name in _ID_FILTERS:
+            try:
+                value = int(value)
+            except ValueError:
+                flask.abort(400)
+        clauses.append(BUG_FILTERS[name])
+        params.append(value)
+    return clauses, params
+
+
+def get_bugs(dbc, limit=50, after=None, before=None, filters=None):
+    """
+    Get one page of bugs, newest first, using a keyset on
+    (creation_date, bug_id).
+    :param dbc: A database connection.  This function will take a transaction.
+    :param limit: The page size.
+    :param after: Cursor of the last bug on the previous page, to fetch the
+                  page following it.
+    :param before: Cursor of the first bug on the following page, to fetch the
+                   page preceding it.
+    :param filters: A dictionary of filters, keyed by the names in BUG_FILTERS.
+    :return: A dictionary with the page's 'bugs', as Bug records, and the
+             'next' and 'prev' cursors (None when there is no such page).
+    """
+    clauses, params = _bug_filter_clauses(filters)
+    if after is not None:
+        clauses.append('(bug.creation_date, bug.bug_id) < (%s, %s)')
+        params.extend(_parse_cursor(after))
+        order = 'DESC'
+    elif before is not None:
+        clauses.append('(bug.creation_date, bug.bug_id) > (%s, %s)')
+        params.extend(_parse_cursor(before))
+        order = 'ASC'
+    else:
+        order = 'DESC'
+    where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
 
-        #get all tags
+    with dbc, dbc.cursor() as cur:
+        # fetch one extra row to learn whether another page follows
         cur.execute('''
-            SELECT bug_id, tag
-            FROM bug JOIN bug_tag USING (bug_id)
-        ''')
-        tag_map = {}
-        for bid, tag in cur:
-            if bid in tag_map:
-                tag_map[bid].append(tag)
-            else:
-                tag_map[bid] = [tag]
-
-        #get all bugs
+            SELECT {columns}
+            FROM bug
+            JOIN milestone USING(milestone_id)
+            {where}
+            ORDER BY bug.creation_date {order}, bug.bug_id {order}
+            LIMIT %s
+        '''.format(columns=_BUG_COLUMNS, where=where, order=order),
+                    params + [limit + 1])
+
+        bugs = list(map(Bug._make, cur))
+        more = len(bugs) > limit
+        del bugs[limit:]
+        if before is not None:
+            bugs.reverse()
+
+    page = {'bugs': bugs, 'next': None, 'prev': None}
+    if bugs:
+        if before is not None:
+            page['next'] = _bug_cursor(bugs[-1])
+            if more:
+                page['prev'] = _bug_cursor(bugs[0])
+        else:
+            if more:
+                page['next'] = _bug_cursor(bugs[-1])
+            if after is not None:
+                page['prev'] = _bug_cursor(bugs[0])
+    return page
+
+
+def iter_bugs(dbc, filters=None, itersize=1000):
+    """
+    Iterate over every bug, newest first, without loading them all into
+    memory.  Rows come from a server-side cursor in batches of ``itersize``,
+    so the first bug is available as soon as the first batch arrives.
+    :param dbc: A database connection.  The generator holds a transaction
+                open until it is exhausted or closed.
+    :param filters: A dictionary of filters, keyed by the names in BUG_FILTERS.
+    :param itersize: The number of rows to fetch per round trip.
+    """
+    clauses, params = _bug_filter_clauses(filters)
+    where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+    with dbc, dbc.cursor(name='bug_stream') as cur:
+        cur.itersize = itersize
         cur.execute('''
-            SELECT bug_id, bug_title, bug_details, creator,creation_date,
-                   assignee, assigned_date, tag_text, status, close_date,
-                   bug_priority, milestone_title, target_date
+            SELECT {columns}
             FROM bug
             JOIN milestone USING(milestone_id)
-            ORDER BY creation_date DESC
-        ''')
+            {where}
+            ORDER BY bug.creation_date DESC, bug.bug_id DESC
+        '''.format(columns=_BUG_COLUMNS, where=where), params)
+        for row in cur:
+            yield Bug._make(row)
 
-        bugs = [{'bug_id': bug_id, 'bug_title': bug_title,
-                 'bug_details': bug_details, 'creator': creator,
-                 'creation_date': creation_date, 'assignee': assignee,
-                 'assigned_date': assigned_date, 'tag_text': tag_text,
-                 'status': status, 'close_date': close_date,
-                 'bug_priority': bug_priority,
-                 'milestone_title': milestone_title,
-                 'target_date': target_date, 'tags': tag_map.get(bug_id, [])}
-                for (bug_id, bug_title, bug_details, creator, creation_date,
-                     assignee, assigned_date, tag_text, status, close_date,
-                     bug_priority, milestone_title, target_date) in cur]
 
-        return bugs
+# Markers ts_headline puts around matched words; chosen so they survive
+# HTML escaping unchanged and can then be swapped for <mark> tags.
+_HIGHLIGHT_OPTIONS = 'StartSel=[[[, StopSel=]]], MaxFragments=2, MaxWords=30, MinWords=10'
 
 
-def get_bug(dbc, bid):
+def _highlight(snippet):
+    if snippet is None:
+        return None
+    return Markup(str(escape(snippet)).replace('[[[', '<mark>')
+                  .replace(']]]', '</mark>'))
+
+
+def search_bugs(dbc, query, filters=None, limit=20, offset=0):
+    """
+    Full-text search over bug titles, details and comments, best match first.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param query: The search text, in web search syntax ("quoted phrases",
+                  -excluded words, OR).
+    :param filters: A dictionary of filters, keyed by the names in BUG_FILTERS.
+    :param limit: The page size.
+    :param offset: The number of results to skip.
+    :return: A dictionary with the page's 'results' and whether there are
+             'more' after it.
+    """
+    clauses, params = _bug_filter_clauses(filters)
+    where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
     with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            WITH q AS (
+                SELECT websearch_to_tsquery('english', %s) AS query
+            ), matches AS (
+                SELECT bug_id, ts_rank(bug.search_vector, q.query) AS rank
+                FROM bug, q
+                WHERE bug.search_vector @@ q.query
+                UNION ALL
+                SELECT bug_id, ts_rank(comment.search_vector, q.query) * 0.5
+                FROM comment, q
+                WHERE comment.search_vector @@ q.query
+            ), page AS (
+                SELECT bug.bug_id, bug.bug_title, bug.bug_details, bug.status,
+                       milestone_title, ranked.rank
+                FROM (SELECT bug_id, MAX(rank) AS rank
+                      FROM matches GROUP BY bug_id) ranked
+                JOIN bug USING (bug_id)
+                JOIN milestone USING (milestone_id)
+                {where}
+                ORDER BY ranked.rank DESC, bug.bug_id DESC
+                LIMIT %s OFFSET %s
+            )
+            SELECT page.bug_id, bug_title, status, milestone_title,
+                   ts_headline('english',
+                               coalesce(bug_title, '') || ': ' ||
+                               coalesce(bug_details, ''),
+                               q.query, %s),
+                   (SELECT ts_headline('english', comment_text, q.query, %s)
+                    FROM comment
+                    WHERE comment.bug_id = page.bug_id
+                      AND comment.search_vector @@ q.query
+                    ORDER BY ts_rank(comment.search_vector, q.query) DESC
+                    LIMIT 1)
+            FROM page, q
+            ORDER BY page.rank DESC, page.bug_id DESC
+        '''.format(where=where),
+                    [query] + params + [limit + 1, offset,
+                                        _HIGHLIGHT_OPTIONS, _HIGHLIGHT_OPTIONS])
+        results = []
+        for (bug_id, bug_title, status, milestone_title,
+             snippet, comment_snippet) in cur:
+            results.append({'bug_id': bug_id, 'bug_title': bug_title,
+                            'status': status,
+                            'milestone_title': milestone_title,
+                            'snippet': _highlight(snippet),
+                            'comment_snippet': _highlight(comment_snippet)})
+    more = len(results) > limit
+    return {'results': results[:limit], 'more': more}
+
+
+_GET_BUG = bug_statements.statement('get_bug', '''
+    SELECT {columns}
+    FROM bug
+    JOIN milestone USING(milestone_id)
+    WHERE bug_id = %s
+'''.format(columns=_BUG_COLUMNS))
 
-        query ='''
-            SELECT bug_id, bug_title, bug_details, creator,creation_date,
-                   assignee, assigned_date, tag_text, status, close_date,
-                   bug_priority, milestone_id, milestone_title, target_date
-            FROM bug
-            JOIN milestone USING(milestone_id)
-            WHERE bug_id = %s'''
 
-        cur.execute(query, (bid,))
+def get_bug(dbc, bid):
+    with dbc, dbc.cursor() as cur:
+        _GET_BUG.execute(cur, (bid,))
 
         row = cur.fetchone()
         if row is None:
             return None
+        return Bug._make(row)
+
+
+_BUG_FIELDS = len(Bug._fields)
+
+_GET_BUG_DETAILS = bug_statements.statement('get_bug_details', '''
+    SELECT b.*, c.comment_id, c.comment_date,
+           c.comment_text, c.display_name
+    FROM (SELECT {columns}
+          FROM bug
+          JOIN milestone USING(milestone_id)
+          WHERE bug_id = %s) b
+    LEFT OUTER JOIN LATERAL (
+        SELECT comment_id, comment_date, comment_text, display_name
+        FROM comment
+        JOIN bug_user ON(comment.comment_author = bug_user.user_id)
+        WHERE comment.bug_id = b.bug_id
+        ORDER BY comment_date DESC, comment_id DESC
+        LIMIT %s) c ON TRUE
+    ORDER BY c.comment_date DESC, c.comment_id DESC
+'''.format(columns=_BUG_COLUMNS))
+
+
+def get_bug_details(dbc, bid, limit=50):
+    """
+    Get a bug together with the first page of its comments, newest first, in
+    one statement.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param bid: The bug ID.
+    :param limit: The comment page size.
+    :return: A (bug, page) pair, the page as returned by get_bug_comments;
+             the bug is None if it does not exist.
+    """
+    with dbc, dbc.cursor() as cur:
+        _GET_BUG_DETAILS.execute(cur, (bid, limit + 1))
 
-        (bug_id, bug_title, bug_details, creator, creation_date,
-            assignee, assigned_date, tag_text, status, close_date,
-            bug_priority, milestone_id, milestone_title, target_date) = row
-        bug = {'bug_id': bug_id, 'bug_title': bug_title,
-               'bug_details': bug_details, 'creator': creator,
-               'creation_date': creation_date, 'assignee': assignee,
-               'assigned_date': assigned_date, 'tag_text': tag_text,
-               'status': status, 'close_date': close_date,
-               'bug_priority': bug_priority,
-               'milestone_id': milestone_id,
-               'milestone_title': milestone_title,
-               'target_date': target_date, 'tags': []}
-
-        cur.execute('''
-            SELECT tag FROM bug_tag WHERE bug_id = %s
-        ''', (bid,))
-        for tag, in cur:
-            bug['tags'].append(tag)
-
-        return bug
+        rows = cur.fetchall()
+        if not rows:
+            return None, {'comments': [], 'next': None}
+        bug = Bug._make(rows[0][:_BUG_FIELDS])
+        bug_comments = [Comment._make(row[_BUG_FIELDS:] + (bid,))
+                        for row in rows if row[_BUG_FIELDS] is not None]
+        return bug, _comment_page(bug_comments, limit)
 
 def user_info(dbc, uid):
     with dbc,dbc.cursor() as cur:
@@ -374,16 +1011,11 @@ def update_user_info(dbc, uid, form):
 def get_report_info_1(dbc):
     with dbc, dbc.cursor() as cur:
         cur.execute('''
-            SELECT bug_id, bug_title, milestone_title, SUM(hours_worked)
-            FROM  milestone
-            LEFT OUTER JOIN  bug USING (milestone_id)
-            LEFT OUTER JOIN  hours USING(bug_id)
-            GROUP BY bug_id, bug_title, milestone_title
-            ORDER BY milestone_target_date''')
-
-        row = cur.fetchone()
-        if row is None:
-            return None
+            SELECT bug_id, bug_title, milestone_title, hours_worked
+            FROM milestone
+            LEFT OUTER JOIN rollup_bug_hours USING (milestone_id)
+            LEFT OUTER JOIN bug USING (bug_id)
+            ORDER BY target_date, milestone.milestone_id, bug_id''')
 
         reports = []
 
@@ -396,19 +1028,13 @@ def get_report_info_1(dbc):
 def get_report_info_2(dbc):
     with dbc, dbc.cursor() as cur:
         cur.execute('''
-            SELECT user_id, user_name, milestone_title, SUM(hours_worked)
-            FROM  milestone
-            LEFT OUTER JOIN  bug USING (milestone_id)
-            LEFT OUTER JOIN  hours USING(bug_id)
-            JOIN  bug_user USING(user_id)
-            GROUP BY user_id,user_name, milestone_title
-            ORDER BY milestone_target_date
+            SELECT user_id, user_name, milestone_title, hours_worked
+            FROM milestone
+            JOIN rollup_user_hours USING (milestone_id)
+            JOIN bug_user USING (user_id)
+            ORDER BY target_date, milestone_id, user_name
             ''')
 
-        row = cur.fetchone()
-        if row is None:
-            return None
-
         reports = []
 
         for (user_id, user_name, milestone_title, hours_worked) in cur:
@@ -420,37 +1046,17 @@ def get_report_info_2(dbc):
 def get_report_info_3(dbc):
     with dbc, dbc.cursor() as cur:
         cur.execute('''
-            SELECT milestone_title, target_date, COALESCE(Open,0) AS Open, COALESCE(Ready_for_Testing,0) AS
-            Ready_for_Testing, COALESCE(Testing,0) AS Testing, COALESCE(Ready_for_Deployment,0) AS Ready_for_Deployment
+            SELECT milestone_title, target_date,
+              COALESCE(SUM(bug_count) FILTER (WHERE status = 'Open'), 0),
+              COALESCE(SUM(bug_count) FILTER (WHERE status = 'Ready_for_Testing'), 0),
+              COALESCE(SUM(bug_count) FILTER (WHERE status = 'Testing'), 0),
+              COALESCE(SUM(bug_count) FILTER (WHERE status = 'Ready_for_Deployment'), 0)
             FROM milestone
-            LEFT OUTER JOIN (SELECT milestone_id,COUNT(*) AS Open
-            FROM bug
-            WHERE status = 'Open'
-            GROUP BY milestone_id)
-            USING (milestone_id)
-            LEFT OUTER JOIN (SELECT milestone_id,COUNT(*) AS Ready_for_Testing
-            FROM bug
-            WHERE status = 'Ready_for_Testing'
-            GROUP BY milestone_id)
-            USING (milestone_id)
-            LEFT OUTER JOIN (SELECT milestone_id,COUNT(*) AS Testing
-            FROM bug
-            WHERE status = 'Testing'
-            GROUP BY milestone_id)
-            USING (milestone_id)
-            LEFT OUTER JOIN (SELECT milestone_id,COUNT(*) AS Ready_for_Deployment
-            FROM bug
-            WHERE status = 'Ready_for_Deployment'
-            GROUP BY milestone_id)
-            USING (milestone_id)
-            ORDER BY milestone_id;
+            LEFT OUTER JOIN rollup_status_count USING (milestone_id)
+            GROUP BY milestone_id, milestone_title, target_date
+            ORDER BY milestone_id
             ''')
 
-        row = cur. fetchone()
-        if row is None:
-            return None
-
-
         reports = []
 
         for (milestone_title, target_date, Open, Ready_for_Testing, Testing, Ready_for_Deployment) in cur:
@@ -458,4 +1064,4 @@ def get_report_info_3(dbc):
                             'Ready_for_Testing': Ready_for_Testing, 'Testing': Testing,
                             'Ready_for_Deployment': Ready_for_Deployment})
 
-        return reports
\ No newline at end of file
+        return reports
@@ -0,0 +1,125 @@
+"""
+In-process caches shared by every request a worker serves.
+"""
+import collections
+import threading
+import time
+from bookmarky import bug_bookmarks
+from bookmarky.bug_dbutil import db_connect, get_version
+
+
+class RefCache(object):
+    """
+    A cache for small, rarely changing reference lists.
+
+    A cached list is served without touching the database for ``ttl`` seconds.
+    After that, its version stamp is read; only if another worker (or a
+    trigger) has bumped the stamp is the list itself reloaded.
+    """
+
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, app, name, loader):
+        """
+        Get a cached list, loading it if needed.
+        :param app: The Flask application.
+        :param name: The version stamp guarding the list.
+        :param loader: A function taking a database connection and returning
+                       a list of immutable records.
+        :return: A tuple of records.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and now - entry[2] < self.ttl:
+            return entry[1]
+
+        dbc = db_connect(app)
+        version = get_version(dbc, name)
+        if entry is not None and entry[0] == version:
+            value = entry[1]
+        else:
+            value = tuple(loader(dbc))
+        with self._lock:
+            self._entries[name] = (version, value, now)
+        return value
+
+    def invalidate(self, name=None):
+        """
+        Drop a cached list, or every list, from this worker's cache.
+        :param name: The list to drop; None drops all of them.
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+class LRUCache(object):
+    """
+    A small least-recently-used cache whose entries expire after ``ttl``
+    seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Look up a key.
+        :return: The cached value, or None if absent or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+ref_cache = RefCache()
+user_cache = LRUCache()
+
+
+def init_app(app):
+    ref_cache.ttl = app.config.get('REF_CACHE_TTL', ref_cache.ttl)
+    user_cache.maxsize = app.config.get('USER_CACHE_SIZE', user_cache.maxsize)
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', user_cache.ttl)
+
+
+def milestones(app):
+    """
+    Get the milestone list, cached.
+    :param app: The Flask application.
+    """
+    return ref_cache.get(app, 'milestones', bug_bookmarks.get_milestones)
+
+
+def developers(app):
+    """
+    Get the developer list, cached.
+    :param app: The Flask application.
+    """
+    return ref_cache.get(app, 'developers', bug_bookmarks.get_developers)
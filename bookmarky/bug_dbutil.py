@@ -1,31 +1,444 @@
 from contextlib import contextmanager
+import os
+import threading
+import time
+import flask
 import psycopg2
+import psycopg2.extensions
 
 
-def db_connect(app):
+class PoolTimeout(Exception):
     """
-    Create a database connection.
+    Raised when no pooled connection becomes available within the checkout timeout.
+    """
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    A connection that carries state across checkouts from the pool: how often
+    it has been checked out, and the names of the statements prepared on its
+    server session (see bug_statements).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PooledConnection, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.prepared = set()
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of database connections.
+
+    The first checkout in each process opens ``min_size`` connections, and
+    more are opened lazily up to ``max_size``; once that many are in use,
+    callers wait up to ``timeout`` seconds for one to be returned.  Connections
+    that have sat idle longer than ``validate_after`` seconds are checked with a
+    trivial query before being handed out, and dropped if they have gone stale.
+    """
+
+    def __init__(self, pg_args, min_size=1, max_size=10, timeout=5.0,
+                 validate_after=30.0, cursor_factory=None):
+        self.pg_args = pg_args
+        self.cursor_factory = cursor_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._lock = threading.Condition()
+        self._idle = []
+        self._in_use = 0
+        self._waiters = 0
+        self._opening = 0
+        self._filled_pid = None
+        self._pid = os.getpid()
+        self._inherited = []
+        self._stats = {'opened': 0, 'discarded': 0, 'checkouts': 0,
+                       'timeouts': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+
+    def _open(self):
+        cxn = psycopg2.connect(connection_factory=PooledConnection,
+                               cursor_factory=self.cursor_factory,
+                               **self.pg_args)
+        with self._lock:
+            self._stats['opened'] += 1
+        return cxn
+
+    def _is_alive(self, cxn, idle_since):
+        if cxn.closed:
+            return False
+        if time.monotonic() - idle_since < self.validate_after:
+            return True
+        try:
+            with cxn.cursor() as cur:
+                cur.execute('SELECT 1')
+            cxn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, cxn):
+        with self._lock:
+            self._stats['discarded'] += 1
+        try:
+            cxn.close()
+        except psycopg2.Error:
+            pass
+
+    def fill(self):
+        """
+        Open connections until the pool holds at least ``min_size``, never
+        more than ``max_size``.  Only the first call in each process does
+        anything: the slots are reserved under the lock before connecting, so
+        concurrent first checkouts cannot both fill.  In a forked child, the
+        connections inherited from the parent are dropped first.
+        """
+        with self._lock:
+            pid = os.getpid()
+            if self._filled_pid == pid:
+                return
+            if self._pid != pid:
+                # The idle connections are the parent's sessions: using one
+                # would interleave with the parent on its socket, and closing
+                # one (or letting it be garbage collected) would end the
+                # parent's session.  Keep them referenced, unused, and forget
+                # the parent's checkouts.
+                self._inherited.extend(cxn for cxn, _ in self._idle)
+                self._idle = []
+                self._in_use = 0
+                self._opening = 0
+                self._pid = pid
+            self._filled_pid = pid
+            wanted = max(0, min(self.min_size, self.max_size) - len(self._idle)
+                         - self._in_use - self._opening)
+            self._opening += wanted
+        try:
+            while wanted:
+                cxn = self._open()
+                with self._lock:
+                    wanted -= 1
+                    self._opening -= 1
+                    self._idle.append((cxn, time.monotonic()))
+                    self._lock.notify()
+        finally:
+            if wanted:
+                # give back the slots we could not open; a later checkout
+                # fills again
+                with self._lock:
+                    self._opening -= wanted
+                    self._filled_pid = None
+                    self._lock.notify_all()
+
+    def _reserve(self, deadline):
+        # Claim a slot in the pool, either an idle connection or the right to
+        # open a new one (returned as None).  Connecting and validating happen
+        # outside the lock so one slow handshake does not stall every caller.
+        with self._lock:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+                if self._in_use + self._opening < self.max_size:
+                    self._in_use += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('no database connection available '
+                                      'after {:.1f}s'.format(self.timeout))
+                self._waiters += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._waiters -= 1
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+            self._lock.notify()
+
+    def getconn(self):
+        """
+        Check a connection out of the pool.
+        :return: An open database connection.
+        :raises PoolTimeout: if no connection is available within the timeout.
+        """
+        # Fill lazily in each process: connections opened before a
+        # pre-forking server forks would be shared by its workers.
+        if self._filled_pid != os.getpid():
+            self.fill()
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            cxn, idle_since = self._reserve(deadline)
+            if cxn is None:
+                try:
+                    cxn = self._open()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._is_alive(cxn, idle_since):
+                self._discard(cxn)
+                self._release_slot()
+                continue
+            waited = time.monotonic() - start
+            cxn.checkouts += 1
+            with self._lock:
+                self._stats['checkouts'] += 1
+                self._stats['wait_time'] += waited
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'],
+                                                   waited)
+            return cxn
+
+    def putconn(self, cxn):
+        """
+        Return a connection to the pool.  Any open transaction is rolled back.
+        :param cxn: A connection obtained from :meth:`getconn`.
+        """
+        healthy = not cxn.closed
+        if healthy:
+            try:
+                status = cxn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    healthy = False
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    cxn.rollback()
+            except psycopg2.Error:
+                healthy = False
+        if not healthy:
+            self._discard(cxn)
+            self._release_slot()
+            return
+        with self._lock:
+            self._in_use -= 1
+            self._idle.append((cxn, time.monotonic()))
+            self._lock.notify()
+
+    def stats(self):
+        """
+        Get a snapshot of pool usage.
+        :return: A dictionary of pool counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'size': len(self._idle) + self._in_use,
+                          'idle': len(self._idle),
+                          'in_use': self._in_use,
+                          'waiters': self._waiters,
+                          'max_size': self.max_size})
+        return stats
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for cxn, _ in self._idle:
+                cxn.close()
+            self._idle = []
+
+
+# Session key holding the primary's WAL position after the user's last
+# write, and until when it may pin their reads to the primary.
+_PIN_KEY = 'db_primary_pin'
+
+
+def _make_pool(app, pg_args):
+    return ConnectionPool(pg_args,
+                          min_size=app.config.get('DB_POOL_MIN_SIZE', 1),
+                          max_size=app.config.get('DB_POOL_MAX_SIZE', 10),
+                          timeout=app.config.get('DB_POOL_TIMEOUT', 5.0),
+                          validate_after=app.config.get('DB_POOL_VALIDATE_AFTER', 30.0))
+
+
+def init_app(app):
+    """
+    Set up the connection pools for an application (the primary, and the
+    replica if PG_REPLICA_ARGS is set) and register the handlers that pin a
+    user's reads to the primary after they write and return each request's
+    connections to their pools.
     :param app: The Flask application.
-    :return: The database connection
     """
-    # Get the database connection from the configuration
-    cxn = psycopg2.connect(**app.config['PG_ARGS'])
+    pool = _make_pool(app, app.config['PG_ARGS'])
+    app.extensions['db_pool'] = pool
+    replica_args = app.config.get('PG_REPLICA_ARGS')
+    replica_pool = _make_pool(app, replica_args) if replica_args else None
+    if replica_pool is not None:
+        app.extensions['db_replica_pool'] = replica_pool
+
+    @app.after_request
+    def pin_to_primary(response):
+        # After a request that may have written, remember how far the
+        # primary's WAL had got, so the user's next reads wait for the
+        # replica to replay that far (see _use_replica).
+        cxn = flask.g.get('db_cxn')
+        if (replica_pool is None or cxn is None or
+                flask.request.method in ('GET', 'HEAD', 'OPTIONS')):
+            return response
+        try:
+            with cxn, cxn.cursor() as cur:
+                cur.execute('SELECT pg_current_wal_lsn()::text')
+                lsn = cur.fetchone()[0]
+        except psycopg2.Error as e:
+            app.logger.warning('cannot read WAL position: %s', e)
+            return response
+        flask.session[_PIN_KEY] = [
+            lsn, time.time() + app.config.get('REPLICA_PIN_SECONDS', 30.0)]
+        return response
+
+    @app.teardown_appcontext
+    def release_connections(exc):
+        release_connection(app)
+
+    return pool
+
+
+def _checkout(app, pool_name, attr):
+    cxn = flask.g.get(attr)
+    if cxn is None:
+        try:
+            cxn = app.extensions[pool_name].getconn()
+        except PoolTimeout as e:
+            app.logger.warning('%s', e)
+            flask.abort(503)
+        setattr(flask.g, attr, cxn)
+        stats = flask.g.get('sql_stats')
+        if stats is not None:
+            stats.connections += 1
+            if cxn.checkouts == 1:
+                stats.opened += 1
     return cxn
 
 
+def _use_replica(app):
+    # decided once per request, so every read in it sees the same database
+    use = flask.g.get('db_use_replica')
+    if use is not None:
+        return use
+    use = 'db_replica_pool' in app.extensions and flask.has_request_context()
+    pin = flask.session.get(_PIN_KEY) if use else None
+    if pin is not None:
+        lsn, until = pin
+        if time.time() < until:
+            cxn = _checkout(app, 'db_replica_pool', 'db_replica_cxn')
+            with cxn, cxn.cursor() as cur:
+                cur.execute('''
+                    SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn
+                ''', (lsn,))
+                use = bool(cur.fetchone()[0])
+        if use:
+            # the replica has caught up with the user's writes (or the pin
+            # has lapsed); no need to check again
+            flask.session.pop(_PIN_KEY, None)
+    flask.g.db_use_replica = use
+    return use
+
+
+def db_connect(app, readonly=False):
+    """
+    Get the database connection for the current request.  The first call in a
+    request checks a connection out of the pool; later calls reuse it, and it
+    is returned to the pool when the request ends.  Callers must not close it.
+    :param app: The Flask application.
+    :param readonly: The caller only reads.  Its connection then comes from
+                     the replica, if one is configured, unless the user has
+                     written within REPLICA_PIN_SECONDS and the replica has
+                     not yet replayed that write.
+    :return: The database connection
+    """
+    if readonly and _use_replica(app):
+        return _checkout(app, 'db_replica_pool', 'db_replica_cxn')
+    return _checkout(app, 'db_pool', 'db_cxn')
+
+
+def release_connection(app):
+    """
+    Return the request's connections to their pools before the request ends,
+    e.g. before a long wait that needs no database.  A later db_connect()
+    checks out a fresh connection.
+    :param app: The Flask application.
+    """
+    cxn = flask.g.pop('db_cxn', None)
+    if cxn is not None:
+        app.extensions['db_pool'].putconn(cxn)
+    cxn = flask.g.pop('db_replica_cxn', None)
+    if cxn is not None:
+        app.extensions['db_replica_pool'].putconn(cxn)
+
+
+def pool_stats(app, replica=False):
+    """
+    Get connection pool statistics.
+    :param app: The Flask application.
+    :param replica: Report on the replica pool instead of the primary's.
+    :return: A dictionary of pool counters, or None if there is no such pool.
+    """
+    pool = app.extensions.get('db_replica_pool' if replica else 'db_pool')
+    return pool.stats() if pool is not None else None
+
+
+def bump_versions(cur, *names):
+    """
+    Bump version stamps so every worker's cached copy is reloaded.
+    :param cur: A cursor in the caller's transaction.
+    :param names: The stamp names.
+    :return: A dictionary of the new version of each stamp.
+    """
+    cur.execute('''
+        INSERT INTO version_stamp (name, version)
+        SELECT unnest(%s::text[]), 1
+        ON CONFLICT (name) DO UPDATE
+        SET version = version_stamp.version + 1, modified_at = now()
+        RETURNING name, version
+    ''', (sorted(names),))
+    return dict(cur.fetchall())
+
+
+def get_version(dbc, name):
+    """
+    Read a version stamp.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param name: The stamp name.
+    :return: The current version (0 if the stamp has never been bumped).
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            SELECT version FROM version_stamp WHERE name = %s
+        ''', (name,))
+        row = cur.fetchone()
+        return row[0] if row is not None else 0
+
+
+def get_versions(dbc, names):
+    """
+    Read several version stamps in one query.
+    :param dbc: A database connection.  This function will take a transaction.
+    :param names: The stamp names.
+    :return: A dictionary mapping each stamp that has ever been bumped to its
+             (version, modified_at) pair.
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            SELECT name, version, modified_at FROM version_stamp
+            WHERE name = ANY(%s::text[])
+        ''', (list(names),))
+        return {name: (version, modified_at)
+                for name, version, modified_at in cur}
+
+
 @contextmanager
 def db_cursor(app):
     """
-    Create a database connection and cursor.  Does *not* manage transactions.
+    Get a cursor on the request's database connection.  Does *not* manage
+    transactions.
     :param app: The application.
-    :return: A database cursor that, when closed, also closes its connection.
+    :return: A database cursor; the connection stays checked out until the
+             request ends.
     """
     dbc = db_connect(app)
+    cur = dbc.cursor()
     try:
-        cur = dbc.cursor()
-        try:
-            yield cur
-        finally:
-            cur.close()
+        yield cur
     finally:
-        dbc.close()
+        cur.close()
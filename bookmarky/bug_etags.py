@@ -0,0 +1,94 @@
+"""
+HTTP conditional GET for pages built from version-stamped data.
+
+A view decorated with ``conditional`` names the version stamps its output
+depends on.  Before the view runs, those stamps are read with one query and
+hashed, together with the request URL, the logged-in user and the
+templates, into an ETag.  A client that already holds that ETag gets 304
+Not Modified and the view's queries and template are skipped entirely.
+"""
+import datetime
+import functools
+import hashlib
+import flask
+from bookmarky.bug_dbutil import db_connect, get_versions
+
+
+def init_app(app):
+    """
+    Fingerprint the application's templates, so a deploy that changes a
+    page's markup also changes its ETags.
+    :param app: The Flask application.
+    """
+    digest = hashlib.sha1(app.config.get('ETAG_SALT', '').encode('UTF-8'))
+    env = app.jinja_env
+    for name in sorted(env.list_templates()):
+        source, _, _ = env.loader.get_source(env, name)
+        digest.update(name.encode('UTF-8'))
+        digest.update(source.encode('UTF-8'))
+    app.extensions['etag_salt'] = digest.hexdigest()
+
+
+def _validators(app, names, versions):
+    user = flask.g.get('user')
+    digest = hashlib.sha1(app.extensions['etag_salt'].encode('UTF-8'))
+    digest.update(repr((sorted(user.items()) if user else None,
+                        flask.request.full_path,
+                        [(name, versions.get(name, (0, None))[0])
+                         for name in names])).encode('UTF-8'))
+    etag = digest.hexdigest()
+
+    # HTTP dates only have whole seconds, so a Last-Modified in the current
+    # second could be followed by another write that it would hide.  Stamps
+    # that have never been bumped have no date at all.
+    last_modified = None
+    if all(name in versions for name in names):
+        newest = max(modified_at for _, modified_at in versions.values())
+        newest = newest.replace(microsecond=0)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        if newest < now:
+            last_modified = newest
+    return etag, last_modified
+
+
+def conditional(stamps):
+    """
+    Decorate a view so that a GET answers 304 Not Modified when nothing it
+    shows has changed since the client's copy.
+    :param stamps: A function taking the view's arguments and returning the
+                   names of the version stamps the page depends on.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request = flask.request
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            app = flask.current_app
+            names = sorted(stamps(*args, **kwargs))
+            # The stamps are read before the view's own queries, so a write
+            # landing in between leaves the page newer than its ETag, never
+            # older; the client just downloads it once more.
+            versions = get_versions(db_connect(app, readonly=True), names)
+            etag, last_modified = _validators(app, names, versions)
+            if request.if_none_match:
+                fresh = request.if_none_match.contains(etag)
+            else:
+                fresh = (last_modified is not None and
+                         request.if_modified_since is not None and
+                         last_modified <= request.if_modified_since)
+            if fresh:
+                response = flask.Response(status=304)
+            else:
+                response = flask.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # browsers may keep the page, but must check back every time
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
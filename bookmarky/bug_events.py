@@ -0,0 +1,284 @@
+"""
+Live news feed updates over Server-Sent Events.
+
+add_comment (and the bulk comment load) and update_bug publish changes with
+NOTIFY on bug_bookmarks.EVENT_CHANNEL when they commit.  Each worker runs one
+listener thread, started with the first stream, which LISTENs on its own
+connection.  Only when a notification arrives, and only for the users with a
+stream open in this worker, does it look up who should see the change, by
+the same creator/assignee/subscription rules as the news feed, and queue
+the event to their streams.  The lookups run on a connection from the
+worker's pool, so the listening connection never runs a query.  Idle streams cost a queue and a heartbeat
+comment every EVENT_HEARTBEAT seconds, and no queries.
+
+Each stream's queue holds at most EVENT_QUEUE_SIZE events.  A client that
+falls that far behind, or that may have missed events while the listener
+was reconnecting, is sent a ``resync`` event and should reload its feed.
+
+Every open stream keeps a worker thread busy, so run the application under
+a threaded (or green-threaded) server; EVENT_MAX_STREAMS caps the streams a
+worker accepts.
+"""
+import collections
+import json
+import os
+import queue
+import select
+import threading
+import time
+import psycopg2
+from bookmarky import bug_bookmarks
+from bookmarky.bug_fragments import render_comment
+
+
+class Subscription(object):
+    """
+    One open event stream.
+    """
+
+    def __init__(self, uid, queue_size):
+        self.uid = uid
+        self.queue = queue.Queue(queue_size)
+        self.overflowed = False
+
+
+class EventHub(object):
+    """
+    The open streams in this worker, and the listener thread feeding them.
+    """
+
+    def __init__(self, queue_size=100, max_streams=100):
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscriptions = collections.defaultdict(set)
+        self._count = 0
+        self._listener = None
+        self._pid = None
+        self._stats = {'notifications': 0, 'events': 0, 'overflows': 0,
+                       'reconnects': 0}
+
+    def subscribe(self, app, uid):
+        """
+        Open a stream for a user, starting this worker's listener if needed.
+        :param app: The Flask application.
+        :param uid: The user ID.
+        :return: A Subscription, or None if the worker has no room for it.
+        """
+        with self._lock:
+            if self._count >= self.max_streams:
+                return None
+            # start the listener lazily in each process, like the hashing
+            # pool: a thread started before a pre-forking server forks would
+            # not exist in its workers
+            if self._listener is None or self._pid != os.getpid():
+                self._listener = Listener(self, app)
+                self._pid = os.getpid()
+                self._listener.start()
+            subscription = Subscription(uid, self.queue_size)
+            self._subscriptions[uid].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.uid)
+            if subscriptions is not None and subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self._count -= 1
+                if not subscriptions:
+                    del self._subscriptions[subscription.uid]
+
+    def connected(self):
+        """
+        Get the users with a stream open in this worker.
+        :return: A list of user IDs.
+        """
+        with self._lock:
+            return list(self._subscriptions)
+
+    def publish(self, uid, event, data):
+        """
+        Queue an event to every stream a user has open.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(uid, ()))
+            self._stats['events'] += len(subscriptions)
+        for subscription in subscriptions:
+            self._offer(subscription, (event, data))
+
+    def resync_all(self):
+        """
+        Tell every stream it may have missed events.
+        """
+        with self._lock:
+            subscriptions = [subscription
+                             for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+        for subscription in subscriptions:
+            self._offer(subscription, ('resync', {}))
+
+    def _offer(self, subscription, item):
+        try:
+            subscription.queue.put_nowait(item)
+        except queue.Full:
+            if not subscription.overflowed:
+                subscription.overflowed = True
+                with self._lock:
+                    self._stats['overflows'] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        """
+        Get a snapshot of stream counters.
+        :return: A dictionary of counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'streams': self._count,
+                          'users': len(self._subscriptions),
+                          'max_streams': self.max_streams})
+        return stats
+
+
+class Listener(threading.Thread):
+    """
+    LISTENs for bug events and fans them out to the hub's streams.
+    """
+
+    def __init__(self, hub, app):
+        super(Listener, self).__init__(name='bug-events', daemon=True)
+        self.hub = hub
+        self.app = app
+
+    def run(self):
+        backoff = 1.0
+        connected_once = False
+        while True:
+            try:
+                cxn = psycopg2.connect(**self.app.config['PG_ARGS'])
+            except psycopg2.Error as e:
+                self.app.logger.warning('event listener cannot connect: %s', e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            try:
+                cxn.autocommit = True
+                with cxn.cursor() as cur:
+                    cur.execute('LISTEN {}'.format(bug_bookmarks.EVENT_CHANNEL))
+                if connected_once:
+                    # events committed while we were away are lost
+                    self.hub.count('reconnects')
+                    self.hub.resync_all()
+                connected_once = True
+                self._listen(cxn)
+            except psycopg2.Error as e:
+                self.app.logger.warning('event listener lost its connection: '
+                                        '%s', e)
+            finally:
+                try:
+                    cxn.close()
+                except psycopg2.Error:
+                    pass
+
+    def _listen(self, cxn):
+        while True:
+            # a poll can pick up more than one batch; wait on the socket only
+            # once everything already read has been dispatched
+            if not cxn.notifies:
+                if select.select([cxn], [], [], 60.0) == ([], [], []):
+                    continue
+                cxn.poll()
+            notifies = list(cxn.notifies)
+            del cxn.notifies[:]
+            if notifies:
+                self.hub.count('notifications', len(notifies))
+                try:
+                    self._dispatch(notifies)
+                except Exception:
+                    self.app.logger.exception('cannot dispatch bug events')
+                    # these events are lost; have the streams reload
+                    self.hub.resync_all()
+
+    def _dispatch(self, notifies):
+        uids = self.hub.connected()
+        if not uids:
+            return
+        pool = self.app.extensions['db_pool']
+        dbc = pool.getconn()
+        try:
+            self._deliver(dbc, notifies, uids)
+        finally:
+            pool.putconn(dbc)
+
+    def _deliver(self, dbc, notifies, uids):
+        comment_ids = []
+        bug_events = []
+        for notify in notifies:
+            payload = json.loads(notify.payload)
+            if payload['type'] == 'comments':
+                comment_ids.extend(payload['ids'])
+            elif payload['type'] == 'bug':
+                bug_events.append(payload)
+
+        if comment_ids:
+            rendered = {}
+            deliveries = bug_bookmarks.get_feed_deliveries(dbc, comment_ids,
+                                                           uids)
+            with self.app.app_context():
+                for uid, comment in deliveries:
+                    data = rendered.get(comment.comment_id)
+                    if data is None:
+                        data = comment._asdict()
+                        data['comment_date'] = comment.comment_date.isoformat()
+                        data['html'] = str(render_comment(comment))
+                        rendered[comment.comment_id] = data
+                    self.hub.publish(uid, 'comment', data)
+
+        for event in bug_events:
+            watchers = bug_bookmarks.get_bug_watchers(dbc, event['bug_id'],
+                                                      uids)
+            # the previous assignee hears about being unassigned too
+            if event.get('old_assignee') in uids:
+                watchers.add(event['old_assignee'])
+            for uid in watchers:
+                self.hub.publish(uid, 'bug', event)
+
+
+def stream(subscription, heartbeat=15.0):
+    """
+    Generate a stream's Server-Sent Events, ending the subscription when the
+    client goes away.  A generator that is never started cannot clean up, so
+    the caller must also unsubscribe when the response is closed.
+    :param subscription: A Subscription from EventHub.subscribe.
+    :param heartbeat: Seconds of quiet after which a comment line is sent, so
+                      proxies and the client know the stream is alive.
+    """
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            if subscription.overflowed:
+                yield 'event: resync\ndata: {}\n\n'
+                return
+            try:
+                event, data = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+            if event == 'resync':
+                return
+    finally:
+        hub.unsubscribe(subscription)
+
+
+hub = EventHub()
+
+
+def init_app(app):
+    hub.queue_size = app.config.get('EVENT_QUEUE_SIZE', hub.queue_size)
+    hub.max_streams = app.config.get('EVENT_MAX_STREAMS', hub.max_streams)
@@ -0,0 +1,235 @@
+"""
+A cache of rendered bug and comment fragments.
+
+Pages render each bug and comment through the ``render_bug`` and
+``render_comment`` template globals rather than calling the display macros
+directly.  Each fragment is keyed by everything it shows that can change:
+a bug by its ID, its version (bumped by every update) and its milestone, a
+comment by its ID and its author's name.  A changed bug therefore gets a new
+key, and the old fragment simply ages out of the cache.
+
+Fragments are kept per worker in an LRU bounded by FRAGMENT_CACHE_BYTES.
+If FRAGMENT_CACHE_DIR is set, they are also written there, one file per
+fragment, so every worker on the machine shares what any of them rendered.
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import flask
+from markupsafe import Markup
+
+
+class FragmentCache(object):
+    """
+    A thread-safe LRU of rendered HTML, bounded by the total length of the
+    fragments it holds.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0,
+                       'evictions': 0}
+
+    def get(self, key):
+        """
+        Look up a fragment, in this worker and then in the shared store.
+        :param key: The fragment key, a string.
+        :return: The HTML, or None if it has not been rendered.
+        """
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return html
+        if self.store is not None:
+            html = self.store.get(key)
+            if html is not None:
+                self._put_local(key, html)
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                return html
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key, html):
+        """
+        Cache a rendered fragment.
+        :param key: The fragment key, a string.
+        :param html: The rendered HTML.
+        """
+        self._put_local(key, html)
+        if self.store is not None:
+            self.store.put(key, html)
+
+    def _put_local(self, key, html):
+        size = len(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = html
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Drop every fragment held by this worker.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Get a snapshot of cache usage.
+        :return: A dictionary of cache counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'entries': len(self._entries), 'bytes': self._bytes,
+                          'max_bytes': self.max_bytes})
+        return stats
+
+
+class FileFragmentStore(object):
+    """
+    Fragments shared between processes as files in a directory.  Files are
+    written to a temporary name and renamed into place, so readers never see
+    a partial fragment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path,
+                            hashlib.sha1(key.encode('UTF-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._file(key), encoding='UTF-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, html):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+                f.write(html)
+            os.replace(tmp, self._file(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def prune(self, max_age):
+        """
+        Delete fragments not written for ``max_age`` seconds.  Fragments of
+        bugs that have since changed are never read again, so this is what
+        bounds the directory.
+        :param max_age: The age in seconds.
+        :return: The number of files deleted.
+        """
+        cutoff = time.time() - max_age
+        deleted = 0
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+
+fragment_cache = FragmentCache()
+
+
+BUG_TEMPLATE = 'bug_display_widget.html'
+COMMENT_TEMPLATE = 'bug_comment_display_widget.html'
+
+
+def bug_key(bug):
+    return 'bug:{}:{}:{}:{}'.format(bug.bug_id, bug.version,
+                                    bug.milestone_title, bug.target_date)
+
+
+def comment_key(comment):
+    return 'comment:{}:{}'.format(comment.comment_id, comment.display_name)
+
+
+def _template_fingerprint(app, names):
+    # part of every key, so fragments left in the shared store by an older
+    # deploy are never served with newer markup
+    env = app.jinja_env
+    digest = hashlib.sha1()
+    for name in names:
+        source, _, _ = env.loader.get_source(env, name)
+        digest.update(source.encode('UTF-8'))
+    return digest.hexdigest()[:12]
+
+
+def _cached(key, template, macro, item):
+    app = flask.current_app
+    key = '{}:{}'.format(app.extensions['fragment_fingerprint'], key)
+    html = fragment_cache.get(key)
+    if html is None:
+        module = app.jinja_env.get_template(template).module
+        html = str(getattr(module, macro)(item))
+        fragment_cache.put(key, html)
+    return Markup(html)
+
+
+def render_bug(bug):
+    """
+    Render a bug with the display_bug macro, or reuse the cached rendering.
+    :param bug: A Bug record.
+    :return: The HTML, as Markup.
+    """
+    return _cached(bug_key(bug), BUG_TEMPLATE, 'display_bug', bug)
+
+
+def render_comment(comment):
+    """
+    Render a comment with the display_bug_comment macro, or reuse the cached
+    rendering.
+    :param comment: A Comment record.
+    :return: The HTML, as Markup.
+    """
+    return _cached(comment_key(comment), COMMENT_TEMPLATE,
+                   'display_bug_comment', comment)
+
+
+def init_app(app):
+    """
+    Configure the fragment cache and register the template globals that
+    render through it.
+    :param app: The Flask application.
+    """
+    fragment_cache.max_bytes = app.config.get('FRAGMENT_CACHE_BYTES',
+                                              16 * 1024 * 1024)
+    path = app.config.get('FRAGMENT_CACHE_DIR')
+    fragment_cache.store = FileFragmentStore(path) if path else None
+    fragment_cache.clear()
+    app.extensions['fragment_fingerprint'] = _template_fingerprint(
+        app, [BUG_TEMPLATE, COMMENT_TEMPLATE])
+    app.add_template_global(render_bug)
+    app.add_template_global(render_comment)
@@ -0,0 +1,259 @@
+"""
+Per-request SQL instrumentation and Prometheus-format metrics.
+
+Every pooled connection hands out InstrumentedCursor objects, which time
+each statement and count the rows it returns into the current request's
+RequestStats.  When the request ends, slow statements and statements
+repeated many times (the N+1 pattern) are logged, and the request's totals
+are added to per-route histograms served by /debug/metrics.
+"""
+import collections
+import re
+import threading
+import time
+import flask
+import psycopg2.extensions
+from bookmarky.bug_dbutil import pool_stats
+from bookmarky.bug_events import hub
+from bookmarky.bug_fragments import fragment_cache
+from bookmarky.bug_passwords import hash_pool
+from bookmarky.bug_reports import runner
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+
+
+def normalize_sql(query):
+    """
+    Reduce a statement to a canonical form for grouping: whitespace is
+    collapsed and literal values are replaced by '?'.
+    :param query: The SQL text, as a string or bytes.
+    :return: The normalized text.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('UTF-8', 'replace')
+    query = _STRING_LITERAL.sub('?', query)
+    query = _NUMBER_LITERAL.sub('?', query)
+    return ' '.join(query.split())
+
+
+class RequestStats(object):
+    """
+    SQL counters for one request.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.connections = 0
+        self.opened = 0
+        self.statements = collections.Counter()
+        self.slow = []
+
+    def record(self, query, elapsed, rows, slow_after):
+        normalized = normalize_sql(query)
+        self.queries += 1
+        self.sql_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.rows += max(rows, 0)
+        self.statements[normalized] += 1
+        if elapsed >= slow_after:
+            self.slow.append((elapsed, normalized))
+
+
+def _record(query, elapsed, rows):
+    if not flask.has_app_context():
+        return
+    stats = flask.g.get('sql_stats')
+    if stats is not None:
+        stats.record(query, elapsed, rows,
+                     flask.current_app.config.get('SQL_SLOW_QUERY_MS', 100) / 1000)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    A cursor that reports statement timings and row counts to the current
+    request.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.monotonic()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            # a server-side cursor's rows are counted as they are fetched
+            rows = self.rowcount if self.name is None else 0
+            _record(query, time.monotonic() - start, rows)
+
+    def close(self):
+        if self.name is not None and not self.closed:
+            stats = flask.g.get('sql_stats') if flask.has_app_context() else None
+            if stats is not None:
+                stats.rows += max(self.rowcount, 0)
+        return super(InstrumentedCursor, self).close()
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_HISTOGRAMS = [
+    ('bugtracker_request_duration_seconds', 'Request wall time.', TIME_BUCKETS),
+    ('bugtracker_request_sql_seconds', 'Time spent in SQL per request.',
+     TIME_BUCKETS),
+    ('bugtracker_request_queries', 'SQL statements per request.',
+     QUERY_BUCKETS),
+]
+_COUNTERS = [
+    ('bugtracker_sql_rows_total', 'Rows returned by SQL statements.'),
+    ('bugtracker_db_connections_opened_total',
+     'Database connections opened while serving requests.'),
+    ('bugtracker_sql_slow_queries_total', 'Statements slower than the threshold.'),
+    ('bugtracker_sql_repeated_statements_total',
+     'Statements repeated within a request at least the N+1 threshold.'),
+]
+
+
+class Registry(object):
+    """
+    Per-route request metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(dict)
+        self._counters = collections.defaultdict(collections.Counter)
+
+    def observe(self, route, duration, stats, repeated):
+        with self._lock:
+            for (name, _, buckets), value in zip(
+                    _HISTOGRAMS, (duration, stats.sql_time, stats.queries)):
+                hist = self._histograms[name].get(route)
+                if hist is None:
+                    hist = self._histograms[name][route] = Histogram(buckets)
+                hist.observe(value)
+            for (name, _), value in zip(
+                    _COUNTERS, (stats.rows, stats.opened, len(stats.slow),
+                                repeated)):
+                self._counters[name][route] += value
+
+    def render(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, help_text, _ in _HISTOGRAMS:
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} histogram'.format(name))
+                for route, hist in sorted(self._histograms[name].items()):
+                    label = 'route="{}"'.format(_escape(route))
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                            name, label, bound, count))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                        name, label, hist.count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label, hist.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, label,
+                                                            hist.count))
+            for name, help_text in _COUNTERS:
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} counter'.format(name))
+                for route, value in sorted(self._counters[name].items()):
+                    lines.append('{}{{route="{}"}} {}'.format(
+                        name, _escape(route), value))
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _gauges(prefix, stats, help_text):
+    lines = []
+    for key, value in sorted(stats.items()):
+        name = '{}_{}'.format(prefix, key)
+        lines.append('# HELP {} {} {}'.format(name, help_text, key))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+    return lines
+
+
+registry = Registry()
+
+
+def init_app(app):
+    """
+    Instrument an application's pooled connections and register the hooks
+    that collect per-request SQL statistics.
+    :param app: The Flask application.
+    """
+    for name in ('db_pool', 'db_replica_pool'):
+        if name in app.extensions:
+            app.extensions[name].cursor_factory = InstrumentedCursor
+
+    @app.before_request
+    def start_sql_stats():
+        flask.g.sql_stats = RequestStats()
+
+    @app.teardown_request
+    def finish_sql_stats(exc):
+        stats = flask.g.pop('sql_stats', None)
+        if stats is None:
+            return
+        rule = flask.request.url_rule
+        route = rule.rule if rule is not None else '<unmatched>'
+        duration = time.monotonic() - stats.start
+        for elapsed, query in stats.slow:
+            app.logger.warning('slow query on %s (%.1f ms): %s', route,
+                               elapsed * 1000, query)
+        threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 5)
+        repeated = 0
+        for query, count in stats.statements.items():
+            if count >= threshold:
+                repeated += 1
+                app.logger.warning('possible N+1 on %s: statement ran %d '
+                                   'times: %s', route, count, query)
+        registry.observe(route, duration, stats, repeated)
+
+
+def render(app):
+    """
+    Render all metrics, including pool gauges, in Prometheus text format.
+    :param app: The Flask application.
+    :return: The metrics document.
+    """
+    lines = registry.render()
+    lines.extend(_gauges('bugtracker_db_pool', pool_stats(app),
+                         'Database connection pool'))
+    replica = pool_stats(app, replica=True)
+    if replica is not None:
+        lines.extend(_gauges('bugtracker_db_replica_pool', replica,
+                             'Replica database connection pool'))
+    lines.extend(_gauges('bugtracker_auth_pool', hash_pool.stats(),
+                         'Password hashing pool'))
+    lines.extend(_gauges('bugtracker_fragment_cache', fragment_cache.stats(),
+                         'Rendered fragment cache'))
+    lines.extend(_gauges('bugtracker_event_streams', hub.stats(),
+                         'Live news feed streams'))
+    lines.extend(_gauges('bugtracker_report_runner', runner.stats(),
+                         'Background report runner'))
+    return '\n'.join(lines) + '\n'
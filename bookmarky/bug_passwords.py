@@ -0,0 +1,141 @@
+"""
+Password hashing on a bounded pool of worker processes.
+
+bcrypt is deliberately slow, so hashing in the request worker lets a burst
+of logins pin every worker and starve unrelated pages.  Hashes are computed
+in a separate process pool instead; when the pool and its queue are full,
+AuthBusy is raised so the view can answer 503 rather than pile up requests.
+"""
+import concurrent.futures
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+import bcrypt
+
+
+# Hashing processes are started from a clean server process, not forked from a
+# request worker with its threads, locks and database sockets.
+_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+    else 'spawn')
+
+
+class AuthBusy(Exception):
+    """
+    Raised when the hashing pool cannot take on more work.
+    """
+    pass
+
+
+def _hash(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+
+def _hash_new(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+class HashPool(object):
+    """
+    A process pool for bcrypt, admitting at most ``workers + queue_limit``
+    jobs at a time.
+    """
+
+    def __init__(self, workers=2, queue_limit=8, timeout=10.0, rounds=12):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.rounds = rounds
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._stats = {'jobs': 0, 'rejected': 0, 'timeouts': 0,
+                       'total_time': 0.0, 'max_time': 0.0}
+
+    def configure(self, workers, queue_limit, timeout, rounds):
+        with self._lock:
+            self.workers = workers
+            self.queue_limit = queue_limit
+            self.timeout = timeout
+            self.rounds = rounds
+            self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def _get_executor(self):
+        # Create the pool lazily in each process: a pool started before a
+        # pre-forking server forks its workers would be shared between them.
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=_MP_CONTEXT)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise AuthBusy()
+        start = time.monotonic()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        # free the slot when the job really finishes, even if we stop waiting
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise AuthBusy()
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._stats['jobs'] += 1
+                self._stats['total_time'] += elapsed
+                self._stats['max_time'] = max(self._stats['max_time'], elapsed)
+
+    def hash_password(self, password):
+        """
+        Hash a new password with a fresh salt.
+        :param password: The password (unhashed).
+        :return: The hash, as a string.
+        """
+        hashed = self._run(_hash_new, password.encode('UTF-8'), self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check_password(self, password, pw_hash):
+        """
+        Check a password against a stored hash.
+        :param password: The password (unhashed).
+        :param pw_hash: The stored hash.
+        :return: True if the password matches.
+        """
+        pw_hash = pw_hash.encode('UTF-8')
+        hashed = self._run(_hash, password.encode('UTF-8'), pw_hash)
+        return hmac.compare_digest(hashed, pw_hash)
+
+    def stats(self):
+        """
+        Get hashing pool counters.
+        :return: A dictionary of counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({'workers': self.workers, 'queue_limit': self.queue_limit})
+        return stats
+
+
+hash_pool = HashPool()
+
+
+def init_app(app):
+    hash_pool.configure(app.config.get('AUTH_POOL_WORKERS', 2),
+                        app.config.get('AUTH_POOL_QUEUE_LIMIT', 8),
+                        app.config.get('AUTH_POOL_TIMEOUT', 10.0),
+                        app.config.get('BCRYPT_ROUNDS', 12))
@@ -0,0 +1,191 @@
+"""
+Opt-in profiling of individual requests.
+
+A request is profiled when a Manager asks for it with an ``X-Profile: 1``
+header or a ``profile=1`` query parameter, or at random with probability
+PROFILE_SAMPLE_RATE.  The whole request is profiled, including template
+rendering and any streamed response, and the result is written to
+PROFILE_DIR as ``<route>.<ms>ms.<timestamp>.<pid>.<ext>``:
+
+* PROFILE_MODE = 'sample' runs a stack sampler every PROFILE_INTERVAL
+  seconds and writes collapsed stacks (``.folded``), ready for
+  flamegraph.pl or speedscope;
+* PROFILE_MODE = 'cprofile' runs cProfile and writes ``.pstats``.  Only one
+  cProfile can run at a time (Python 3.12 refuses a second), so a request
+  that arrives while another is being profiled is served unprofiled.
+
+Profiles for the same route can be merged with::
+
+    python -m bookmarky.bug_profile merge PROFILE_DIR -o OUTPUT_DIR
+"""
+import argparse
+import collections
+import cProfile
+import glob
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import flask
+
+# held while a request is under cProfile
+_cprofile_lock = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples one thread's Python stack at a fixed interval.
+    """
+
+    def __init__(self, thread_id, interval):
+        super(StackSampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                module = frame.f_globals.get('__name__') or \
+                    frame.f_code.co_filename
+                stack.append('{}:{}'.format(module, frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _route_slug(rule):
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+def _wanted(app):
+    if random.random() < app.config.get('PROFILE_SAMPLE_RATE', 0.0):
+        return True
+    user = flask.g.get('user')
+    if user is None or user.get('role') != 'Manager':
+        return False
+    return (flask.request.headers.get('X-Profile') == '1' or
+            flask.request.args.get('profile') == '1')
+
+
+def init_app(app):
+    """
+    Register the profiling hooks.  Must be called after the hook that loads
+    flask.g.user, since only Managers may ask for a profile.
+    :param app: The Flask application.
+    """
+
+    @app.before_request
+    def start_profile():
+        if not app.config.get('PROFILE_DIR') or not _wanted(app):
+            return
+        if app.config.get('PROFILE_MODE', 'sample') == 'cprofile':
+            if not _cprofile_lock.acquire(blocking=False):
+                return
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler (a debugger, say) is already active
+                _cprofile_lock.release()
+                return
+        else:
+            profiler = StackSampler(threading.get_ident(),
+                                    app.config.get('PROFILE_INTERVAL', 0.005))
+            profiler.start()
+        flask.g.profile = (profiler, time.monotonic())
+
+    @app.teardown_request
+    def finish_profile(exc):
+        profile = flask.g.pop('profile', None)
+        if profile is None:
+            return
+        profiler, start = profile
+        elapsed = time.monotonic() - start
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            _cprofile_lock.release()
+        else:
+            profiler.stop()
+        rule = flask.request.url_rule
+        route = _route_slug(rule.rule if rule is not None else 'unmatched')
+        base = os.path.join(app.config['PROFILE_DIR'], '{}.{}ms.{}.{}'.format(
+            route, int(elapsed * 1000), int(time.time() * 1000), os.getpid()))
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(base + '.pstats')
+        else:
+            with open(base + '.folded', 'w') as f:
+                for stack, count in sorted(profiler.stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+        app.logger.info('profiled %s in %.1f ms: %s', route, elapsed * 1000,
+                        base)
+
+
+def merge(profile_dir, output_dir):
+    """
+    Merge the profiles in a directory per route.  Collapsed stacks are summed
+    into ``<route>.folded``; cProfile output is combined into
+    ``<route>.pstats``.
+    :param profile_dir: The directory the profiles were written to.
+    :param output_dir: The directory to write merged profiles to.
+    :return: The list of files written.
+    """
+    by_route = collections.defaultdict(lambda: collections.defaultdict(list))
+    for path in glob.glob(os.path.join(profile_dir, '*.*ms.*.*.*')):
+        name = os.path.basename(path)
+        route, ext = name.split('.', 1)[0], name.rsplit('.', 1)[1]
+        by_route[route][ext].append(path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for route, files in sorted(by_route.items()):
+        if files.get('folded'):
+            stacks = collections.Counter()
+            for path in files['folded']:
+                with open(path) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        stacks[stack] += int(count)
+            out = os.path.join(output_dir, route + '.folded')
+            with open(out, 'w') as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            written.append(out)
+        if files.get('pstats'):
+            out = os.path.join(output_dir, route + '.pstats')
+            pstats.Stats(*files['pstats']).dump_stats(out)
+            written.append(out)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bookmarky.bug_profile',
+        description='Merge request profiles per route.')
+    commands = parser.add_subparsers(dest='command')
+    merge_cmd = commands.add_parser('merge', help='merge profiles per route')
+    merge_cmd.add_argument('profile_dir')
+    merge_cmd.add_argument('-o', '--output', default='merged',
+                           help='output directory (default: merged)')
+    args = parser.parse_args(argv)
+    if args.command != 'merge':
+        parser.print_help()
+        return 2
+    for path in merge(args.profile_dir, args.output):
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,25 @@
+"""
+Row records returned by the fetch functions in bug_bookmarks.
+
+Each record is a named tuple whose fields are the columns of the query that
+builds it, in order, so a cursor's rows become records with ``map(Bug._make,
+cur)`` and no per-row dictionary.  Records are immutable, share their field
+names through the class, and support attribute access, so templates use
+them exactly as they used the dictionaries (``bug.bug_title``).  Use
+``record._asdict()`` where a real dictionary is needed, e.g. for JSON.
+"""
+import collections
+
+Bug = collections.namedtuple('Bug', [
+    'bug_id', 'bug_title', 'bug_details', 'creator', 'creation_date',
+    'assignee', 'assigned_date', 'tag_text', 'status', 'close_date',
+    'bug_priority', 'milestone_id', 'milestone_title', 'target_date', 'tags',
+    'version', 'comment_count'])
+
+Comment = collections.namedtuple('Comment', [
+    'comment_id', 'comment_date', 'comment_text', 'display_name', 'bug_id'])
+
+Milestone = collections.namedtuple('Milestone', [
+    'milestone_id', 'milestone_title', 'target_date'])
+
+Developer = collections.namedtuple('Developer', ['user_id', 'display_name'])
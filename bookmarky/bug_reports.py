@@ -0,0 +1,206 @@
+"""
+Reports computed in the background and served from their last result.
+
+The report queries are too slow to run inside a request, so /reports/<rid>
+shows the result last stored in report_result, with the time it was
+generated.  Each result records the versions of the stamps its data depends
+on (SOURCES); once any of them has been bumped since, the result is stale,
+and the page queues a refresh on this worker's runner while still showing
+it.  A report seen for the first time has no result, and its page asks the
+client to come back shortly.
+
+A refresh takes a session advisory lock on the report, so however many
+workers (or ``flask refresh-reports`` runs) ask for it at once, only one
+computes it.  Under the lock it checks again that the stored result is
+stale, so a refresh queued just before another one finished does nothing.
+Storing a result bumps ``report:<rid>``, which changes the page's ETag.
+
+Results are stored as JSON, so dates and decimals come back as the strings
+they would have been rendered as.
+"""
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import psycopg2
+from bookmarky import bug_bookmarks
+from bookmarky.bug_dbutil import bump_versions, get_versions
+
+REPORTS = {1: bug_bookmarks.get_report_info_1,
+           2: bug_bookmarks.get_report_info_2,
+           3: bug_bookmarks.get_report_info_3}
+
+# The stamps bumped by every change the reports show.
+SOURCES = ('reports', 'developers', 'milestones')
+
+# Arbitrary first key of the per-report advisory locks.
+_LOCK_KEY = 4333
+
+
+def report_stamp(rid):
+    return 'report:{}'.format(rid)
+
+
+def _is_stale(sources, versions):
+    return any(versions.get(name, (0, None))[0] > sources.get(name, 0)
+               for name in SOURCES)
+
+
+def get_result(dbc, rid):
+    """
+    Get the stored result of a report.
+    :param dbc: A database connection.  This function will take transactions.
+    :param rid: The report ID.
+    :return: A dictionary with the result's rows, its generated_at time and
+             whether it is stale, or None if the report has never been
+             computed.
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            SELECT result, sources, generated_at FROM report_result
+            WHERE report_id = %s
+        ''', (rid,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    rows, sources, generated_at = row
+    return {'rows': rows, 'generated_at': generated_at,
+            'stale': _is_stale(sources, get_versions(dbc, SOURCES))}
+
+
+def compute(dbc, rid, force=False):
+    """
+    Compute a report and store its result, unless it is already being
+    computed elsewhere or (without ``force``) the stored result is current.
+    :param dbc: A connection to the primary.  This function will make and
+                commit transactions, and holds an advisory lock on the
+                connection while it works.
+    :param rid: The report ID.
+    :param force: Recompute even if the stored result is current.
+    :return: True if the report was computed.
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('SELECT pg_try_advisory_lock(%s, %s)', (_LOCK_KEY, rid))
+        if not cur.fetchone()[0]:
+            return False
+    try:
+        # Read the stamps before the report, so a write landing in between
+        # leaves the result newer than its sources, never older.
+        versions = get_versions(dbc, SOURCES)
+        if not force:
+            with dbc, dbc.cursor() as cur:
+                cur.execute('''
+                    SELECT sources FROM report_result WHERE report_id = %s
+                ''', (rid,))
+                row = cur.fetchone()
+            if row is not None and not _is_stale(row[0], versions):
+                return False
+        start = time.monotonic()
+        rows = REPORTS[rid](dbc)
+        duration = time.monotonic() - start
+        sources = {name: versions.get(name, (0, None))[0] for name in SOURCES}
+        with dbc, dbc.cursor() as cur:
+            cur.execute('''
+                INSERT INTO report_result
+                    (report_id, result, sources, generated_at, duration)
+                VALUES (%s, %s, %s, now(), %s)
+                ON CONFLICT (report_id) DO UPDATE
+                SET result = excluded.result, sources = excluded.sources,
+                    generated_at = excluded.generated_at,
+                    duration = excluded.duration
+            ''', (rid, json.dumps(rows, default=str), json.dumps(sources),
+                  duration))
+            bump_versions(cur, report_stamp(rid))
+        return True
+    finally:
+        with dbc, dbc.cursor() as cur:
+            cur.execute('SELECT pg_advisory_unlock(%s, %s)', (_LOCK_KEY, rid))
+
+
+class ReportRunner(object):
+    """
+    A thread pool refreshing reports in the background.  The work happens in
+    Postgres, so threads waiting on it do not hold up the request threads.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stats = {'queued': 0, 'computed': 0, 'skipped': 0,
+                       'failed': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+    def _get_executor(self):
+        # Create the pool lazily in each process, like the hashing pool:
+        # threads started before a pre-forking server forks would not exist
+        # in its workers.
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='reports')
+                self._pid = os.getpid()
+                self._running.clear()
+            return self._executor
+
+    def refresh(self, app, rid):
+        """
+        Queue a report to be recomputed, unless this worker already has.
+        :param app: The Flask application.
+        :param rid: The report ID.
+        :return: True if a refresh was queued.
+        """
+        executor = self._get_executor()
+        with self._lock:
+            if rid in self._running:
+                return False
+            self._running.add(rid)
+            self._stats['queued'] += 1
+        try:
+            executor.submit(self._run, app, rid)
+        except Exception:
+            with self._lock:
+                self._running.discard(rid)
+            raise
+        return True
+
+    def _run(self, app, rid):
+        start = time.monotonic()
+        outcome = 'failed'
+        try:
+            cxn = psycopg2.connect(**app.config['PG_ARGS'])
+            try:
+                outcome = 'computed' if compute(cxn, rid) else 'skipped'
+            finally:
+                cxn.close()
+        except Exception:
+            app.logger.exception('cannot compute report %s', rid)
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._running.discard(rid)
+                self._stats[outcome] += 1
+                if outcome == 'computed':
+                    self._stats['total_time'] += elapsed
+                    self._stats['max_time'] = max(self._stats['max_time'],
+                                                  elapsed)
+
+    def stats(self):
+        """
+        Get report runner counters.
+        :return: A dictionary of counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'running': len(self._running),
+                          'workers': self.workers})
+        return stats
+
+
+runner = ReportRunner()
+
+
+def init_app(app):
+    runner.workers = app.config.get('REPORT_WORKERS', runner.workers)
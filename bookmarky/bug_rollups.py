@@ -0,0 +1,165 @@
+"""
+Incremental maintenance of the report rollup tables.
+
+Every function takes a cursor and runs inside the caller's transaction, so a
+rollup change commits or rolls back together with the write it reflects.
+"""
+from bookmarky.bug_dbutil import bump_versions
+
+
+def bug_created(cur, bid):
+    """
+    Count a newly inserted bug.
+    :param cur: A database cursor.
+    :param bid: The bug ID.
+    """
+    cur.execute('''
+        INSERT INTO rollup_bug_hours (milestone_id, bug_id)
+        SELECT milestone_id, bug_id FROM bug
+        WHERE bug_id = %s AND milestone_id IS NOT NULL
+    ''', (bid,))
+    cur.execute('''
+        INSERT INTO rollup_status_count (milestone_id, status, bug_count)
+        SELECT milestone_id, status, 1 FROM bug
+        WHERE bug_id = %s AND milestone_id IS NOT NULL AND status IS NOT NULL
+        ON CONFLICT (milestone_id, status) DO UPDATE
+        SET bug_count = rollup_status_count.bug_count + 1
+    ''', (bid,))
+
+
+def bug_changed(cur, bid, old_milestone, old_status, new_milestone, new_status):
+    """
+    Account for a bug moving between milestones or statuses.  A status
+    transition adjusts two counters; a milestone move also carries the bug's
+    hours across.
+    :param cur: A database cursor.
+    :param bid: The bug ID.
+    :param old_milestone: The milestone ID before the update.
+    :param old_status: The status before the update.
+    :param new_milestone: The milestone ID after the update.
+    :param new_status: The status after the update.
+    """
+    old_milestone = int(old_milestone) if old_milestone is not None else None
+    new_milestone = int(new_milestone) if new_milestone is not None else None
+    if old_milestone == new_milestone and old_status == new_status:
+        return
+
+    deltas = []
+    if old_milestone is not None and old_status is not None:
+        deltas.append((old_milestone, old_status, -1))
+    if new_milestone is not None and new_status is not None:
+        deltas.append((new_milestone, new_status, 1))
+    for milestone_id, status, delta in deltas:
+        cur.execute('''
+            INSERT INTO rollup_status_count (milestone_id, status, bug_count)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (milestone_id, status) DO UPDATE
+            SET bug_count = rollup_status_count.bug_count + EXCLUDED.bug_count
+        ''', (milestone_id, status, delta))
+
+    if old_milestone == new_milestone:
+        return
+    if new_milestone is None:
+        cur.execute('''
+            DELETE FROM rollup_bug_hours WHERE bug_id = %s
+        ''', (bid,))
+    else:
+        cur.execute('''
+            INSERT INTO rollup_bug_hours (milestone_id, bug_id, hours_worked)
+            SELECT %s, %s, COALESCE(SUM(hours_worked), 0)
+            FROM hours WHERE bug_id = %s
+            ON CONFLICT (bug_id) DO UPDATE
+            SET milestone_id = EXCLUDED.milestone_id
+        ''', (new_milestone, bid, bid))
+
+    moves = [(m, sign) for m, sign in ((old_milestone, -1), (new_milestone, 1))
+             if m is not None]
+    cur.execute('''
+        INSERT INTO rollup_user_hours (milestone_id, user_id, hours_worked)
+        SELECT moved.milestone_id, user_id, moved.sign * SUM(hours_worked)
+        FROM hours,
+             unnest(%s::integer[], %s::integer[]) AS moved (milestone_id, sign)
+        WHERE bug_id = %s
+        GROUP BY moved.milestone_id, moved.sign, user_id
+        ON CONFLICT (milestone_id, user_id) DO UPDATE
+        SET hours_worked = rollup_user_hours.hours_worked
+                           + EXCLUDED.hours_worked
+    ''', ([m for m, _ in moves], [sign for _, sign in moves], bid))
+    if old_milestone is not None:
+        cur.execute('''
+            DELETE FROM rollup_user_hours
+            WHERE milestone_id = %s AND hours_worked = 0
+        ''', (old_milestone,))
+
+
+def hours_added(cur, hours_ids):
+    """
+    Add newly inserted time entries to the hour totals.
+    :param cur: A database cursor.
+    :param hours_ids: The IDs of the new ``hours`` rows.
+    """
+    # Keep the bugs from moving to another milestone until this transaction
+    # commits; otherwise bug_changed could carry their hours across before
+    # these are counted, and they would be credited to the old milestone.
+    cur.execute('''
+        SELECT bug_id FROM bug
+        WHERE bug_id IN (SELECT bug_id FROM hours WHERE hours_id = ANY(%s))
+        ORDER BY bug_id
+        FOR SHARE
+    ''', (list(hours_ids),))
+    cur.execute('''
+        INSERT INTO rollup_bug_hours (milestone_id, bug_id, hours_worked)
+        SELECT bug.milestone_id, bug_id, SUM(hours_worked)
+        FROM hours JOIN bug USING (bug_id)
+        WHERE hours_id = ANY(%s) AND bug.milestone_id IS NOT NULL
+        GROUP BY bug.milestone_id, bug_id
+        ON CONFLICT (bug_id) DO UPDATE
+        SET hours_worked = rollup_bug_hours.hours_worked + EXCLUDED.hours_worked
+    ''', (list(hours_ids),))
+    cur.execute('''
+        INSERT INTO rollup_user_hours (milestone_id, user_id, hours_worked)
+        SELECT bug.milestone_id, hours.user_id, SUM(hours_worked)
+        FROM hours JOIN bug USING (bug_id)
+        WHERE hours_id = ANY(%s) AND bug.milestone_id IS NOT NULL
+        GROUP BY bug.milestone_id, hours.user_id
+        ON CONFLICT (milestone_id, user_id) DO UPDATE
+        SET hours_worked = rollup_user_hours.hours_worked
+                           + EXCLUDED.hours_worked
+    ''', (list(hours_ids),))
+
+
+def rebuild(dbc):
+    """
+    Re-derive all rollup tables from bug and hours.  Writes to those tables
+    are blocked until the rebuild commits.  migrations/0003_rollups.sql
+    backfills them with the same queries.
+    :param dbc: A database connection.  This function will make and commit a
+                transaction.
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('LOCK TABLE bug, hours IN SHARE MODE')
+        cur.execute('''
+            TRUNCATE rollup_bug_hours, rollup_user_hours, rollup_status_count
+        ''')
+        cur.execute('''
+            INSERT INTO rollup_bug_hours (milestone_id, bug_id, hours_worked)
+            SELECT bug.milestone_id, bug_id, COALESCE(SUM(hours_worked), 0)
+            FROM bug LEFT OUTER JOIN hours USING (bug_id)
+            WHERE bug.milestone_id IS NOT NULL
+            GROUP BY bug.milestone_id, bug_id
+        ''')
+        cur.execute('''
+            INSERT INTO rollup_user_hours (milestone_id, user_id, hours_worked)
+            SELECT bug.milestone_id, hours.user_id, SUM(hours_worked)
+            FROM hours JOIN bug USING (bug_id)
+            WHERE bug.milestone_id IS NOT NULL
+            GROUP BY bug.milestone_id, hours.user_id
+        ''')
+        cur.execute('''
+            INSERT INTO rollup_status_count (milestone_id, status, bug_count)
+            SELECT milestone_id, status, COUNT(*)
+            FROM bug
+            WHERE milestone_id IS NOT NULL AND status IS NOT NULL
+            GROUP BY milestone_id, status
+        ''')
+        bump_versions(cur, 'reports')
@@ -0,0 +1,80 @@
+"""
+Server-side prepared statements for the hot read queries.
+
+Each statement is declared once, at import time, with psycopg2-style ``%s``
+placeholders.  The first time a pooled connection runs it, the statement is
+PREPAREd on that connection's server session; later calls, including those
+from later requests that check out the same connection, only send EXECUTE,
+so Postgres skips parsing and, once it settles on a generic plan, planning.
+
+Prepared statements belong to the session, not the transaction, so they
+survive commits and rollbacks.  Connections that do not come from the pool
+(scripts, the migrations tools) have nowhere to remember what has been
+prepared, so they run the plain statement instead.
+"""
+import re
+
+_PLACEHOLDER = re.compile(r'%s')
+
+_statements = {}
+
+
+class Statement(object):
+    """
+    A query that can be run as a prepared statement.
+    """
+
+    def __init__(self, name, sql):
+        if '%%' in sql or '%(' in sql:
+            raise ValueError('statement {} may only use %s placeholders'
+                             .format(name))
+        self.name = name
+        self.sql = sql
+        self.nparams = len(_PLACEHOLDER.findall(sql))
+        counter = iter(range(1, self.nparams + 1))
+        self.prepare_sql = 'PREPARE {} AS {}'.format(
+            name, _PLACEHOLDER.sub(lambda m: '${}'.format(next(counter)), sql))
+        if self.nparams:
+            self.execute_sql = 'EXECUTE {} ({})'.format(
+                name, ', '.join(['%s'] * self.nparams))
+        else:
+            self.execute_sql = 'EXECUTE {}'.format(name)
+
+    def execute(self, cur, params=()):
+        """
+        Run the statement on a cursor, preparing it first if the cursor's
+        connection has not seen it yet.
+        :param cur: A cursor.
+        :param params: The statement's parameters, in placeholder order.
+        """
+        prepared = getattr(cur.connection, 'prepared', None)
+        if prepared is None:
+            cur.execute(self.sql, params)
+            return
+        if self.name not in prepared:
+            cur.execute(self.prepare_sql)
+            prepared.add(self.name)
+        cur.execute(self.execute_sql, params)
+
+
+def statement(name, sql):
+    """
+    Declare a prepared statement.
+    :param name: The statement name; it must be a valid SQL identifier and
+                 unique across the application.
+    :param sql: The query, with ``%s`` placeholders.
+    :return: The Statement.
+    """
+    if name in _statements:
+        raise ValueError('statement {} is already declared'.format(name))
+    stmt = Statement(name, sql)
+    _statements[name] = stmt
+    return stmt
+
+
+def statements():
+    """
+    Get every declared statement.
+    :return: A dictionary of statements by name.
+    """
+    return dict(_statements)
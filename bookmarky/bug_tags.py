@@ -0,0 +1,137 @@
+"""
+An in-process index of bug tags for the tag list and form autocomplete.
+
+The index holds every distinct tag in a sorted list, so a prefix lookup is a
+binary search, along with bug counts per tag and status.  It is loaded from
+the database on first use.  Writes made by this worker update it in place;
+writes made by other workers bump the 'tags' version stamp, which each
+worker checks at most every ``ttl`` seconds before reloading.
+"""
+import bisect
+import collections
+import threading
+import time
+from bookmarky.bug_dbutil import db_connect, get_version
+
+
+class TagIndex(object):
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tags = []
+        self._counts = {}
+        self._version = None
+        self._checked_at = 0.0
+
+    def load(self, dbc):
+        """
+        Rebuild the index from the database.
+        :param dbc: A database connection.  This function will take a
+                    transaction.
+        """
+        with dbc, dbc.cursor() as cur:
+            cur.execute('''
+                SELECT version FROM version_stamp WHERE name = 'tags'
+            ''')
+            row = cur.fetchone()
+            version = row[0] if row is not None else 0
+            cur.execute('''
+                SELECT tag, status, COUNT(*)
+                FROM bug_tag JOIN bug USING (bug_id)
+                GROUP BY tag, status
+            ''')
+            counts = {}
+            for tag, status, count in cur:
+                counts.setdefault(tag, collections.Counter())[status] = count
+        with self._lock:
+            self._counts = counts
+            self._tags = sorted(counts)
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def refresh(self, app):
+        """
+        Load the index if it is empty, or reload it if its version stamp has
+        moved since the last check.
+        :param app: The Flask application.
+        """
+        with self._lock:
+            if (self._version is not None and
+                    time.monotonic() - self._checked_at < self.ttl):
+                return
+            version = self._version
+        dbc = db_connect(app)
+        if version is not None and get_version(dbc, 'tags') == version:
+            with self._lock:
+                self._checked_at = time.monotonic()
+        else:
+            self.load(dbc)
+
+    def bug_changed(self, old_tags, old_status, new_tags, new_status, version):
+        """
+        Apply one bug's tag or status change made by this worker.
+        :param old_tags: The bug's tags before the change (empty for a new bug).
+        :param old_status: The bug's status before the change.
+        :param new_tags: The bug's tags after the change.
+        :param new_status: The bug's status after the change.
+        :param version: The 'tags' version stamp the change was committed as.
+        """
+        with self._lock:
+            if self._version is None:
+                return
+            if (version != self._version + 1 or
+                    any(old_status not in self._counts.get(tag, ())
+                        for tag in old_tags)):
+                # missed someone else's change; reload on the next refresh
+                self._checked_at = 0.0
+                return
+            for tag in old_tags:
+                counts = self._counts[tag]
+                counts[old_status] -= 1
+                if counts[old_status] <= 0:
+                    del counts[old_status]
+                if not counts:
+                    del self._counts[tag]
+                    del self._tags[bisect.bisect_left(self._tags, tag)]
+            for tag in new_tags:
+                if tag not in self._counts:
+                    self._counts[tag] = collections.Counter()
+                    bisect.insort(self._tags, tag)
+                self._counts[tag][new_status] += 1
+            self._version = version
+
+    def complete(self, prefix, limit=10):
+        """
+        Find tags starting with a prefix.
+        :param prefix: The prefix (case-insensitive).
+        :param limit: The maximum number of tags to return.
+        :return: A list of tags, in alphabetical order.
+        """
+        prefix = prefix.strip().lower()
+        with self._lock:
+            tags = self._tags
+            i = bisect.bisect_left(tags, prefix)
+            matches = []
+            while i < len(tags) and len(matches) < limit and \
+                    tags[i].startswith(prefix):
+                matches.append(tags[i])
+                i += 1
+        return matches
+
+    def counts(self):
+        """
+        Get bug counts for every tag.
+        :return: A list of (tag, total, {status: count}) tuples, by tag.
+        """
+        with self._lock:
+            return [(tag, sum(self._counts[tag].values()),
+                     dict(self._counts[tag]))
+                    for tag in self._tags]
+
+
+tag_index = TagIndex()
+
+
+def init_app(app):
+    tag_index.ttl = app.config.get('TAG_INDEX_TTL', tag_index.ttl)
@@ -1,4 +1,16 @@
-import bcrypt
+from bookmarky import bug_statements
+from bookmarky.bug_passwords import hash_pool
+
+_GET_USER = bug_statements.statement('get_user', '''
+    SELECT user_name, display_name, e_mail, role
+    FROM bug_user WHERE user_id = %s
+''')
+
+_LOOKUP_USER = bug_statements.statement('lookup_user', '''
+    SELECT user_id, user_name, pw_hash
+    FROM bug_user WHERE user_name = %s
+''')
+
 
 def get_user(dbc, uid):
     """
@@ -8,16 +20,14 @@ def get_user(dbc, uid):
     :return: The user information map, or None if the user is invalid.
     """
     with dbc, dbc.cursor() as cur:
-        cur.execute('''
-            SELECT user_name
-            FROM bug_user WHERE user_id = %s
-        ''', (uid,))
+        _GET_USER.execute(cur, (uid,))
         row = cur.fetchone()
         if row is None:
             return None
         else:
-            name, = row
-            return {'name': name, 'id': uid }
+            name, display_name, e_mail, role = row
+            return {'name': name, 'id': uid, 'display_name': display_name,
+                    'e_mail': e_mail, 'role': role}
 
 
 def lookup_user(dbc, name):
@@ -28,10 +38,7 @@ def lookup_user(dbc, name):
     :return: The user information map, or None if the user is invalid.
     """
     with dbc, dbc.cursor() as cur:
-        cur.execute('''
-            SELECT user_id, user_name, pw_hash
-            FROM bug_user WHERE user_name = %s
-        ''', (name,))
+        _LOOKUP_USER.execute(cur, (name,))
         row = cur.fetchone()
         if row is None:
             return None
@@ -47,13 +54,24 @@ def check_auth(dbc, username, password):
     :param username: The user name.
     :param password: The password (unhashed).
     :return: The user ID, or None if authentication failed.
+    :raises AuthBusy: if the password hashing pool is saturated.
+    """
+    return check_password(lookup_user(dbc, username), password)
+
+
+def check_password(user, password):
+    """
+    Check a password against a user looked up with lookup_user.  Needs no
+    database connection, so callers can give theirs back while it waits on
+    the hashing pool.
+    :param user: The user information map, or None.
+    :param password: The password (unhashed).
+    :return: The user ID, or None if authentication failed.
+    :raises AuthBusy: if the password hashing pool is saturated.
     """
-    user = lookup_user(dbc, username)
     if user is None:
         return None
-    hash = bcrypt.hashpw(password.encode('UTF-8'),
-                         user['pw_hash'].encode('UTF-8'))
-    if hash == user['pw_hash'].encode('UTF-8'):
+    if hash_pool.check_password(password, user['pw_hash']):
         return user['id']
     else:
         return None
@@ -67,13 +85,24 @@ def create_user(dbc, username, password, display_name, e_mail, role):
     :param password: The password.
     :return: The user ID.
     """
-    hash = bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt())
+    return insert_user(dbc, username, hash_pool.hash_password(password),
+                       display_name, e_mail, role)
+
+
+def insert_user(dbc, username, pw_hash, display_name, e_mail, role):
+    """
+    Creates a user whose password has already been hashed.
+    :param dbc: The DB connection.  This function will make and commit a transaction.
+    :param username: The user name.
+    :param pw_hash: The password hash, from hash_pool.hash_password.
+    :return: The user ID.
+    """
     with dbc, dbc.cursor() as cur:
         cur.execute('''
             INSERT INTO bug_user (user_name, pw_hash, display_name,
                                   e_mail, role)
             VALUES (%s, %s, %s, %s, %s)
             RETURNING user_id
-        ''', (username, hash.decode('UTF-8'), display_name, e_mail, role))
+        ''', (username, pw_hash, display_name, e_mail, role))
         row = cur.fetchone()
         return row[0]
@@ -1,27 +1,91 @@
+import csv
+import functools
+import io
+import json
+import time
+import click
 import flask
-from bookmarky import bug_users, bug_bookmarks
-from bookmarky.dbutil import db_connect
-from contextlib import closing
+import migrations
+from bookmarky import bug_users, bug_bookmarks, bug_cache, bug_etags, \
+    bug_events, bug_fragments, bug_metrics, bug_passwords, bug_profile, \
+    bug_reports, bug_rollups, bug_tags
+from bookmarky import bug_dbutil
+from bookmarky.bug_dbutil import db_connect
 import urllib
 
 app = flask.Flask(__name__)
 app.config.from_pyfile('settings.py')
+bug_dbutil.init_app(app)
+bug_metrics.init_app(app)
+bug_cache.init_app(app)
+bug_passwords.init_app(app)
+bug_tags.init_app(app)
+bug_etags.init_app(app)
+bug_fragments.init_app(app)
+bug_events.init_app(app)
+bug_reports.init_app(app)
+
+
+@app.before_request
+def load_user():
+    """
+    Load the logged-in user, if any, into flask.g.user once per request.
+    Users are cached across requests for USER_CACHE_TTL seconds.
+    """
+    flask.g.user = None
+    uid = flask.session.get('auth_user')
+    if uid is None:
+        return
+    user = bug_cache.user_cache.get(uid)
+    if user is None:
+        user = bug_users.get_user(db_connect(app), uid)
+        if user is None:
+            # the account is gone; carry on anonymously, so the user can
+            # log in again without clearing their cookies
+            app.logger.warning('session for unknown user %d', uid)
+            flask.session.pop('auth_user', None)
+            return
+        bug_cache.user_cache.put(uid, user)
+    # views get their own copy, so they cannot alter the cached entry
+    flask.g.user = dict(user)
+
+
+# registered after load_user, which it needs to tell who may ask for a profile
+bug_profile.init_app(app)
+
+
+def login_required(view):
+    """
+    Decorate a view to answer 403 unless a user is logged in.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if flask.g.user is None:
+            flask.abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def manager_required(view):
+    """
+    Decorate a view to answer 403 unless a Manager is logged in.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if flask.g.user is None or flask.g.user['role'] != 'Manager':
+            flask.abort(403)
+        return view(*args, **kwargs)
+    return wrapper
 
 
 @app.route('/')
 def hello_world():
-    if 'auth_user' in flask.session:
+    if flask.g.user is not None:
         # we have a user
-        with db_connect(app) as dbc:
-            uid = flask.session['auth_user']
-            user = bug_users.get_user(dbc, uid)
-            if user is None:
-                app.logger.error('invalid user %d', uid)
-                flask.abort(400)
-
-            user_marks = bug_bookmarks.get_for_user(dbc, uid)
-            return flask.render_template('bug_home.html', user=user,
-                                          bookmarks=user_marks)
+        dbc = db_connect(app)
+        user_marks = bug_bookmarks.get_for_user(dbc, flask.g.user['id'])
+        return flask.render_template('bug_home.html', user=flask.g.user,
+                                     bookmarks=user_marks)
     else:
         return flask.render_template('bug_login.html')
 
@@ -37,213 +101,565 @@ def login():
         flask.abort(400)
     action = flask.request.form['action']
     if action == 'Log in':
-        with closing(db_connect(app)) as dbc:
-            uid = bug_users.check_auth(dbc, username, password)
-            if uid is not None:
-                flask.session['auth_user'] = uid
-                return flask.redirect('/', code=303)
-            else:
-                flask.abort(403)
-    elif action == 'Create account':
-        with closing(db_connect(app)) as dbc:
-            uid = bug_users.create_user(dbc, username, password, display_name,
-                                        e_mail, role)
+        start = time.monotonic()
+        user = bug_users.lookup_user(db_connect(app), username)
+        # hashing may wait up to AUTH_POOL_TIMEOUT; a login storm must not
+        # hold database connections other pages need meanwhile
+        bug_dbutil.release_connection(app)
+        uid = bug_users.check_password(user, password)
+        app.logger.info('login for %s took %.1f ms', username,
+                        (time.monotonic() - start) * 1000)
+        if uid is not None:
             flask.session['auth_user'] = uid
             return flask.redirect('/', code=303)
+        else:
+            flask.abort(403)
+    elif action == 'Create account':
+        # hash before checking out a connection, as for logging in
+        pw_hash = bug_passwords.hash_pool.hash_password(password)
+        uid = bug_users.insert_user(db_connect(app), username, pw_hash,
+                                    display_name, e_mail, role)
+        bug_cache.ref_cache.invalidate('developers')
+        flask.session['auth_user'] = uid
+        return flask.redirect('/', code=303)
+
+
+@app.errorhandler(bug_passwords.AuthBusy)
+def auth_busy(e):
+    return ('Too many logins in progress, please try again shortly.', 503,
+            {'Retry-After': str(app.config['AUTH_RETRY_AFTER'])})
 
 
 @app.route('/create_bug', methods=['GET', 'POST'])
+@login_required
 def create_bug():
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            milestones = bug_bookmarks.get_milestones(dbc)
-            developers = bug_bookmarks.get_developers(dbc)
+        milestones = bug_cache.milestones(app)
+        developers = bug_cache.developers(app)
         return flask.render_template('create_bug.html', milestones=milestones,
                                     developers=developers)
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.create_bug(dbc, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.create_bug(dbc, uid, flask.request.form)
         return flask.redirect('/', code=303)
 
 
 @app.route('/add_comment/<int:bid>', methods=['GET', 'POST'])
+@login_required
 def add_comment(bid):
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
         return flask.render_template('add_comment.html', bug_id = bid)
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.add_comment(dbc, bid, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.add_comment(dbc, bid, uid, flask.request.form)
         return flask.redirect('/bug_details/' + str(bid), code=303)
 
 @app.route('/add_hours_worked/<int:bid>', methods=['GET', 'POST'])
+@login_required
 def add_hours_worked(bid):
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
         return flask.render_template('add_hours_worked.html', bug_id = bid)
     else:
-        with closing(db_connect(app)) as dbc:
-            print('Test print for else clause')
-            bug_bookmarks.add_hours_worked(dbc, bid, uid, flask.request.form)
-            print('Test print for else clause, after call')
+        dbc = db_connect(app)
+        bug_bookmarks.add_hours_worked(dbc, bid, uid, flask.request.form)
         return flask.redirect('/bug_details/' + str(bid), code=303)
 
 
+def _parse_batch(text, fmt):
+    """
+    Parse a bulk upload: a JSON array of objects, or CSV with a header row.
+    :return: A list of dictionaries.
+    :raises ValueError: if the upload is malformed.
+    """
+    if fmt == 'csv':
+        try:
+            return list(csv.DictReader(io.StringIO(text)))
+        except csv.Error as e:
+            raise ValueError(str(e))
+    entries = json.loads(text)
+    if not (isinstance(entries, list) and
+            all(isinstance(entry, dict) for entry in entries)):
+        raise ValueError('expected a JSON array of objects')
+    return entries
+
+
+def _bulk_entries():
+    request = flask.request
+    fmt = 'csv' if request.mimetype == 'text/csv' else 'json'
+    try:
+        entries = _parse_batch(request.get_data(as_text=True), fmt)
+    except ValueError as e:
+        flask.abort(400, str(e))
+    user = flask.g.user
+    for entry in entries:
+        if not entry.get('user_id'):
+            entry['user_id'] = user['id']
+        elif str(entry['user_id']) != str(user['id']) and \
+                user['role'] != 'Manager':
+            # only managers may load entries on behalf of other users
+            flask.abort(403)
+    return entries
+
+
+def _bulk_response(result):
+    status = 422 if result['errors'] else 200
+    return flask.jsonify(loaded=len(result['ids']),
+                         errors=result['errors']), status
+
+
+@app.errorhandler(bug_bookmarks.PartialLoad)
+def partial_load(e):
+    app.logger.error('bulk load %s', e)
+    # the first part is committed; tell the client where to resume
+    return flask.jsonify(loaded=len(e.ids), resume_from=e.row,
+                         errors=[{'row': e.row, 'error': 'not loaded, '
+                                  'nor were the rows after it'}]), 500
+
+
+@app.route('/bulk/hours', methods=['POST'])
+@login_required
+def bulk_hours():
+    dbc = db_connect(app)
+    result = bug_bookmarks.add_hours_batch(dbc, _bulk_entries(),
+                                           app.config['BULK_BATCH_SIZE'])
+    return _bulk_response(result)
+
+
+@app.route('/bulk/comments', methods=['POST'])
+@login_required
+def bulk_comments():
+    dbc = db_connect(app)
+    result = bug_bookmarks.add_comments_batch(dbc, _bulk_entries(),
+                                              app.config['BULK_BATCH_SIZE'])
+    return _bulk_response(result)
+
+
 @app.route('/bug_details/<int:bid>', methods=['GET', 'POST'])
+@login_required
+@bug_etags.conditional(lambda bid: [bug_bookmarks.bug_stamp(bid),
+                                    'developers', 'milestones'])
 def bug_details(bid):
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
+        before = flask.request.args.get('before')
+        limit = app.config['COMMENT_PAGE_SIZE']
+        dbc = db_connect(app, readonly=True)
+        if before is None:
+            bug, page = bug_bookmarks.get_bug_details(dbc, bid, limit)
+        else:
+            # the "load more" link, followed without JavaScript
             bug = bug_bookmarks.get_bug(dbc, bid)
-            bug_comments = bug_bookmarks.get_bug_comments(dbc, bid)
+            page = bug_bookmarks.get_bug_comments(dbc, bid, limit, before)
+        if bug is None:
+            flask.abort(404)
         return flask.render_template('bug_details.html', bug=bug,
-                                     bug_comments = bug_comments)
+                                     bug_comments=page['comments'],
+                                     next_cursor=page['next'])
 
     #I do not think the 'POST' method is used
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
         return flask.redirect('/', code=303)
 
 
+@app.route('/bug_details/<int:bid>/comments')
+@login_required
+@bug_etags.conditional(lambda bid: [bug_bookmarks.bug_stamp(bid),
+                                    'developers'])
+def bug_comments(bid):
+    dbc = db_connect(app, readonly=True)
+    page = bug_bookmarks.get_bug_comments(dbc, bid,
+                                          app.config['COMMENT_PAGE_SIZE'],
+                                          flask.request.args.get('before'))
+    comments = []
+    for comment in page['comments']:
+        item = comment._asdict()
+        item['comment_date'] = comment.comment_date.isoformat()
+        item['html'] = str(bug_fragments.render_comment(comment))
+        comments.append(item)
+    return flask.jsonify(comments=comments, next=page['next'])
+
+
 @app.route('/edit_bug/<int:bid>', methods=['GET', 'POST'])
+@login_required
 def edit_bug(bid):
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
-
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            bug = bug_bookmarks.get_bug(dbc, bid)
-            milestones = bug_bookmarks.get_milestones(dbc)
-            developers = bug_bookmarks.get_developers(dbc)
+        dbc = db_connect(app)
+        bug = bug_bookmarks.get_bug(dbc, bid)
+        milestones = bug_cache.milestones(app)
+        developers = bug_cache.developers(app)
         return flask.render_template('edit_bug.html', bug=bug,
                                      milestones=milestones,
                                      developers=developers)
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.update_bug(dbc, bid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.update_bug(dbc, bid, flask.request.form)
         return flask.redirect('/', code=303)
 
 
+@app.errorhandler(bug_bookmarks.BugConflict)
+def bug_conflict(e):
+    # show the bug as it is now, so the edit can be redone on top of it
+    dbc = db_connect(app)
+    bug = bug_bookmarks.get_bug(dbc, e.bid)
+    if bug is None:
+        # deleted since the edit was rendered; nothing left to redo it on
+        flask.abort(404)
+    accept = flask.request.accept_mimetypes
+    if accept.accept_json and not accept.accept_html:
+        return flask.jsonify(error='conflict', bug=bug._asdict()), 409
+    return flask.render_template('edit_bug.html', bug=bug,
+                                 milestones=bug_cache.milestones(app),
+                                 developers=bug_cache.developers(app),
+                                 conflict=True), 409
+
+
 @app.route('/news_feed', methods=['GET', 'POST'])
+@login_required
+@bug_etags.conditional(lambda: [bug_bookmarks.feed_stamp(flask.g.user['id']),
+                                'developers'])
 def news_feed():
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            news_comments = bug_bookmarks.get_news_comments(dbc, uid)
-        return flask.render_template('news_feed.html', news_comments=news_comments)
+        since = flask.request.args.get('since')
+        dbc = db_connect(app, readonly=True)
+        feed = bug_bookmarks.get_news_comments(
+            dbc, uid, app.config['NEWS_FEED_LIMIT'], since)
+        if since is not None:
+            # polling clients only want what is new since their last check,
+            # oldest first, and continue from the cursor they get back
+            comments = []
+            for comment in feed['comments']:
+                comment = comment._asdict()
+                comment['comment_date'] = comment['comment_date'].isoformat()
+                comments.append(comment)
+            return flask.jsonify(comments=comments, since=feed['since'])
+        return flask.render_template('news_feed.html',
+                                     news_comments=feed['comments'],
+                                     since=feed['since'])
 
     #I do not think the 'POST' method is used
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
         return flask.redirect('/', code=303)
 
 
+@app.route('/news_feed/stream')
+@login_required
+def news_feed_stream():
+    subscription = bug_events.hub.subscribe(app, flask.g.user['id'])
+    if subscription is None:
+        return ('Too many live feeds open, please try again shortly.', 503,
+                {'Retry-After': str(app.config['EVENT_RETRY_AFTER'])})
+    # not stream_with_context: the request's database connection goes back
+    # to the pool as soon as this returns, however long the stream stays open
+    response = flask.Response(
+        bug_events.stream(subscription, app.config['EVENT_HEARTBEAT']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # the stream's own cleanup never runs if it is not started (a HEAD
+    # request, or a client gone before the first write)
+    response.call_on_close(lambda: bug_events.hub.unsubscribe(subscription))
+    return response
+
+
 @app.route('/bug_list', methods=['GET', 'POST'])
+@login_required
+@bug_etags.conditional(lambda: ['bugs', 'milestones'])
 def bug_list():
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            bugs = bug_bookmarks.get_bugs(dbc)
-        return flask.render_template('bug_list.html', bugs=bugs)
+        args = flask.request.args
+        filters = _bug_list_filters()
+        if args.get('stream'):
+            bugs = bug_bookmarks.iter_bugs(db_connect(app, readonly=True),
+                                           filters,
+                                           app.config['BUG_STREAM_ITERSIZE'])
+            return stream_template('bug_list.html', bugs=bugs,
+                                   next_cursor=None, prev_cursor=None,
+                                   filters=filters, limit=None)
+        limit = args.get('limit', app.config['BUG_LIST_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['BUG_LIST_MAX_PAGE_SIZE']))
+        dbc = db_connect(app, readonly=True)
+        page = bug_bookmarks.get_bugs(dbc, limit,
+                                      after=args.get('after'),
+                                      before=args.get('before'),
+                                      filters=filters)
+        return flask.render_template('bug_list.html', bugs=page['bugs'],
+                                     next_cursor=page['next'],
+                                     prev_cursor=page['prev'],
+                                     filters=filters, limit=limit)
 
     #I do not think the 'POST' method is used
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
         return flask.redirect('/', code=303)
 
+def stream_template(template_name, **context):
+    """
+    Render a template incrementally, sending output as it is produced.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config['TEMPLATE_STREAM_BUFFER'])
+    return flask.Response(flask.stream_with_context(stream))
+
+
+BUG_EXPORT_FIELDS = ['bug_id', 'bug_title', 'bug_details', 'creator',
+                     'creation_date', 'assignee', 'assigned_date', 'status',
+                     'close_date', 'bug_priority', 'milestone_title',
+                     'target_date', 'tags']
+
+
+def _bug_list_filters():
+    args = flask.request.args
+    return {name: args[name] for name in bug_bookmarks.BUG_FILTERS
+            if args.get(name)}
+
+
+@app.route('/bug_list.csv')
+@login_required
+def bug_list_csv():
+    bugs = bug_bookmarks.iter_bugs(db_connect(app, readonly=True),
+                                   _bug_list_filters(),
+                                   app.config['BUG_STREAM_ITERSIZE'])
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(BUG_EXPORT_FIELDS)
+        for bug in bugs:
+            bug = bug._replace(tags=','.join(bug.tags))
+            writer.writerow([getattr(bug, f) for f in BUG_EXPORT_FIELDS])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='text/csv')
+
+
+@app.route('/bug_list.ndjson')
+@login_required
+def bug_list_ndjson():
+    bugs = bug_bookmarks.iter_bugs(db_connect(app, readonly=True),
+                                   _bug_list_filters(),
+                                   app.config['BUG_STREAM_ITERSIZE'])
+
+    def generate():
+        for bug in bugs:
+            yield json.dumps({f: getattr(bug, f) for f in BUG_EXPORT_FIELDS},
+                             default=str) + '\n'
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='application/x-ndjson')
+
+
+@app.route('/search')
+@login_required
+def search():
+    args = flask.request.args
+    query = args.get('q', '').strip()
+    filters = {name: args[name] for name in ('status', 'milestone', 'tag')
+               if args.get(name)}
+    page = max(args.get('page', 1, type=int), 1)
+    limit = app.config['SEARCH_PAGE_SIZE']
+    found = {'results': [], 'more': False}
+    if query:
+        dbc = db_connect(app, readonly=True)
+        found = bug_bookmarks.search_bugs(dbc, query, filters, limit,
+                                          (page - 1) * limit)
+    return flask.render_template('search.html', query=query, filters=filters,
+                                 page=page, results=found['results'],
+                                 more=found['more'])
+
+
+@app.route('/tags')
+@login_required
+def tags():
+    bug_tags.tag_index.refresh(app)
+    return flask.render_template('tags.html',
+                                 tags=bug_tags.tag_index.counts(),
+                                 by_status=bool(flask.request.args.get('by_status')))
+
+
+@app.route('/tags/complete')
+@login_required
+def tags_complete():
+    bug_tags.tag_index.refresh(app)
+    prefix = flask.request.args.get('prefix', '')
+    return flask.jsonify(tags=bug_tags.tag_index.complete(prefix))
+
+
 @app.route('/user_profile', methods=['GET', 'POST'])
+@login_required
 def user_profile():
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            user_info = bug_bookmarks.get_user_info.user_info(dbc,uid)
-        return flask.render_template('user_profile.html', user_info=user_info)
+        return flask.render_template('user_profile.html',
+                                     user_info=flask.g.user)
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
-            return flask.redirect('/', code=303)
+        dbc = db_connect(app)
+        bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
+        return flask.redirect('/', code=303)
 
 
 @app.route('/edit_user_profile', methods=['GET', 'POST'])
+@login_required
 def edit_user_profile():
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        with closing(db_connect(app)) as dbc:
-            user_info = bug_bookmarks.get_user_info(dbc, uid)
-        return flask.render_template('edit_user_profile.html', user_info=user_info)
+        return flask.render_template('edit_user_profile.html',
+                                     user_info=flask.g.user)
 
     else:
-        with closing(db_connect(app)) as dbc:
-            bug_bookmarks.edit_user_profile(dbc, uid, flask.request.form)
+        dbc = db_connect(app)
+        bug_bookmarks.edit_user_profile(dbc, uid, flask.request.form)
+        bug_cache.user_cache.invalidate(uid)
         return flask.redirect('/user_profile', code=303)
 
 @app.route('/reports/<int:rid>', methods=['GET', 'POST'])
+@login_required
+@bug_etags.conditional(lambda rid: [bug_reports.report_stamp(rid),
+                                    *bug_reports.SOURCES])
 def reports(rid):
-    if 'auth_user' in flask.session:
-        uid = flask.session['auth_user']
-    else:
-        flask.abort(403)
+    uid = flask.g.user['id']
 
     if flask.request.method == 'GET':
-        if rid == 1:
-            with closing(db_connect(app)) as dbc:
-                report_info_1 = bug_bookmarks.get_report_info_1(dbc)
-            return flask.render_template('report_1.html',
-                                          report_info_1=report_info_1)
-        if rid == 2:
-            with closing(db_connect(app)) as dbc:
-                report_info_2 = bug_bookmarks.get_report_info_2(dbc)
-            return flask.render_template('report_2.html',
-                                          report_info_2=report_info_2)
-
-        if rid == 3:
-            with closing(db_connect(app)) as dbc:
-                report_info_3 = bug_bookmarks.get_report_info_3(dbc)
-            return flask.render_template('report_3.html',
-                                         report_info_3=report_info_3)
+        if rid not in bug_reports.REPORTS:
+            flask.abort(404)
+        dbc = db_connect(app, readonly=True)
+        result = bug_reports.get_result(dbc, rid)
+        if result is None or result['stale']:
+            bug_reports.runner.refresh(app, rid)
+        if result is None:
+            retry = str(app.config['REPORT_RETRY_AFTER'])
+            return ('This report is being generated, please try again '
+                    'shortly.', 202, {'Retry-After': retry, 'Refresh': retry})
+        return flask.render_template(
+            'report_{}.html'.format(rid),
+            generated_at=result['generated_at'], stale=result['stale'],
+            **{'report_info_{}'.format(rid): result['rows']})
     #I do not think the 'POST' method is used
-        else:
-            with closing(db_connect(app)) as dbc:
-                bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
-            return flask.redirect('/', code=303)
+    else:
+        dbc = db_connect(app)
+        bug_bookmarks.get_bugs(dbc, uid, flask.request.form)
+        return flask.redirect('/', code=303)
+
+
+@app.route('/debug/pool_stats')
+@manager_required
+def debug_pool_stats():
+    stats = bug_dbutil.pool_stats(app)
+    replica = bug_dbutil.pool_stats(app, replica=True)
+    if replica is not None:
+        stats['replica'] = replica
+    return flask.jsonify(stats)
+
+
+@app.route('/debug/auth_stats')
+@manager_required
+def debug_auth_stats():
+    return flask.jsonify(bug_passwords.hash_pool.stats())
+
+
+@app.route('/debug/report_stats')
+@manager_required
+def debug_report_stats():
+    return flask.jsonify(bug_reports.runner.stats())
+
+
+@app.route('/debug/metrics')
+@manager_required
+def debug_metrics():
+    return flask.Response(bug_metrics.render(app),
+                          mimetype='text/plain; version=0.0.4')
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Apply pending schema migrations."""
+    migrations.migrate(db_connect(app))
+
+
+@app.cli.command('prune-fragments')
+def prune_fragments():
+    """Delete shared rendered fragments older than FRAGMENT_CACHE_MAX_AGE."""
+    store = bug_fragments.fragment_cache.store
+    if store is None:
+        print('FRAGMENT_CACHE_DIR is not set')
+        return
+    deleted = store.prune(app.config['FRAGMENT_CACHE_MAX_AGE'])
+    print('deleted {} fragments'.format(deleted))
+
+
+def _import_file(path, load):
+    fmt = 'csv' if path.lower().endswith('.csv') else 'json'
+    with open(path, newline='', encoding='UTF-8') as f:
+        try:
+            entries = _parse_batch(f.read(), fmt)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    try:
+        result = load(db_connect(app), entries, app.config['BULK_BATCH_SIZE'])
+    except bug_bookmarks.PartialLoad as e:
+        raise click.ClickException(
+            'loaded {} rows, then {}; load from row {} on to finish'.format(
+                len(e.ids), e, e.row))
+    for error in result['errors']:
+        click.echo('row {row}: {error}'.format(**error), err=True)
+    if result['errors']:
+        raise click.ClickException('{} invalid rows, nothing loaded'.format(
+            len(result['errors'])))
+    click.echo('loaded {} rows'.format(len(result['ids'])))
+
+
+@app.cli.command('import-hours')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_hours(path):
+    """Load time entries from a JSON or CSV file."""
+    _import_file(path, bug_bookmarks.add_hours_batch)
+
+
+@app.cli.command('import-comments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_comments(path):
+    """Load comments from a JSON or CSV file."""
+    _import_file(path, bug_bookmarks.add_comments_batch)
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Re-derive the report rollup tables from bug and hours."""
+    bug_rollups.rebuild(db_connect(app))
+
+
+@app.cli.command('refresh-reports')
+@click.argument('rids', nargs=-1, type=int)
+@click.option('--force', is_flag=True, help='Recompute current results too.')
+def refresh_reports(rids, force):
+    """Compute stale reports now (all of them, or those named)."""
+    for rid in rids or sorted(bug_reports.REPORTS):
+        if rid not in bug_reports.REPORTS:
+            raise click.ClickException('no report {}'.format(rid))
+        computed = bug_reports.compute(db_connect(app), rid, force)
+        click.echo('report {}: {}'.format(
+            rid, 'computed' if computed else 'current or in progress'))
 
 
 if __name__ == '__main__':
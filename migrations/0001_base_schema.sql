@@ -0,0 +1,76 @@
+-- Base schema, as the application's queries expect it.
+--
+-- Databases created before migrations existed already have these tables;
+-- record this migration as applied there without running it:
+--
+--     python -m migrations --fake 1
+
+CREATE TABLE bug_user (
+    user_id       SERIAL PRIMARY KEY,
+    user_name     TEXT NOT NULL UNIQUE,
+    pw_hash       TEXT NOT NULL,
+    display_name  TEXT,
+    e_mail        TEXT,
+    role          TEXT
+);
+
+CREATE TABLE milestone (
+    milestone_id     SERIAL PRIMARY KEY,
+    milestone_title  TEXT NOT NULL,
+    target_date      DATE
+);
+
+CREATE TABLE bug (
+    bug_id         SERIAL PRIMARY KEY,
+    bug_title      TEXT,
+    bug_details    TEXT,
+    creator        INTEGER REFERENCES bug_user (user_id),
+    creation_date  TIMESTAMP NOT NULL DEFAULT now(),
+    assignee       INTEGER REFERENCES bug_user (user_id),
+    assigned_date  TIMESTAMP,
+    tag_text       TEXT,
+    status         TEXT,
+    close_date     TIMESTAMP,
+    bug_priority   TEXT,
+    milestone_id   INTEGER REFERENCES milestone (milestone_id)
+);
+
+CREATE TABLE bug_tag (
+    bug_id  INTEGER NOT NULL REFERENCES bug (bug_id) ON DELETE CASCADE,
+    tag     TEXT NOT NULL
+);
+
+CREATE TABLE comment (
+    comment_id      SERIAL PRIMARY KEY,
+    comment_author  INTEGER NOT NULL REFERENCES bug_user (user_id),
+    bug_id          INTEGER NOT NULL REFERENCES bug (bug_id),
+    comment_text    TEXT,
+    comment_date    TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE hours (
+    hours_id      SERIAL PRIMARY KEY,
+    user_id       INTEGER NOT NULL REFERENCES bug_user (user_id),
+    bug_id        INTEGER NOT NULL REFERENCES bug (bug_id),
+    hours_worked  NUMERIC NOT NULL
+);
+
+CREATE TABLE subscription (
+    user_id  INTEGER NOT NULL REFERENCES bug_user (user_id),
+    bug_id   INTEGER NOT NULL REFERENCES bug (bug_id)
+);
+
+CREATE TABLE bookmark (
+    bookmark_id  SERIAL PRIMARY KEY,
+    owner_id     INTEGER NOT NULL REFERENCES bug_user (user_id),
+    url          TEXT NOT NULL,
+    title        TEXT,
+    notes        TEXT,
+    create_time  TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE bm_tag (
+    bookmark_id  INTEGER NOT NULL REFERENCES bookmark (bookmark_id)
+                 ON DELETE CASCADE,
+    tag          TEXT NOT NULL
+);
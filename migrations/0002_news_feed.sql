@@ -0,0 +1,33 @@
+-- Per-user news feed index.
+--
+-- add_comment (bookmarky/bug_bookmarks.py) fans each new comment out to the
+-- bug's creator, assignee and subscribers at write time, so /news_feed reads
+-- a user's feed as a range scan on the primary key instead of joining
+-- comment, bug and subscription on every request.
+
+CREATE TABLE news_feed_item (
+    user_id     INTEGER NOT NULL REFERENCES bug_user (user_id),
+    comment_id  INTEGER NOT NULL REFERENCES comment (comment_id)
+                ON DELETE CASCADE,
+    -- the transaction that added the item, which ?since= polls page by
+    xact_id     BIGINT NOT NULL DEFAULT txid_current(),
+    PRIMARY KEY (user_id, comment_id)
+);
+
+-- ?since= polls: a user's items in the order their transactions finished
+CREATE INDEX news_feed_item_xact_idx
+    ON news_feed_item (user_id, xact_id, comment_id);
+
+-- Backfill from the existing comments.
+INSERT INTO news_feed_item (user_id, comment_id)
+SELECT DISTINCT recipient.user_id, comment.comment_id
+FROM comment
+JOIN bug USING (bug_id)
+CROSS JOIN LATERAL (
+    SELECT bug.creator
+    UNION SELECT bug.assignee
+    UNION SELECT subscription.user_id
+          FROM subscription
+          WHERE subscription.bug_id = bug.bug_id
+) AS recipient (user_id)
+WHERE recipient.user_id IS NOT NULL;
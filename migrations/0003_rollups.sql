@@ -0,0 +1,51 @@
+-- Rollup tables for the /reports pages.
+--
+-- Maintained incrementally by bookmarky/bug_rollups.py from create_bug,
+-- update_bug and add_hours_worked, and re-derived from scratch by
+-- `flask rebuild-rollups`.  The backfill at the end uses the same
+-- aggregation as bug_rollups.rebuild; keep the two in step.
+
+-- Report 1: hours per bug, grouped by milestone.  Every bug has a row, even
+-- before any hours are logged against it.
+CREATE TABLE rollup_bug_hours (
+    milestone_id  INTEGER NOT NULL REFERENCES milestone (milestone_id),
+    bug_id        INTEGER NOT NULL REFERENCES bug (bug_id) ON DELETE CASCADE,
+    hours_worked  NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (milestone_id, bug_id)
+);
+CREATE UNIQUE INDEX rollup_bug_hours_bug_idx ON rollup_bug_hours (bug_id);
+
+-- Report 2: hours per user, grouped by milestone.
+CREATE TABLE rollup_user_hours (
+    milestone_id  INTEGER NOT NULL REFERENCES milestone (milestone_id),
+    user_id       INTEGER NOT NULL REFERENCES bug_user (user_id),
+    hours_worked  NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (milestone_id, user_id)
+);
+
+-- Report 3: bug counts per milestone and status.
+CREATE TABLE rollup_status_count (
+    milestone_id  INTEGER NOT NULL REFERENCES milestone (milestone_id),
+    status        TEXT NOT NULL,
+    bug_count     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (milestone_id, status)
+);
+
+-- Backfill from the existing bugs and hours.
+INSERT INTO rollup_bug_hours (milestone_id, bug_id, hours_worked)
+SELECT bug.milestone_id, bug_id, COALESCE(SUM(hours_worked), 0)
+FROM bug LEFT OUTER JOIN hours USING (bug_id)
+WHERE bug.milestone_id IS NOT NULL
+GROUP BY bug.milestone_id, bug_id;
+
+INSERT INTO rollup_user_hours (milestone_id, user_id, hours_worked)
+SELECT bug.milestone_id, hours.user_id, SUM(hours_worked)
+FROM hours JOIN bug USING (bug_id)
+WHERE bug.milestone_id IS NOT NULL
+GROUP BY bug.milestone_id, hours.user_id;
+
+INSERT INTO rollup_status_count (milestone_id, status, bug_count)
+SELECT milestone_id, status, COUNT(*)
+FROM bug
+WHERE milestone_id IS NOT NULL AND status IS NOT NULL
+GROUP BY milestone_id, status;
@@ -0,0 +1,33 @@
+-- Version stamps for cached data.
+--
+-- Each row names a piece of data cached in the web workers; bumping its
+-- version tells every worker to reload it (see bookmarky/bug_cache.py).
+-- Checking a stamp is a single primary-key read, far cheaper than
+-- re-running the query it guards.
+
+CREATE TABLE version_stamp (
+    name         TEXT PRIMARY KEY,
+    version      BIGINT NOT NULL DEFAULT 0,
+    modified_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE FUNCTION bump_version_stamp() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO version_stamp (name, version) VALUES (TG_ARGV[0], 1)
+    ON CONFLICT (name) DO UPDATE
+    SET version = version_stamp.version + 1, modified_at = now();
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Reference data shown on the bug forms changes rarely and outside the app
+-- as often as inside it, so bump its stamps from triggers.
+CREATE TRIGGER milestone_version_stamp
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON milestone
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_version_stamp('milestones');
+
+CREATE TRIGGER bug_user_version_stamp
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bug_user
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_version_stamp('developers');
+
+INSERT INTO version_stamp (name) VALUES ('milestones'), ('developers');
@@ -0,0 +1,19 @@
+-- Full-text search over bugs and comments (see search_bugs in
+-- bookmarky/bug_bookmarks.py).
+--
+-- The tsvector columns are generated, so Postgres keeps them current on
+-- every insert and update, and the GIN indexes answer @@ matches without
+-- scanning the tables.
+
+ALTER TABLE bug ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(bug_title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(bug_details, '')), 'B')
+    ) STORED;
+CREATE INDEX bug_search_idx ON bug USING GIN (search_vector);
+
+ALTER TABLE comment ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('english', coalesce(comment_text, ''))
+    ) STORED;
+CREATE INDEX comment_search_idx ON comment USING GIN (search_vector);
@@ -0,0 +1,38 @@
+-- Indexes for the access paths of the queries in bookmarky/bug_bookmarks.py.
+-- IF NOT EXISTS lets this run on databases where some were created by hand
+-- under the same names.
+
+-- bug tags fetched with each bug row; (bug_id, tag) also makes the tag
+-- array and the tag sync diff index-only
+CREATE INDEX IF NOT EXISTS bug_tag_bug_idx ON bug_tag (bug_id, tag);
+-- ?tag= filter on the bug list and search
+CREATE INDEX IF NOT EXISTS bug_tag_tag_idx ON bug_tag (tag, bug_id);
+
+-- a bug's comments, newest first
+CREATE INDEX IF NOT EXISTS comment_bug_date_idx
+    ON comment (bug_id, comment_date);
+CREATE INDEX IF NOT EXISTS comment_author_idx ON comment (comment_author);
+
+-- a user's subscriptions, and a bug's subscribers for news feed fan-out
+CREATE INDEX IF NOT EXISTS subscription_user_bug_idx
+    ON subscription (user_id, bug_id);
+CREATE INDEX IF NOT EXISTS subscription_bug_idx ON subscription (bug_id);
+
+-- time entries per bug (rollup maintenance) and per user
+CREATE INDEX IF NOT EXISTS hours_bug_idx ON hours (bug_id);
+CREATE INDEX IF NOT EXISTS hours_user_idx ON hours (user_id);
+
+-- keyset pagination of the bug list
+CREATE INDEX IF NOT EXISTS bug_creation_idx ON bug (creation_date, bug_id);
+-- ?assignee= on the bug list, newest first, with the same keyset as the
+-- unfiltered list
+CREATE INDEX IF NOT EXISTS bug_assignee_creation_idx
+    ON bug (assignee, creation_date, bug_id);
+-- bugs per milestone and status
+CREATE INDEX IF NOT EXISTS bug_milestone_status_idx
+    ON bug (milestone_id, status);
+
+-- the home page's bookmarks
+CREATE INDEX IF NOT EXISTS bookmark_owner_idx
+    ON bookmark (owner_id, create_time);
+CREATE INDEX IF NOT EXISTS bm_tag_bookmark_idx ON bm_tag (bookmark_id, tag);
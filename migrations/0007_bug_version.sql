@@ -0,0 +1,6 @@
+-- A per-bug version, incremented by every update to the bug row, so that
+-- anything derived from a bug (rendered fragments, edit forms) can tell
+-- whether its copy is current.  The constant default makes this a catalog
+-- change, without rewriting the table.
+
+ALTER TABLE bug ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
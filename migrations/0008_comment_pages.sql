@@ -0,0 +1,15 @@
+-- Bug details show a bug's comments a page at a time, newest first, with a
+-- keyset on (comment_date, comment_id), and the total from a counter kept
+-- by add_comment instead of a COUNT over all of them.
+
+ALTER TABLE bug ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE bug SET comment_count = counts.comment_count
+FROM (SELECT bug_id, COUNT(*) AS comment_count
+      FROM comment GROUP BY bug_id) AS counts
+WHERE bug.bug_id = counts.bug_id;
+
+-- one range scan per page; replaces the (bug_id, comment_date) index
+CREATE INDEX comment_bug_page_idx
+    ON comment (bug_id, comment_date, comment_id);
+DROP INDEX IF EXISTS comment_bug_date_idx;
@@ -0,0 +1,11 @@
+-- The last computed result of each report (see bookmarky/bug_reports.py),
+-- with the versions of the stamps it was computed from, so a page can tell
+-- whether it is stale without re-running the report.
+
+CREATE TABLE report_result (
+    report_id     INTEGER PRIMARY KEY,
+    result        JSONB NOT NULL,
+    sources       JSONB NOT NULL,
+    generated_at  TIMESTAMPTZ NOT NULL,
+    duration      DOUBLE PRECISION NOT NULL
+);
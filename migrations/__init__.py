@@ -0,0 +1,88 @@
+"""
+Versioned database schema.
+
+Each ``NNNN_description.sql`` file in this package is one migration.
+Migrations are applied in order, each in its own transaction, and recorded
+in the ``schema_migrations`` table so that every one runs exactly once per
+database.  Run pending migrations with ``flask migrate`` or::
+
+    python -m migrations [--target N] [--fake N] [--list]
+"""
+import os
+import re
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_FILENAME = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# Arbitrary key for the advisory lock that serializes concurrent migrators.
+_LOCK_KEY = 4332
+
+
+def available():
+    """
+    List the migrations shipped in this package.
+    :return: A list of (version, name, path) tuples, in version order.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = _FILENAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                               os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def applied(dbc):
+    """
+    Get the versions already applied to a database, creating the bookkeeping
+    table if necessary.
+    :param dbc: A database connection.  This function will make and commit a
+                transaction.
+    :return: A set of migration versions.
+    """
+    with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version     INTEGER PRIMARY KEY,
+                name        TEXT NOT NULL,
+                applied_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        cur.execute('SELECT version FROM schema_migrations')
+        return {version for version, in cur}
+
+
+def migrate(dbc, target=None, fake=False, log=print):
+    """
+    Apply pending migrations.
+    :param dbc: A database connection.  Each migration is made and committed
+                as its own transaction.
+    :param target: The last version to apply; None applies all of them.
+    :param fake: Record the migrations as applied without running them, for
+                 databases whose schema was created by hand.
+    :param log: A function to report progress to.
+    :return: The list of versions applied.
+    """
+    done = applied(dbc)
+    ran = []
+    for version, name, path in available():
+        if version in done or (target is not None and version > target):
+            continue
+        with open(path) as f:
+            sql = f.read()
+        with dbc, dbc.cursor() as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (_LOCK_KEY,))
+            cur.execute('''
+                SELECT 1 FROM schema_migrations WHERE version = %s
+            ''', (version,))
+            if cur.fetchone() is not None:
+                continue
+            if not fake:
+                cur.execute(sql)
+            cur.execute('''
+                INSERT INTO schema_migrations (version, name) VALUES (%s, %s)
+            ''', (version, name))
+        log('{} {:04d}_{}'.format('faked' if fake else 'applied', version, name))
+        ran.append(version)
+    return ran
@@ -0,0 +1,41 @@
+import argparse
+import sys
+import psycopg2
+import migrations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m migrations',
+                                     description='Apply schema migrations.')
+    parser.add_argument('--target', type=int,
+                        help='last migration version to apply')
+    parser.add_argument('--fake', type=int, metavar='VERSION',
+                        help='record migrations up to VERSION as applied '
+                             'without running them')
+    parser.add_argument('--list', action='store_true',
+                        help='show migrations and whether they are applied')
+    parser.add_argument('--settings', default='settings.py',
+                        help='settings file holding PG_ARGS')
+    args = parser.parse_args(argv)
+
+    config = {}
+    with open(args.settings) as f:
+        exec(compile(f.read(), args.settings, 'exec'), config)
+    dbc = psycopg2.connect(**config['PG_ARGS'])
+    try:
+        if args.list:
+            done = migrations.applied(dbc)
+            for version, name, _ in migrations.available():
+                print('[{}] {:04d}_{}'.format('x' if version in done else ' ',
+                                              version, name))
+        elif args.fake is not None:
+            migrations.migrate(dbc, target=args.fake, fake=True)
+        else:
+            migrations.migrate(dbc, target=args.target)
+    finally:
+        dbc.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
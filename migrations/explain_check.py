@@ -0,0 +1,351 @@
+"""
+Check that the application's queries use indexes.
+
+Seeds a database with a realistic volume of rows, runs every query in
+bookmarky.bug_bookmarks (and the user lookups in bookmarky.bug_users) with
+EXPLAIN, and fails if any plan sequentially scans a table that query is not
+expected to read in full.  Everything happens in one transaction that is
+rolled back, but the seeding is heavy: point it at a scratch database with
+all migrations applied::
+
+    python -m migrations.explain_check [--settings settings.py]
+"""
+import argparse
+import json
+import sys
+import psycopg2
+from bookmarky import bug_bookmarks, bug_rollups, bug_users
+
+# Tables small enough by nature that scanning them is the right plan.
+SMALL_TABLES = {'milestone', 'version_stamp'}
+
+SEED_SQL = '''
+    INSERT INTO bug_user (user_name, pw_hash, display_name, e_mail, role)
+    SELECT 'seed' || i, 'x', 'Seed User ' || i, 'seed' || i || '@example.com',
+           CASE WHEN i % 10 = 0 THEN 'Developer' ELSE 'User' END
+    FROM generate_series(1, 5000) AS i;
+
+    INSERT INTO milestone (milestone_title, target_date)
+    SELECT 'Seed milestone ' || i, current_date + i * 14
+    FROM generate_series(1, 20) AS i;
+
+    INSERT INTO bug (bug_title, bug_details, creator, creation_date, assignee,
+                     tag_text, status, bug_priority, milestone_id)
+    SELECT 'Seed bug ' || i || ' crashes on save',
+           'Steps to reproduce seed bug ' || i,
+           (SELECT min(user_id) FROM bug_user) + i % 5000,
+           now() - i * interval '1 minute',
+           (SELECT min(user_id) FROM bug_user) + (i * 7) % 5000,
+           '',
+           (ARRAY['Open', 'In_Development', 'Ready_for_Testing', 'Testing',
+                  'Ready_for_Deployment', 'Rejected', 'Closed'])[1 + i % 7],
+           (ARRAY['Low', 'Medium', 'High'])[1 + i % 3],
+           (SELECT min(milestone_id) FROM milestone) + i % 20
+    FROM generate_series(1, 100000) AS i;
+
+    INSERT INTO bug_tag (bug_id, tag)
+    SELECT bug_id, 'tag' || ((bug_id * k) % 500)
+    FROM bug, generate_series(1, 3) AS k;
+
+    INSERT INTO comment (comment_author, bug_id, comment_text, comment_date)
+    SELECT (SELECT min(user_id) FROM bug_user) + i % 5000,
+           (SELECT min(bug_id) FROM bug) + i % 100000,
+           'Seed comment ' || i || ' about the save crash',
+           now() - i * interval '10 seconds'
+    FROM generate_series(1, 300000) AS i;
+
+    INSERT INTO hours (user_id, bug_id, hours_worked)
+    SELECT (SELECT min(user_id) FROM bug_user) + i % 5000,
+           (SELECT min(bug_id) FROM bug) + i % 100000,
+           0.25 * (1 + i % 16)
+    FROM generate_series(1, 200000) AS i;
+
+    INSERT INTO subscription (user_id, bug_id)
+    SELECT (SELECT min(user_id) FROM bug_user) + i % 5000,
+           (SELECT min(bug_id) FROM bug) + (i * 13) % 100000
+    FROM generate_series(1, 50000) AS i;
+
+    INSERT INTO bookmark (owner_id, url, title)
+    SELECT (SELECT min(user_id) FROM bug_user) + i % 5000,
+           'http://example.com/' || i, 'Seed bookmark ' || i
+    FROM generate_series(1, 50000) AS i;
+
+    INSERT INTO bm_tag (bookmark_id, tag)
+    SELECT bookmark_id, 'tag' || ((bookmark_id * k) % 200)
+    FROM bookmark, generate_series(1, 2) AS k;
+
+    INSERT INTO news_feed_item (user_id, comment_id)
+    SELECT DISTINCT recipient.user_id, comment.comment_id
+    FROM comment
+    JOIN bug USING (bug_id)
+    CROSS JOIN LATERAL (
+        SELECT bug.creator
+        UNION SELECT bug.assignee
+        UNION SELECT subscription.user_id
+              FROM subscription
+              WHERE subscription.bug_id = bug.bug_id
+    ) AS recipient (user_id)
+    WHERE recipient.user_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+
+    -- create_bug assigns new bugs to user 3, "unassigned".  Added last: the
+    -- seed users' IDs come from the sequence, which a rolled-back run leaves
+    -- advanced, and the rows above are spread from the lowest of them.
+    INSERT INTO bug_user (user_id, user_name, pw_hash, display_name, role)
+    VALUES (3, 'unassigned', 'x', 'unassigned', 'User')
+    ON CONFLICT DO NOTHING;
+'''
+
+
+class ExplainCursor(object):
+    """
+    Wraps a cursor so that every statement is EXPLAINed, then run, so the
+    code under test still gets its results.
+    """
+
+    def __init__(self, cur, plans):
+        self._cur = cur
+        self._plans = plans
+        self.itersize = 1000
+
+    def execute(self, query, vars=None):
+        # execute_values passes the statement already composed, as bytes
+        text = query
+        explain = 'EXPLAIN (FORMAT JSON) '
+        if isinstance(query, bytes):
+            text = query.decode('UTF-8', 'replace')
+            explain = explain.encode('ascii')
+        verb = text.split(None, 1)[0].upper()
+        if verb in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'EXECUTE'):
+            self._cur.execute(explain + query, vars)
+            plan = self._cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            self._plans.append((' '.join(text.split()), plan[0]['Plan']))
+        return self._cur.execute(query, vars)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+        return False
+
+
+class ExplainConnection(object):
+    """
+    Stands in for a connection: hands out ExplainCursors and turns the
+    application's commits into no-ops, so the whole check stays inside one
+    transaction that is rolled back at the end.
+    """
+
+    def __init__(self, cxn):
+        self._cxn = cxn
+        self.plans = []
+
+    def cursor(self, name=None):
+        # server-side cursors cannot be EXPLAINed; a client cursor runs the
+        # same statement
+        return ExplainCursor(self._cxn.cursor(), self.plans)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def seq_scans(plan):
+    """
+    Find the tables a plan reads with a sequential scan.
+    :param plan: A plan node from EXPLAIN (FORMAT JSON).
+    :return: A set of table names.
+    """
+    tables = set()
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        tables |= seq_scans(child)
+    return tables
+
+
+def _checks(ids):
+    bug, user, milestone = ids['bug'], ids['user'], ids['milestone']
+    comment = ids['comment']
+    first_page = {}
+
+    def bug_list_page_2(dbc):
+        after = first_page.get('next')
+        return bug_bookmarks.get_bugs(dbc, 50, after=after)
+
+    def bug_list_page_1(dbc):
+        first_page.update(bug_bookmarks.get_bugs(dbc, 50))
+
+    edit_form = {'bug_title': 'Edited', 'bug_details': 'Edited details',
+                 'bug_priority': 'High', 'milestone': str(milestone),
+                 'assignee': str(user), 'status': 'Testing',
+                 'tags': 'tag1, tag2, new-tag', 'version': '1'}
+    # (name, function, tables this query legitimately reads in full)
+    return [
+        ('get_bugs', bug_list_page_1, ()),
+        ('get_bugs after cursor', bug_list_page_2, ()),
+        ('get_bugs by status',
+         lambda dbc: bug_bookmarks.get_bugs(dbc, 50, filters={'status': 'Open'}),
+         ()),
+        ('get_bugs by priority',
+         lambda dbc: bug_bookmarks.get_bugs(dbc, 50,
+                                            filters={'priority': 'High'}), ()),
+        ('get_bugs by milestone',
+         lambda dbc: bug_bookmarks.get_bugs(
+             dbc, 50, filters={'milestone': milestone}), ()),
+        ('get_bugs by assignee',
+         lambda dbc: bug_bookmarks.get_bugs(dbc, 50,
+                                            filters={'assignee': user}), ()),
+        ('get_bugs by tag',
+         lambda dbc: bug_bookmarks.get_bugs(dbc, 50, filters={'tag': 'tag7'}),
+         ()),
+        # the streaming exports; unfiltered, they read every bug
+        ('iter_bugs', lambda dbc: list(bug_bookmarks.iter_bugs(dbc)), ('bug',)),
+        ('iter_bugs by assignee',
+         lambda dbc: list(bug_bookmarks.iter_bugs(dbc,
+                                                  filters={'assignee': user})),
+         ()),
+        ('get_bug', lambda dbc: bug_bookmarks.get_bug(dbc, bug), ()),
+        ('get_bug_details',
+         lambda dbc: bug_bookmarks.get_bug_details(dbc, bug), ()),
+        ('get_bug_comments',
+         lambda dbc: bug_bookmarks.get_bug_comments(dbc, bug), ()),
+        ('get_bug_comments after cursor',
+         lambda dbc: bug_bookmarks.get_bug_comments(
+             dbc, bug, 1,
+             before=bug_bookmarks.get_bug_comments(dbc, bug, 1)['next']), ()),
+        ('get_for_user', lambda dbc: bug_bookmarks.get_for_user(dbc, user), ()),
+        ('get_news_comments',
+         lambda dbc: bug_bookmarks.get_news_comments(dbc, user), ()),
+        ('get_news_comments since',
+         lambda dbc: bug_bookmarks.get_news_comments(
+             dbc, user,
+             since=bug_bookmarks.get_news_comments(dbc, user)['since']), ()),
+        ('get_feed_deliveries',
+         lambda dbc: bug_bookmarks.get_feed_deliveries(
+             dbc, range(comment - 10, comment + 1), [user, user - 1]), ()),
+        ('get_bug_watchers',
+         lambda dbc: bug_bookmarks.get_bug_watchers(dbc, bug, [user, user - 1]),
+         ()),
+        ('search_bugs',
+         lambda dbc: bug_bookmarks.search_bugs(dbc, 'crashes save'), ()),
+        ('search_bugs by tag',
+         lambda dbc: bug_bookmarks.search_bugs(dbc, 'crashes',
+                                               filters={'tag': 'tag7'}), ()),
+        ('get_milestones', bug_bookmarks.get_milestones, ()),
+        ('get_developers', bug_bookmarks.get_developers, ('bug_user',)),
+        ('get_report_info_1', bug_bookmarks.get_report_info_1,
+         ('rollup_bug_hours', 'bug')),
+        ('get_report_info_2', bug_bookmarks.get_report_info_2,
+         ('rollup_user_hours', 'bug_user')),
+        ('get_report_info_3', bug_bookmarks.get_report_info_3,
+         ('rollup_status_count',)),
+        ('get_user', lambda dbc: bug_users.get_user(dbc, user), ()),
+        ('lookup_user', lambda dbc: bug_users.lookup_user(dbc, 'seed42'), ()),
+        ('create_bug',
+         lambda dbc: bug_bookmarks.create_bug(dbc, user, {
+             'bug_title': 'New', 'bug_details': 'New details',
+             'bug_priority': 'Low', 'milestone': str(milestone),
+             'tags': 'tag1, tag2'}), ()),
+        ('update_bug',
+         lambda dbc: bug_bookmarks.update_bug(dbc, bug, edit_form), ()),
+        ('add_comment',
+         lambda dbc: bug_bookmarks.add_comment(dbc, bug, user,
+                                               {'comment_text': 'Checked'}), ()),
+        ('add_hours_worked',
+         lambda dbc: bug_bookmarks.add_hours_worked(dbc, bug, user,
+                                                    {'hours_worked': '1.5'}),
+         ()),
+    ]
+
+
+def run(cxn, log=print):
+    """
+    Seed the database and check every query's plan.  The transaction is
+    rolled back afterwards.
+    :param cxn: A psycopg2 connection to a scratch database.
+    :param log: A function to report results to.
+    :return: The number of queries with unexpected sequential scans.
+    """
+    failures = 0
+    try:
+        with cxn.cursor() as cur:
+            cur.execute(SEED_SQL)
+        # the rollups as the application maintains them; the connection
+        # wrapper keeps the rebuild's commit from ending the transaction
+        bug_rollups.rebuild(ExplainConnection(cxn))
+        with cxn.cursor() as cur:
+            cur.execute('ANALYZE')
+            cur.execute('''
+                SELECT (SELECT max(bug_id) FROM bug),
+                       (SELECT max(user_id) FROM bug_user
+                        WHERE role = 'Developer'),
+                       (SELECT max(milestone_id) FROM milestone),
+                       (SELECT max(comment_id) FROM comment)
+            ''')
+            bug, user, milestone, comment = cur.fetchone()
+        ids = {'bug': bug, 'user': user, 'milestone': milestone,
+               'comment': comment}
+        for name, check, allowed in _checks(ids):
+            dbc = ExplainConnection(cxn)
+            with cxn.cursor() as cur:
+                cur.execute('SAVEPOINT explain_check')
+            try:
+                check(dbc)
+            finally:
+                with cxn.cursor() as cur:
+                    cur.execute('ROLLBACK TO SAVEPOINT explain_check')
+            bad = []
+            for query, plan in dbc.plans:
+                scanned = seq_scans(plan) - SMALL_TABLES - set(allowed)
+                if scanned:
+                    bad.append((sorted(scanned), query))
+            if bad:
+                failures += 1
+                for tables, query in bad:
+                    log('FAIL {}: seq scan on {}\n     {}'.format(
+                        name, ', '.join(tables), query))
+            else:
+                log('ok   {} ({} statements)'.format(name, len(dbc.plans)))
+    finally:
+        cxn.rollback()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m migrations.explain_check',
+                                     description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--settings', default='settings.py',
+                        help='settings file holding PG_ARGS')
+    args = parser.parse_args(argv)
+    config = {}
+    with open(args.settings) as f:
+        exec(compile(f.read(), args.settings, 'exec'), config)
+    cxn = psycopg2.connect(**config['PG_ARGS'])
+    try:
+        failures = run(cxn)
+    finally:
+        cxn.close()
+    print('{} queries with unexpected sequential scans'.format(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
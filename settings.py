@@ -5,3 +5,109 @@ SERVER_NAME='localhost:5347'
 
 PG_ARGS = {'database': 'cs4332sm1', 'host': 'localhost',
            'user': 'gdv9', 'password': 'XXXXXXXXXXXXXXXXXXXX'}
+
+# Connection pool: connections are checked out once per request and returned
+# at teardown.  DB_POOL_TIMEOUT is how long (seconds) a request waits for a
+# free connection before failing with 503; idle connections older than
+# DB_POOL_VALIDATE_AFTER seconds are pinged before reuse.
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_TIMEOUT = 5.0
+DB_POOL_VALIDATE_AFTER = 30.0
+
+# Streaming read replica for list, detail, feed, search and report pages
+# (None sends everything to PG_ARGS).  It gets its own pool, sized like the
+# primary's.  After a user writes, their reads stay on the primary until the
+# replica has replayed the write, or for at most REPLICA_PIN_SECONDS.
+PG_REPLICA_ARGS = None
+REPLICA_PIN_SECONDS = 30.0
+
+# /bug_list page size (overridable per request with ?limit=, up to the max)
+BUG_LIST_PAGE_SIZE = 50
+BUG_LIST_MAX_PAGE_SIZE = 200
+
+# Streaming bug list and exports: rows fetched per server-side cursor round
+# trip, and template chunks buffered before each write to the client.
+BUG_STREAM_ITERSIZE = 1000
+TEMPLATE_STREAM_BUFFER = 20
+
+# Number of comments shown on /news_feed and returned per ?since= poll
+NEWS_FEED_LIMIT = 50
+
+# Seconds a worker serves cached reference data (milestones, developers)
+# before re-checking its version stamp in the database
+REF_CACHE_TTL = 60.0
+
+# Password hashing runs on a separate process pool.  Logins beyond
+# AUTH_POOL_WORKERS + AUTH_POOL_QUEUE_LIMIT concurrent hashes get a 503 with
+# Retry-After: AUTH_RETRY_AFTER seconds.  BCRYPT_ROUNDS is the cost factor
+# for new hashes; existing hashes keep the cost they were created with.
+BCRYPT_ROUNDS = 12
+AUTH_POOL_WORKERS = 2
+AUTH_POOL_QUEUE_LIMIT = 8
+AUTH_POOL_TIMEOUT = 10.0
+AUTH_RETRY_AFTER = 5
+
+# Logged-in users are cached per worker for USER_CACHE_TTL seconds
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 30.0
+
+# Results per page on /search
+SEARCH_PAGE_SIZE = 20
+
+# Seconds a worker trusts its tag index before re-checking the 'tags'
+# version stamp for changes made by other workers
+TAG_INDEX_TTL = 30.0
+
+# SQL instrumentation: statements slower than SQL_SLOW_QUERY_MS are logged,
+# as are statements run SQL_N_PLUS_ONE_THRESHOLD or more times in a request
+SQL_SLOW_QUERY_MS = 100
+SQL_N_PLUS_ONE_THRESHOLD = 5
+
+# Request profiling.  Managers can profile a request with an X-Profile: 1
+# header or ?profile=1; PROFILE_SAMPLE_RATE also profiles that fraction of
+# all requests.  Profiles are written to PROFILE_DIR (disabled when None) as
+# collapsed stacks ('sample', every PROFILE_INTERVAL seconds) or as pstats
+# ('cprofile').
+PROFILE_DIR = None
+PROFILE_MODE = 'sample'
+PROFILE_INTERVAL = 0.005
+PROFILE_SAMPLE_RATE = 0.0
+
+# Bug, list, feed and report pages carry ETags derived from version stamps
+# and the templates.  Change ETAG_SALT to invalidate every client's copy, for
+# example after a change to the view code that the templates do not show.
+ETAG_SALT = ''
+
+# Rendered bug and comment fragments are cached per worker, up to
+# FRAGMENT_CACHE_BYTES of HTML.  Set FRAGMENT_CACHE_DIR to also share them
+# between workers through files there; `flask prune-fragments` deletes
+# files older than FRAGMENT_CACHE_MAX_AGE seconds.
+FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+FRAGMENT_CACHE_DIR = None
+FRAGMENT_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Comments shown per page on bug details, and per "load more"
+COMMENT_PAGE_SIZE = 50
+
+# Bulk loads (/bulk/hours, /bulk/comments, flask import-hours and
+# import-comments) are validated as a whole, then inserted and committed
+# BULK_BATCH_SIZE rows at a time.  If a later group fails, the response says
+# how many rows were loaded and the row to resume from
+BULK_BATCH_SIZE = 1000
+
+# Live news feed (/news_feed/stream).  Each worker accepts up to
+# EVENT_MAX_STREAMS streams (more get a 503 with Retry-After:
+# EVENT_RETRY_AFTER), queues at most EVENT_QUEUE_SIZE undelivered events per
+# stream, and sends a heartbeat after EVENT_HEARTBEAT quiet seconds.
+EVENT_MAX_STREAMS = 100
+EVENT_QUEUE_SIZE = 100
+EVENT_HEARTBEAT = 15.0
+EVENT_RETRY_AFTER = 10
+
+# Reports are computed in the background by REPORT_WORKERS threads per
+# worker; pages show the last result and queue a refresh when it is stale.
+# A page with no result yet asks the client to retry after
+# REPORT_RETRY_AFTER seconds.
+REPORT_WORKERS = 2
+REPORT_RETRY_AFTER = 5
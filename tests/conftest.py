@@ -0,0 +1,122 @@
+"""
+Fixtures for the tests that need a database.
+
+They run against the scratch PostgreSQL database named by the
+BUGTRACKER_TEST_DSN environment variable, a libpq connection string such as
+``dbname=bugtracker_test host=localhost``.  Each test drops and recreates its
+public schema, so never point it at real data.  Without it, those tests are
+skipped.
+"""
+import os
+import psycopg2
+import pytest
+import migrations
+from bookmarky import bug_cache, bug_dbutil, bug_rollups
+
+TEST_DSN = os.environ.get('BUGTRACKER_TEST_DSN')
+
+SEED_SQL = '''
+    -- user 3 is "unassigned", the assignee create_bug gives new bugs
+    INSERT INTO bug_user (user_name, pw_hash, display_name, e_mail, role)
+    VALUES ('manager', 'x', 'Manager', 'manager@example.com', 'Manager'),
+           ('developer', 'x', 'Developer', 'dev@example.com', 'Developer'),
+           ('unassigned', 'x', 'unassigned', NULL, 'User');
+
+    INSERT INTO milestone (milestone_title, target_date)
+    SELECT 'Milestone ' || i, current_date + i * 14
+    FROM generate_series(1, 3) AS i;
+
+    INSERT INTO bug (bug_title, bug_details, creator, assignee, tag_text,
+                     status, bug_priority, milestone_id)
+    SELECT 'Bug ' || i, 'Details of bug ' || i, 1 + i % 2, 1 + i % 3, '',
+           (ARRAY['Open', 'Testing', 'Closed'])[1 + i % 3], 'Low',
+           -- every fourth bug is not in a milestone
+           CASE WHEN i % 4 <> 0 THEN 1 + i % 3 END
+    FROM generate_series(1, 20) AS i;
+
+    INSERT INTO hours (user_id, bug_id, hours_worked)
+    SELECT 1 + i % 2, 1 + i % 15, 0.25 * (1 + i % 8)
+    FROM generate_series(1, 60) AS i;
+'''
+
+
+@pytest.fixture
+def pg_args():
+    """
+    The test database's connection parameters, as for psycopg2.connect.
+    """
+    if not TEST_DSN:
+        pytest.skip('BUGTRACKER_TEST_DSN is not set')
+    return psycopg2.extensions.parse_dsn(TEST_DSN)
+
+
+@pytest.fixture
+def blank_db():
+    """
+    A connection to the test database with an empty public schema.
+    """
+    if not TEST_DSN:
+        pytest.skip('BUGTRACKER_TEST_DSN is not set')
+    dbc = psycopg2.connect(TEST_DSN)
+    with dbc, dbc.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE')
+        cur.execute('CREATE SCHEMA public')
+    yield dbc
+    dbc.close()
+
+
+def _seed(dbc):
+    with dbc, dbc.cursor() as cur:
+        cur.execute(SEED_SQL)
+
+
+@pytest.fixture
+def seed():
+    """
+    A function that adds a few users, milestones, bugs and hours to a
+    database, with the base schema at least, without touching the rollups.
+    """
+    return _seed
+
+
+@pytest.fixture
+def dbc(blank_db):
+    """
+    A connection to the test database with every migration applied, the
+    seed rows, and rollups built from them.
+    """
+    migrations.migrate(blank_db, log=lambda line: None)
+    _seed(blank_db)
+    bug_rollups.rebuild(blank_db)
+    return blank_db
+
+
+@pytest.fixture
+def client(dbc, pg_args, monkeypatch):
+    """
+    A test client for the application, on a connection pool for the test
+    database.  Log in with ``login(client, uid)``.
+    """
+    import bugtracker
+    app = bugtracker.app
+    pool = bug_dbutil.ConnectionPool(pg_args)
+    monkeypatch.setitem(app.extensions, 'db_pool', pool)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    # cached rows from an earlier test's database
+    bug_cache.ref_cache.invalidate()
+    for uid in (1, 2, 3):
+        bug_cache.user_cache.invalidate(uid)
+    with app.test_client() as client:
+        yield client
+    pool.close()
+
+
+@pytest.fixture
+def login():
+    """
+    A function that logs a test client in as a user.
+    """
+    def login(client, uid):
+        with client.session_transaction() as session:
+            session['auth_user'] = uid
+    return login
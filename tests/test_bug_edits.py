@@ -0,0 +1,73 @@
+import pytest
+import werkzeug.exceptions
+from bookmarky import bug_bookmarks
+
+
+def edit_form(bug, **changes):
+    form = {'bug_title': bug.bug_title, 'bug_details': bug.bug_details,
+            'bug_priority': bug.bug_priority,
+            'milestone': str(bug.milestone_id or ''),
+            'assignee': str(bug.assignee or ''), 'status': bug.status,
+            'tags': ', '.join(bug.tags), 'version': str(bug.version)}
+    form.update(changes)
+    return form
+
+
+def test_update_bug_writes_changes_and_bumps_version(dbc):
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, edit_form(bug, bug_title='Renamed',
+                                               tags='ui, Crash'))
+    edited = bug_bookmarks.get_bug(dbc, 1)
+    assert edited.bug_title == 'Renamed'
+    assert sorted(edited.tags) == ['crash', 'ui']
+    assert edited.version == bug.version + 1
+
+
+def test_unchanged_edit_keeps_version(dbc):
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, edit_form(bug))
+    assert bug_bookmarks.get_bug(dbc, 1).version == bug.version
+
+
+def test_stale_edit_conflicts(dbc):
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, edit_form(bug, status='Closed'))
+    with pytest.raises(bug_bookmarks.BugConflict) as raised:
+        bug_bookmarks.update_bug(dbc, 1, edit_form(bug, bug_title='Lost'))
+    assert raised.value.bid == 1
+    assert bug_bookmarks.get_bug(dbc, 1).bug_title == bug.bug_title
+
+
+def test_stale_edit_answers_409_with_current_bug(client, login, dbc):
+    login(client, 1)
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, edit_form(bug, status='Closed'))
+
+    response = client.post('/edit_bug/1', data=edit_form(bug),
+                           headers={'Accept': 'application/json'})
+    assert response.status_code == 409
+    assert response.json['error'] == 'conflict'
+    assert response.json['bug']['status'] == 'Closed'
+    assert response.json['bug']['version'] == bug.version + 1
+
+    response = client.post('/edit_bug/1', data=edit_form(bug))
+    assert response.status_code == 409
+    assert b'Someone else changed this bug' in response.data
+
+
+def test_conflict_on_deleted_bug_answers_404(client, dbc):
+    import bugtracker
+    with bugtracker.app.test_request_context('/edit_bug/999', method='POST'):
+        with pytest.raises(werkzeug.exceptions.NotFound):
+            bugtracker.bug_conflict(bug_bookmarks.BugConflict(999))
+
+
+def test_new_assignee_gets_earlier_comments_in_their_feed(dbc):
+    for text in ('before', 'also before'):
+        bug_bookmarks.add_comment(dbc, 1, 1, {'comment_text': text})
+    since = bug_bookmarks.get_news_comments(dbc, 3)['since']
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, edit_form(bug, assignee='3'))
+    poll = bug_bookmarks.get_news_comments(dbc, 3, since=since)
+    assert sorted(c.comment_text for c in poll['comments']) == [
+        'also before', 'before']
@@ -0,0 +1,48 @@
+import pytest
+import werkzeug.exceptions
+from bookmarky import bug_bookmarks
+
+
+def all_bug_ids(dbc, **kwargs):
+    return [bug.bug_id
+            for bug in bug_bookmarks.get_bugs(dbc, 100, **kwargs)['bugs']]
+
+
+def test_pages_round_trip(dbc):
+    expected = all_bug_ids(dbc)
+    assert len(expected) > 8
+
+    pages = [bug_bookmarks.get_bugs(dbc, 4)]
+    assert pages[0]['prev'] is None
+    while pages[-1]['next'] is not None:
+        pages.append(bug_bookmarks.get_bugs(dbc, 4, after=pages[-1]['next']))
+    assert [bug.bug_id for page in pages for bug in page['bugs']] == expected
+    assert all(len(page['bugs']) == 4 for page in pages[:-1])
+
+    # and back again from the last page
+    for page, previous in zip(reversed(pages[1:]), reversed(pages[:-1])):
+        back = bug_bookmarks.get_bugs(dbc, 4, before=page['prev'])
+        assert back['bugs'] == previous['bugs']
+        assert back['next'] == previous['next']
+
+
+def test_filters(dbc):
+    milestone_2 = all_bug_ids(dbc, filters={'milestone': '2'})
+    assert milestone_2
+    assert all(bug_bookmarks.get_bug(dbc, bid).milestone_id == 2
+               for bid in milestone_2)
+    assert all_bug_ids(dbc, filters={'milestone': '2',
+                                     'status': 'Testing'}) == [
+        bid for bid in milestone_2
+        if bug_bookmarks.get_bug(dbc, bid).status == 'Testing']
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'filters': {'milestone': 'two'}},
+    {'filters': {'assignee': '1 OR 1=1'}},
+    {'after': 'not a cursor'},
+    {'before': 'yesterday,12'},
+])
+def test_malformed_input_is_a_bad_request(dbc, kwargs):
+    with pytest.raises(werkzeug.exceptions.BadRequest):
+        bug_bookmarks.get_bugs(dbc, 10, **kwargs)
@@ -0,0 +1,72 @@
+import psycopg2
+import pytest
+from bookmarky import bug_bookmarks
+
+
+def comment_count(dbc):
+    with dbc, dbc.cursor() as cur:
+        cur.execute('SELECT count(*) FROM comment')
+        return cur.fetchone()[0]
+
+
+@pytest.mark.parametrize('text', [None, 42, ['a'], '   '])
+def test_comment_text_must_be_text(dbc, text):
+    result = bug_bookmarks.add_comments_batch(dbc, [
+        {'bug_id': 1, 'user_id': 1, 'comment_text': 'fine'},
+        {'bug_id': 1, 'user_id': 1, 'comment_text': text},
+    ])
+    assert result['ids'] == []
+    assert [error['row'] for error in result['errors']] == [2]
+    assert result['errors'][0]['error'].startswith('comment_text: ')
+    assert comment_count(dbc) == 0
+
+
+@pytest.fixture
+def failing_comment(dbc):
+    """Make inserting a comment with the text 'boom' fail."""
+    with dbc, dbc.cursor() as cur:
+        cur.execute('''
+            CREATE FUNCTION boom() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION 'boom';
+            END
+            $$ LANGUAGE plpgsql;
+            CREATE TRIGGER boom BEFORE INSERT ON comment FOR EACH ROW
+            WHEN (NEW.comment_text = 'boom') EXECUTE PROCEDURE boom();
+        ''')
+
+
+def entries(*texts):
+    return [{'bug_id': 1, 'user_id': 1, 'comment_text': text}
+            for text in texts]
+
+
+def test_failed_group_reports_where_to_resume(dbc, failing_comment):
+    with pytest.raises(bug_bookmarks.PartialLoad) as e:
+        bug_bookmarks.add_comments_batch(
+            dbc, entries('a', 'b', 'c', 'boom', 'e'), batch_size=2)
+    assert len(e.value.ids) == 2
+    assert e.value.row == 3
+    assert comment_count(dbc) == 2
+    assert bug_bookmarks.get_bug(dbc, 1).comment_count == 2
+
+
+def test_failed_first_group_loads_nothing(dbc, failing_comment):
+    with pytest.raises(psycopg2.Error):
+        bug_bookmarks.add_comments_batch(dbc, entries('boom', 'b'))
+    assert comment_count(dbc) == 0
+
+
+def test_bulk_comments_endpoint(client, login, failing_comment, monkeypatch):
+    import bugtracker
+    monkeypatch.setitem(bugtracker.app.config, 'BULK_BATCH_SIZE', 2)
+    login(client, 1)
+    response = client.post('/bulk/comments', json=entries('a', 'b'))
+    assert response.status_code == 200
+    assert response.get_json() == {'loaded': 2, 'errors': []}
+
+    response = client.post('/bulk/comments',
+                           json=entries('c', 'd', 'boom', 'f'))
+    assert response.status_code == 500
+    assert response.get_json()['loaded'] == 2
+    assert response.get_json()['resume_from'] == 3
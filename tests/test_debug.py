@@ -0,0 +1,13 @@
+import pytest
+
+DEBUG_URLS = ['/debug/pool_stats', '/debug/auth_stats', '/debug/report_stats',
+              '/debug/metrics']
+
+
+@pytest.mark.parametrize('url', DEBUG_URLS)
+def test_debug_pages_are_for_managers_only(client, login, url):
+    assert client.get(url).status_code == 403
+    login(client, 2)
+    assert client.get(url).status_code == 403
+    login(client, 1)
+    assert client.get(url).status_code == 200
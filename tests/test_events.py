@@ -0,0 +1,33 @@
+import queue
+from bookmarky import bug_bookmarks, bug_events
+
+
+def test_comments_reach_open_streams(client, dbc, pg_args, monkeypatch):
+    import bugtracker
+    monkeypatch.setitem(bugtracker.app.config, 'PG_ARGS', pg_args)
+    hub = bug_events.EventHub()
+    watcher = hub.subscribe(bugtracker.app, 2)
+    bystander = hub.subscribe(bugtracker.app, 3)
+    # wait for the listener to be LISTENing
+    for _ in range(20):
+        if hub.stats()['notifications']:
+            break
+        bug_bookmarks.add_comment(dbc, 1, 1, {'comment_text': 'ping'})
+        try:
+            watcher.queue.get(timeout=0.5)
+        except queue.Empty:
+            pass
+    assert hub.stats()['notifications']
+
+    ids = [bug_bookmarks.add_comment(dbc, 1, 1, {'comment_text': text})
+           for text in ('first', 'second', 'third')]
+    events = []
+    while len(events) < len(ids):
+        event = watcher.queue.get(timeout=5)
+        if event[1]['comment_text'] != 'ping':
+            events.append(event)
+    assert [data['comment_id'] for _, data in events] == ids
+    assert all(event == 'comment' and data['html'] for event, data in events)
+    assert bystander.queue.empty()
+    hub.unsubscribe(watcher)
+    hub.unsubscribe(bystander)
@@ -0,0 +1,72 @@
+import os
+import time
+from bookmarky import bug_bookmarks, bug_fragments
+from bookmarky.bug_fragments import FileFragmentStore, FragmentCache
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    cache = FragmentCache(max_bytes=10)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    assert cache.get('a') == 'aaaa'
+    cache.put('c', 'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (2, 8, 1)
+
+
+def test_cache_skips_fragments_larger_than_itself():
+    cache = FragmentCache(max_bytes=3)
+    cache.put('big', 'xxxx')
+    assert cache.get('big') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_shared_store_serves_other_workers(tmp_path):
+    store = FileFragmentStore(str(tmp_path))
+    FragmentCache(store=store).put('bug:1', '<div>1</div>')
+    other = FragmentCache(store=store)
+    assert other.get('bug:1') == '<div>1</div>'
+    assert other.get('bug:1') == '<div>1</div>'
+    stats = other.stats()
+    assert (stats['shared_hits'], stats['hits']) == (1, 1)
+
+
+def test_prune_deletes_only_old_fragments(tmp_path):
+    store = FileFragmentStore(str(tmp_path))
+    store.put('old', 'x')
+    store.put('new', 'y')
+    an_hour_ago = time.time() - 3600
+    os.utime(store._file('old'), (an_hour_ago, an_hour_ago))
+    assert store.prune(60) == 1
+    assert store.get('old') is None
+    assert store.get('new') == 'y'
+
+
+def test_edited_bug_gets_a_new_key(dbc):
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_bookmarks.update_bug(dbc, 1, {
+        'bug_title': 'Renamed', 'bug_details': bug.bug_details,
+        'bug_priority': bug.bug_priority, 'milestone': str(bug.milestone_id),
+        'assignee': str(bug.assignee), 'status': bug.status, 'tags': '',
+        'version': str(bug.version)})
+    edited = bug_bookmarks.get_bug(dbc, 1)
+    assert bug_fragments.bug_key(edited) != bug_fragments.bug_key(bug)
+    assert bug_fragments.bug_key(edited) == bug_fragments.bug_key(
+        bug_bookmarks.get_bug(dbc, 1))
+
+
+def test_bug_is_rendered_once(client, dbc):
+    import bugtracker
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    bug_fragments.fragment_cache.clear()
+    with bugtracker.app.test_request_context('/'):
+        stats = bug_fragments.fragment_cache.stats()
+        html = bug_fragments.render_bug(bug)
+        assert bug.bug_title in html
+        assert bug_fragments.render_bug(bug) == html
+    after = bug_fragments.fragment_cache.stats()
+    assert after['misses'] == stats['misses'] + 1
+    assert after['hits'] == stats['hits'] + 1
@@ -0,0 +1,73 @@
+import psycopg2
+import pytest
+import werkzeug.exceptions
+from bookmarky import bug_bookmarks
+
+# bug 1's creator and assignee, whose feed its comments go to
+USER = 2
+
+
+@pytest.fixture
+def other_dbc(pg_args):
+    dbc = psycopg2.connect(**pg_args)
+    yield dbc
+    dbc.close()
+
+
+def comment(dbc, text):
+    return bug_bookmarks.add_comment(dbc, 1, 1, {'comment_text': text})
+
+
+def texts(feed):
+    return [c.comment_text for c in feed['comments']]
+
+
+def test_feed_page_is_newest_first(dbc):
+    for text in 'abc':
+        comment(dbc, text)
+    assert texts(bug_bookmarks.get_news_comments(dbc, USER)) == ['c', 'b', 'a']
+
+
+def test_polls_page_forward_through_a_backlog(dbc):
+    since = bug_bookmarks.get_news_comments(dbc, USER)['since']
+    for text in 'abcde':
+        comment(dbc, text)
+    seen = []
+    while True:
+        poll = bug_bookmarks.get_news_comments(dbc, USER, 2, since)
+        if not poll['comments']:
+            break
+        seen.extend(texts(poll))
+        since = poll['since']
+    assert seen == ['a', 'b', 'c', 'd', 'e']
+    assert poll['since'] == since
+
+
+def test_poll_waits_for_a_comment_committed_out_of_order(dbc, other_dbc):
+    since = bug_bookmarks.get_news_comments(dbc, USER)['since']
+
+    # the first comment's transaction is still open when a later one commits
+    with other_dbc.cursor() as cur:
+        cur.execute('''
+            INSERT INTO comment (comment_author, bug_id, comment_text)
+            VALUES (1, 1, 'first') RETURNING comment_id
+        ''')
+        first = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO news_feed_item (user_id, comment_id) VALUES (%s, %s)
+        ''', (USER, first))
+    second = comment(dbc, 'second')
+    assert first < second
+
+    poll = bug_bookmarks.get_news_comments(dbc, USER, since=since)
+    assert texts(poll) == []
+    other_dbc.commit()
+    poll = bug_bookmarks.get_news_comments(dbc, USER, since=poll['since'])
+    assert texts(poll) == ['first', 'second']
+    poll = bug_bookmarks.get_news_comments(dbc, USER, since=poll['since'])
+    assert texts(poll) == []
+
+
+def test_malformed_cursor_is_a_bad_request(dbc):
+    with pytest.raises(werkzeug.exceptions.BadRequest):
+        bug_bookmarks.get_news_comments(dbc, USER, since='12')
@@ -0,0 +1,133 @@
+import os
+import threading
+import psycopg2.extensions
+import pytest
+from bookmarky.bug_dbutil import ConnectionPool, PoolTimeout
+
+
+@pytest.fixture
+def make_pool(pg_args):
+    pools = []
+
+    def make_pool(**kwargs):
+        pool = ConnectionPool(pg_args, **kwargs)
+        pools.append(pool)
+        return pool
+    yield make_pool
+    for pool in pools:
+        pool.close()
+
+
+def test_first_checkout_fills_to_min_size(make_pool):
+    pool = make_pool(min_size=3, max_size=5)
+    cxn = pool.getconn()
+    stats = pool.stats()
+    assert stats['opened'] == 3
+    assert (stats['in_use'], stats['idle']) == (1, 2)
+    pool.putconn(cxn)
+
+
+def test_returned_connection_is_reused(make_pool):
+    pool = make_pool(min_size=1, max_size=2)
+    cxn = pool.getconn()
+    pool.putconn(cxn)
+    assert pool.getconn() is cxn
+    assert cxn.checkouts == 2
+    assert pool.stats()['opened'] == 1
+
+
+def test_open_transaction_is_rolled_back_on_return(make_pool):
+    pool = make_pool(min_size=1, max_size=1)
+    cxn = pool.getconn()
+    with cxn.cursor() as cur:
+        cur.execute('CREATE TEMP TABLE scratch (x INTEGER)')
+    pool.putconn(cxn)
+    assert (cxn.get_transaction_status() ==
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+    with cxn.cursor() as cur:
+        cur.execute("SELECT to_regclass('pg_temp.scratch')")
+        assert cur.fetchone()[0] is None
+
+
+def test_closed_connection_is_discarded(make_pool):
+    pool = make_pool(min_size=1, max_size=1)
+    cxn = pool.getconn()
+    cxn.close()
+    pool.putconn(cxn)
+    assert pool.stats()['discarded'] == 1
+    replacement = pool.getconn()
+    assert replacement is not cxn and not replacement.closed
+
+
+def test_checkout_beyond_max_size_times_out(make_pool):
+    pool = make_pool(min_size=1, max_size=2, timeout=0.1)
+    held = [pool.getconn(), pool.getconn()]
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+    for cxn in held:
+        pool.putconn(cxn)
+
+
+def test_waiter_gets_returned_connection(make_pool):
+    pool = make_pool(min_size=1, max_size=1, timeout=5.0)
+    cxn = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    pool.putconn(cxn)
+    waiter.join()
+    assert got == [cxn]
+
+
+def test_concurrent_first_checkouts_stay_within_max_size(make_pool):
+    pool = make_pool(min_size=3, max_size=4, timeout=0.5)
+    start = threading.Barrier(6)
+    held = []
+
+    def checkout():
+        start.wait()
+        try:
+            held.append(pool.getconn())
+        except PoolTimeout:
+            pass
+    threads = [threading.Thread(target=checkout) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert len(held) == 4
+    assert stats['opened'] == 4
+    assert stats['size'] <= 4
+
+
+def test_forked_child_leaves_the_parents_connections_alone(make_pool):
+    pool = make_pool(min_size=2, max_size=3)
+    pool.putconn(pool.getconn())
+    parents = [cxn for cxn, _ in pool._idle]
+    backends = {cxn.get_backend_pid() for cxn in parents}
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            cxn = pool.getconn()
+            with cxn.cursor() as cur:
+                cur.execute('SELECT pg_backend_pid()')
+                fresh = cur.fetchone()[0] not in backends
+            stats = pool.stats()
+            if fresh and (stats['in_use'], stats['idle']) == (1, 1):
+                status = 0
+            pool.putconn(cxn)
+            pool.close()
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    # the parent's sessions survived the child
+    for cxn in parents:
+        with cxn.cursor() as cur:
+            cur.execute('SELECT 1')
+        cxn.rollback()
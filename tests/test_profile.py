@@ -0,0 +1,42 @@
+import cProfile
+import os
+from bookmarky import bug_profile
+
+
+def use_cprofile(tmp_path, monkeypatch):
+    import bugtracker
+    monkeypatch.setitem(bugtracker.app.config, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setitem(bugtracker.app.config, 'PROFILE_MODE', 'cprofile')
+
+
+def test_cprofile_writes_pstats(client, login, tmp_path, monkeypatch):
+    use_cprofile(tmp_path, monkeypatch)
+    login(client, 1)
+    assert client.get('/debug/pool_stats?profile=1').status_code == 200
+    assert [name.endswith('.pstats') for name in os.listdir(tmp_path)] == [
+        True]
+    assert not bug_profile._cprofile_lock.locked()
+
+
+def test_request_during_another_profile_is_served_unprofiled(
+        client, login, tmp_path, monkeypatch):
+    use_cprofile(tmp_path, monkeypatch)
+    login(client, 1)
+    with bug_profile._cprofile_lock:
+        assert client.get('/debug/pool_stats?profile=1').status_code == 200
+    assert os.listdir(tmp_path) == []
+
+
+def test_request_under_an_outside_profiler_succeeds(
+        client, login, tmp_path, monkeypatch):
+    use_cprofile(tmp_path, monkeypatch)
+    login(client, 1)
+    # Python 3.12 refuses to enable a second profiler
+    outside = cProfile.Profile()
+    outside.enable()
+    try:
+        response = client.get('/debug/pool_stats?profile=1')
+    finally:
+        outside.disable()
+    assert response.status_code == 200
+    assert not bug_profile._cprofile_lock.locked()
@@ -0,0 +1,60 @@
+import decimal
+import migrations
+from bookmarky import bug_bookmarks, bug_rollups
+
+ROLLUP_TABLES = ['rollup_bug_hours', 'rollup_user_hours', 'rollup_status_count']
+
+
+def rollups(dbc):
+    # every rollup row, leaving out zero counts, which rebuild never writes
+    # but the incremental updates leave behind
+    with dbc, dbc.cursor() as cur:
+        snapshot = {}
+        for table in ROLLUP_TABLES:
+            cur.execute('SELECT * FROM {} ORDER BY 1, 2'.format(table))
+            snapshot[table] = [row for row in cur
+                               if table == 'rollup_bug_hours' or row[2] != 0]
+        return snapshot
+
+
+def rebuilt(dbc):
+    bug_rollups.rebuild(dbc)
+    return rollups(dbc)
+
+
+def test_migration_backfill_matches_rebuild(blank_db, seed):
+    migrations.migrate(blank_db, target=2, log=lambda line: None)
+    seed(blank_db)
+    migrations.migrate(blank_db, log=lambda line: None)
+    backfilled = rollups(blank_db)
+    assert all(backfilled.values())
+    assert backfilled == rebuilt(blank_db)
+
+
+def test_incremental_updates_match_rebuild(dbc):
+    bug_bookmarks.create_bug(dbc, 1, {'bug_title': 'New bug',
+                                      'bug_details': 'Details',
+                                      'bug_priority': 'High',
+                                      'milestone': '2', 'tags': 'ui, crash'})
+    bid = bug_bookmarks.get_bugs(dbc, 1)['bugs'][0].bug_id
+    bug_bookmarks.add_hours_worked(dbc, bid, 2, {'hours_worked': '1.5'})
+    bug_bookmarks.add_hours_batch(dbc, [
+        {'bug_id': bid, 'user_id': 1, 'hours_worked': '2'},
+        {'bug_id': 1, 'user_id': 2, 'hours_worked': '0.5'}])
+
+    # move a bug with hours to another milestone and status, then out of
+    # milestones altogether
+    bug = bug_bookmarks.get_bug(dbc, 1)
+    form = {'bug_title': bug.bug_title, 'bug_details': bug.bug_details,
+            'bug_priority': bug.bug_priority, 'milestone': '3',
+            'assignee': str(bug.assignee), 'status': 'Closed', 'tags': '',
+            'version': str(bug.version)}
+    bug_bookmarks.update_bug(dbc, 1, form)
+    form.update(milestone='', version=str(bug.version + 1))
+    bug_bookmarks.update_bug(dbc, 1, form)
+
+    incremental = rollups(dbc)
+    assert [decimal.Decimal('3.5')] == [
+        hours for _, bug_id, hours in incremental['rollup_bug_hours']
+        if bug_id == bid]
+    assert incremental == rebuilt(dbc)
@@ -0,0 +1,42 @@
+from bookmarky import bug_bookmarks
+
+
+def tags_of(dbc, bid):
+    with dbc, dbc.cursor() as cur:
+        cur.execute('SELECT tag FROM bug_tag WHERE bug_id = %s ORDER BY tag',
+                    (bid,))
+        return [tag for tag, in cur]
+
+
+def sync(dbc, bid, text):
+    with dbc, dbc.cursor() as cur:
+        return bug_bookmarks.sync_tags(cur, bid,
+                                       bug_bookmarks.parse_tags(text))
+
+
+def test_parse_tags():
+    assert bug_bookmarks.parse_tags(' UI, crash,,ui , ') == ['crash', 'ui']
+    assert bug_bookmarks.parse_tags('') == []
+
+
+def test_sync_tags_adds_and_removes_only_the_difference(dbc):
+    added, removed = sync(dbc, 1, 'ui, crash')
+    assert (sorted(added), removed) == (['crash', 'ui'], [])
+    added, removed = sync(dbc, 1, 'crash, Save, data-loss')
+    assert sorted(added) == ['data-loss', 'save']
+    assert removed == ['ui']
+    assert tags_of(dbc, 1) == ['crash', 'data-loss', 'save']
+
+
+def test_sync_tags_with_unchanged_tags_writes_nothing(dbc):
+    sync(dbc, 1, 'ui, crash')
+    assert sync(dbc, 1, 'crash, ui') == ([], [])
+    assert tags_of(dbc, 1) == ['crash', 'ui']
+
+
+def test_sync_tags_to_none_clears_the_bug(dbc):
+    sync(dbc, 1, 'ui, crash')
+    sync(dbc, 2, 'ui')
+    assert sorted(sync(dbc, 1, '')[1]) == ['crash', 'ui']
+    assert tags_of(dbc, 1) == []
+    assert tags_of(dbc, 2) == ['ui']